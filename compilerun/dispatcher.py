@@ -1,123 +1,211 @@
-import hashlib
-import json
 import logging
 import re
+import time
 from time import sleep
-from urllib.parse import urljoin
 
-import requests
-from django.db import transaction
-from django.db.models import F
 from django.conf import settings
-from conf.models import JudgeServer
+from judge.allocator import JudgeLane, slot_allocator
+from judge.client import judge_timeout
+from judge.dispatcher import DispatcherBase as JudgeDispatcherBase
 from judge.languages import languages
+from judge.metrics import JudgeStage, StageTimer
+from judge.notifier import ResultKind, result_notifier
+from judge.registry import judge_server_registry
+from judge.result_cache import compile_run_cache
+from judge.scheduler import LEASE_GRACE_PERIOD, JudgeTaskClass, compile_run_queue
 from problem.models import Problem
 from submission.models import JudgeStatus
-from options.options import SysOptions
 from compilerun.models import CompileRunStatus, CompileRun
-from utils.cache import cache
-from utils.constants import CacheKey
 
 logger = logging.getLogger(__name__)
 
 
-# 继续处理在队列中的问题
+# 继续处理通道中等待的任务, 有多少空闲名额就取出多少
 def process_pending_task():
-    if cache.llen(CacheKey.waiting_queue):
-        # 防止循环引入c
-        from compilerun.tasks import compile_run_task
-
-        data = json.loads(cache.rpop(CacheKey.waiting_queue).decode("utf-8"))
-        compile_run_task.delay(**data)
-
-
-class DispatcherBase(object):
-    def __init__(self):
-        self.token = hashlib.sha256(
-            SysOptions.judge_server_token.encode("utf-8")
-        ).hexdigest()
-
-    def _request(self, url, data=None):
-        kwargs = {"headers": {"X-Judge-Server-Token": self.token}}
-        if data:
-            kwargs["json"] = data
-        try:
-            return requests.post(url, **kwargs).json()
-        except Exception as e:
-            logger.exception(e)
-
+    # 防止循环引入
+    from compilerun.tasks import compile_run_task
+
+    # 先获取名额再从队列中取出任务, 名额被其他进程抢走时任务留在原位
+    available = slot_allocator.available(JudgeLane.COMPILE_RUN)
+    for task in compile_run_queue.peek(available):
+        slot = slot_allocator.acquire(JudgeLane.COMPILE_RUN)
+        if not slot:
+            break
+        if not compile_run_queue.take(task):
+            slot_allocator.release(slot)
+            break
+        compile_run_task.delay(
+            **task["data"], enqueue_time=task.get("enqueue_time"), slot=vars(slot)
+        )
+
+
+# 每组输入保存的结果字段
+RESULT_FIELDS = ("result", "output", "error", "cpu_time", "memory", "real_time")
+
+# 支持 inputs 字段的 judge server 版本（心跳中的 judger_version）, 其他版本按组分别调用 /compile_run
+MULTIPLE_INPUTS_VERSIONS = ("mock",)
+
+
+def supports_multiple_inputs(server_id):
+    for server in judge_server_registry.active():
+        if server.id == server_id:
+            return server.judger_version in MULTIPLE_INPUTS_VERSIONS
+    return False
+
+
+def summarize_results(results):
+    """
+    多组输入的总体结果: 第一组没有通过的结果, 用时和内存取最大值, 输出分别保存在每组中
+    """
+    failed = [item for item in results if item["result"] != CompileRunStatus.ACCEPTED]
+    return {
+        "result": failed[0]["result"] if failed else CompileRunStatus.ACCEPTED,
+        "error": failed[0]["error"] if failed else 0,
+        "output": None,
+        "cpu_time": max(item["cpu_time"] for item in results),
+        "memory": max(item["memory"] for item in results),
+        "real_time": max(item["real_time"] for item in results),
+    }
+
+
+class DispatcherBase(JudgeDispatcherBase):
     @staticmethod
     def choose_compile_run_server():
-        with transaction.atomic():
-            servers = (
-                JudgeServer.objects.select_for_update()
-                .filter(is_disabled=False)
-                .order_by("task_number")
-            )
-            servers = [s for s in servers if s.status == "normal"]
-            if servers:
-                server = servers[0]
-                server.used_instance_number = F("task_number") + 1
-                server.save()
-                return server
+        return slot_allocator.acquire(JudgeLane.COMPILE_RUN)
 
     @staticmethod
-    def release_judge_server(judge_server_id):
-        with transaction.atomic():
-            # 使用原子操作, 同时因为use和release中间间隔了判题过程,需要重新查询一下
-            server = JudgeServer.objects.get(id=judge_server_id)
-            server.used_instance_number = F("task_number") - 1
-            server.save()
+    def release_judge_server(server):
+        slot_allocator.release(server)
 
 
 class CompileRunDispatcher(DispatcherBase):
-    def __init__(self, compile_run_id, problem_id):
+    def __init__(self, compile_run_id, problem_id, timer=None):
         super().__init__()
         self.compile_run = CompileRun.objects.get(id=compile_run_id)
         self.problem = Problem.objects.get(id=problem_id)
+        self.timer = timer or StageTimer(JudgeLane.COMPILE_RUN)
 
-    def do_compile_run(self):
-        server = self.choose_compile_run_server()
-        if not server:
-            data = {"compile_run_id": self.compile_run.id}
-            cache.lpush(CacheKey.waiting_queue, json.dumps(data))
-            return
-
-        language = self.compile_run.language
+    @staticmethod
+    def build_payload(compile_run, problem):
+        """
+        生成发给 judge server /compile_run 的数据, compile_run 可以是还没有保存的对象
+        """
+        language = compile_run.language
         compile_run_config = list(
             filter(lambda item: language == item["name"], languages)
         )[0]
-        code = self.compile_run.code
-        input_data = self.compile_run.input
-
-        data = {
+        return {
             "language_config": compile_run_config["config"],
-            "code": code,
-            "max_cpu_time": self.problem.time_limit,  # 3 seconds 1000 * 5
-            "max_memory": 1024 * 1024 * self.problem.memory_limit,  # 10MB? -> 128 (?)
-            "compile_run_id": self.compile_run.id,
+            "code": compile_run.code,
+            "max_cpu_time": problem.time_limit,  # 3 seconds 1000 * 5
+            "max_memory": 1024 * 1024 * problem.memory_limit,  # 10MB? -> 128 (?)
+            "compile_run_id": compile_run.id,
             "output": False,
-            "input_data": input_data,
+            "input_data": None if compile_run.results else compile_run.input,
+            # 多组输入时 judge server 只编译一次, 按顺序运行每组输入, data 中每组一个结果
+            "inputs": [item["input"] for item in compile_run.results] or None,
         }
 
-        self.compile_run.result = CompileRunStatus.JUDGING
-        resp = self._request(urljoin(server.service_url, "/compile_run"), data=data)
+    @staticmethod
+    def apply_result(compile_run, resp):
+        """
+        把 /compile_run 的返回值写到 compile_run 上, 不保存
+        :param resp: None 表示调用失败
+        """
+        if not resp:
+            compile_run.result = CompileRunStatus.SYSTEM_ERROR
+            compile_run.error_message = "Failed to call judge server"
         # 에러가 발생할 경우
-        if resp["err"]:
-            self.compile_run.result = CompileRunStatus.COMPILE_ERROR
-            self.compile_run.error = CompileRunStatus.COMPILE_ERROR
-            self.compile_run.error_message = resp["data"]
+        elif resp["err"]:
+            compile_run.result = CompileRunStatus.COMPILE_ERROR
+            compile_run.error = CompileRunStatus.COMPILE_ERROR
+            compile_run.error_message = resp["data"]
+        elif compile_run.results and len(resp["data"]) != len(compile_run.results):
+            compile_run.result = CompileRunStatus.SYSTEM_ERROR
+            compile_run.error_message = "Judge server does not support multiple inputs"
         else:
             execution_result = resp["data"][0]
-            self.compile_run.result = execution_result["result"]
-            self.compile_run.output = execution_result["output"]
-            self.compile_run.result = execution_result["result"]
-            self.compile_run.error = execution_result["error"]
-            self.compile_run.cpu_time = execution_result["cpu_time"]
-            self.compile_run.memory = execution_result["memory"]
-            self.compile_run.real_time = execution_result["real_time"]
+            if compile_run.results:
+                for item, case in zip(compile_run.results, resp["data"]):
+                    item.update({field: case[field] for field in RESULT_FIELDS})
+                execution_result = summarize_results(compile_run.results)
+            compile_run.result = execution_result["result"]
+            compile_run.output = execution_result["output"]
+            compile_run.error = execution_result["error"]
+            compile_run.cpu_time = execution_result["cpu_time"]
+            compile_run.memory = execution_result["memory"]
+            compile_run.real_time = execution_result["real_time"]
+
+    def _compile_run_each(self, server, data):
+        """
+        judge server 不支持 inputs 时每组输入单独调用一次 /compile_run, 合并成多组输入的返回格式
+        :return: 任意一组调用失败或出错（如编译错误）时返回该组的结果
+        """
+        timeout = judge_timeout(self.problem.time_limit)
+        cases = []
+        for item in self.compile_run.results:
+            resp = self._request(
+                server,
+                "/compile_run",
+                data={**data, "input_data": item["input"], "inputs": None},
+                timeout=timeout,
+            )
+            if not resp or resp["err"]:
+                return resp
+            cases.append(resp["data"][0])
+        return {"err": None, "data": cases}
+
+    def do_compile_run(self, slot=None):
+        """
+        :param slot: process_pending_task 取出任务前已经获取的名额
+        """
+        task = {"compile_run_id": self.compile_run.id, "problem_id": self.problem.id}
+        timeout = judge_timeout(self.problem.time_limit, len(self.compile_run.results))
+        start = time.perf_counter()
+        server = slot or self.choose_compile_run_server()
+        if not server:
+            compile_run_queue.push(
+                self.compile_run.id,
+                JudgeTaskClass.COMPILE_RUN,
+                self.compile_run.user_id,
+                task,
+            )
+            return
+        compile_run_queue.lease(
+            self.compile_run.id,
+            JudgeTaskClass.COMPILE_RUN,
+            self.compile_run.user_id,
+            task,
+            timeout + LEASE_GRACE_PERIOD,
+        )
+        self.timer.add(JudgeStage.ACQUIRE, time.perf_counter() - start)
+        self.timer.server = server.hostname
+
+        data = self.build_payload(self.compile_run, self.problem)
+        self.compile_run.result = CompileRunStatus.JUDGING
+        try:
+            with self.timer.measure(JudgeStage.JUDGE):
+                if data["inputs"] and not supports_multiple_inputs(server.id):
+                    resp = self._compile_run_each(server, data)
+                else:
+                    resp = self._request(
+                        server,
+                        "/compile_run",
+                        data=data,
+                        timeout=timeout,
+                    )
+        finally:
+            self.release_judge_server(server)
+        start = time.perf_counter()
+        compile_run_cache.set(compile_run_cache.key(data), resp)
+        self.apply_result(self.compile_run, resp)
         self.compile_run.save()
-        self.release_judge_server(server.id)
-
+        compile_run_queue.ack(self.compile_run.id)
+        result_notifier.publish(
+            ResultKind.COMPILE_RUN, self.compile_run.id, self.compile_run.result
+        )
+        self.timer.add(JudgeStage.SAVE, time.perf_counter() - start)
         # 큐에 남아있는 task 처리
-        process_pending_task()
+        with self.timer.measure(JudgeStage.PENDING):
+            process_pending_task()
+        self.timer.flush()
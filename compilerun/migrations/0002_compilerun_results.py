@@ -0,0 +1,18 @@
+# Generated by Django 3.2.9 on 2026-10-18 18:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compilerun', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compilerun',
+            name='results',
+            field=models.JSONField(default=list),
+        ),
+    ]
@@ -34,6 +34,9 @@ class CompileRun(models.Model):
     real_time = models.IntegerField(default=0)
 
     # info = JSONField(default=dict)
+    # 一次编译后运行多组输入时每组的结果, [{input, output, result, error, cpu_time, memory, real_time}, ...],
+    # 只有一组输入时为空, 结果保存在上面的字段中
+    results = JSONField(default=list)
     language = models.TextField()
     error_message = models.TextField(default="", blank=True)  # std_out
     # error = models.CharField(max_length=140, blank=True)
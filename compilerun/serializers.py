@@ -3,12 +3,26 @@ from utils.api import serializers
 from judge.languages import language_names
 
 
+# 一次最多运行的输入组数
+MAX_INPUTS = 20
+
+
 class CreateCompileRunSerializer(serializers.Serializer):
     code = serializers.CharField(max_length=1024 * 1024)
-    input_data = serializers.CharField(max_length=1024 * 1024, allow_blank=True)
+    input_data = serializers.CharField(max_length=1024 * 1024, allow_blank=True, required=False)
+    # 编译一次, 依次运行多组输入
+    inputs = serializers.ListField(child=serializers.CharField(max_length=1024 * 1024, allow_blank=True),
+                                   required=False, min_length=1, max_length=MAX_INPUTS)
+    # 使用题目的所有样例输入
+    use_samples = serializers.BooleanField(default=False)
     language = serializers.ChoiceField(choices=language_names)
     problem_id = serializers.IntegerField()
 
+    def validate(self, data):
+        if "input_data" not in data and not data.get("inputs") and not data["use_samples"]:
+            raise serializers.ValidationError("input_data, inputs or use_samples is required")
+        return data
+
 
 class CompileRunModelSerializer(serializers.ModelSerializer):
     class Meta:
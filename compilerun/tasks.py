@@ -1,11 +1,24 @@
 from __future__ import absolute_import, unicode_literals
 from celery import shared_task
 from compilerun.dispatcher import CompileRunDispatcher
+from judge.allocator import JudgeLane, JudgeSlot
+from judge.metrics import JudgeStage, StageTimer
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 
 @shared_task
-def compile_run_task(compile_run_id, problem_id):
-    CompileRunDispatcher(compile_run_id, problem_id).do_compile_run()
+def compile_run_task(compile_run_id, problem_id, enqueue_time=None, slot=None):
+    """
+    :param enqueue_time: 放入队列或调用 delay 的时间, 用于统计排队时间
+    :param slot: process_pending_task 已经获取的名额, JudgeSlot 的属性
+    """
+    timer = StageTimer(JudgeLane.COMPILE_RUN)
+    if enqueue_time:
+        timer.add(JudgeStage.QUEUE_WAIT, time.time() - enqueue_time)
+    with timer.measure(JudgeStage.FETCH):
+        dispatcher = CompileRunDispatcher(compile_run_id, problem_id, timer=timer)
+    dispatcher.do_compile_run(slot=JudgeSlot(**slot) if slot else None)
+    timer.flush()
@@ -1,3 +1,164 @@
-from django.test import TestCase
+from copy import deepcopy
+from unittest import mock
 
-# Create your tests here.
+from django.test import override_settings
+
+from judge.allocator import slot_allocator
+from judge.registry import judge_server_registry
+from judge.result_cache import compile_run_cache
+from judge.tests import JudgeServerTestMixin
+from problem.models import Problem
+from submission.tests import DEFAULT_PROBLEM_DATA
+from utils.api.tests import APITestCase
+from .dispatcher import CompileRunDispatcher
+from .models import CompileRun, CompileRunStatus
+
+RESP = {
+    "err": None,
+    "data": [{"result": 0, "output": "3\n", "error": 0, "cpu_time": 1, "memory": 1024, "real_time": 2}],
+}
+
+
+@mock.patch("compilerun.views.compile_run_task.delay")
+class CompileRunCacheTest(APITestCase):
+    def setUp(self):
+        user = self.create_user("test", "test123")
+        problem_data = deepcopy(DEFAULT_PROBLEM_DATA)
+        problem_data.pop("tags")
+        self.problem = Problem.objects.create(created_by=user, **problem_data)
+        self.url = self.reverse("compile_api")
+        self.data = {"code": "int main() { return 0; }", "input_data": "1 2", "language": "C", "problem_id": self.problem.id}
+        compile_run_cache.reset()
+
+    def run_code(self, **kwargs):
+        resp = self.client.post(self.url, data={**self.data, **kwargs})
+        self.assertSuccess(resp)
+        return CompileRun.objects.get(id=resp.data["data"]["compile_run_id"])
+
+    def test_cache(self, mocked_delay):
+        compile_run = self.run_code()
+        mocked_delay.assert_called_once()
+        # 模拟 judge server 返回后写入缓存
+        data = CompileRunDispatcher.build_payload(compile_run, self.problem)
+        compile_run_cache.set(compile_run_cache.key(data), RESP)
+
+        compile_run = self.run_code()
+        mocked_delay.assert_called_once()
+        self.assertEqual((compile_run.result, compile_run.output, compile_run.cpu_time), (0, "3\n", 1))
+        # 输入不同时重新运行
+        self.assertEqual(self.run_code(input_data="2 3").result, CompileRunStatus.PENDING)
+        self.assertEqual(mocked_delay.call_count, 2)
+        stats = compile_run_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+
+    def test_unstable_result(self, mocked_delay):
+        resp = deepcopy(RESP)
+        resp["data"][0]["result"] = CompileRunStatus.CPU_TIME_LIMIT_EXCEEDED
+        compile_run_cache.set("compile_run_cache:a", resp)
+        self.assertIsNone(compile_run_cache.get("compile_run_cache:a"))
+
+    @override_settings(COMPILE_RUN_CACHE_SIZE=2)
+    def test_size_bound(self, mocked_delay):
+        for key in ("a", "b", "c"):
+            compile_run_cache.set(f"compile_run_cache:{key}", RESP)
+        self.assertIsNone(compile_run_cache.get("compile_run_cache:a"))
+        self.assertEqual(compile_run_cache.get("compile_run_cache:c"), RESP)
+
+
+@mock.patch("compilerun.views.compile_run_task.delay")
+class MultiInputCompileRunTest(JudgeServerTestMixin, APITestCase):
+    def setUp(self):
+        user = self.create_user("test", "test123")
+        problem_data = deepcopy(DEFAULT_PROBLEM_DATA)
+        problem_data.pop("tags")
+        self.problem = Problem.objects.create(created_by=user, **problem_data)
+        self.url = self.reverse("compile_api")
+        self.data = {"code": "int main() { return 0; }", "language": "C", "problem_id": self.problem.id}
+        compile_run_cache.reset()
+
+    def run_code(self, **kwargs):
+        resp = self.client.post(self.url, data={**self.data, **kwargs}, format="json")
+        self.assertSuccess(resp)
+        return CompileRun.objects.get(id=resp.data["data"]["compile_run_id"])
+
+    def test_inputs(self, mocked_delay):
+        compile_run = self.run_code(inputs=["1 2", "3 4"])
+        mocked_delay.assert_called_once()
+        data = CompileRunDispatcher.build_payload(compile_run, self.problem)
+        self.assertEqual((data["inputs"], data["input_data"]), (["1 2", "3 4"], None))
+
+        resp = {"err": None, "data": [RESP["data"][0], {**RESP["data"][0], "result": CompileRunStatus.RUNTIME_ERROR,
+                                                        "error": 4, "cpu_time": 5, "output": ""}]}
+        CompileRunDispatcher.apply_result(compile_run, resp)
+        self.assertEqual((compile_run.result, compile_run.cpu_time, compile_run.output), (CompileRunStatus.RUNTIME_ERROR, 5, None))
+        self.assertEqual([item["output"] for item in compile_run.results], ["3\n", ""])
+
+        # judge server 没有按组返回结果
+        compile_run = self.run_code(inputs=["1 2", "3 4"])
+        CompileRunDispatcher.apply_result(compile_run, RESP)
+        self.assertEqual(compile_run.result, CompileRunStatus.SYSTEM_ERROR)
+
+    def test_single_input_server(self, mocked_delay):
+        server = self.create_server("server1")
+        slot_allocator.reset()
+        judge_server_registry.invalidate()
+        compile_run = self.run_code(inputs=["1 2", "3 4"])
+        outputs = iter(["3\n", "7\n"])
+        with mock.patch.object(CompileRunDispatcher, "_request",
+                               side_effect=lambda *args, **kwargs: {"err": None, "data": [{**RESP["data"][0], "output": next(outputs)}]}) as mocked_request:
+            CompileRunDispatcher(compile_run.id, self.problem.id).do_compile_run()
+        # 不支持 inputs 的 judge server 按组分别运行
+        self.assertEqual([(call.kwargs["data"]["input_data"], call.kwargs["data"]["inputs"]) for call in mocked_request.call_args_list],
+                         [("1 2", None), ("3 4", None)])
+        compile_run.refresh_from_db()
+        self.assertEqual((compile_run.result, [item["output"] for item in compile_run.results]), (CompileRunStatus.ACCEPTED, ["3\n", "7\n"]))
+
+        server.judger_version = "mock"
+        server.save()
+        judge_server_registry.invalidate()
+        compile_run = self.run_code(inputs=["1 2", "3 4"])
+        with mock.patch.object(CompileRunDispatcher, "_request", return_value={"err": None, "data": RESP["data"] * 2}) as mocked_request:
+            CompileRunDispatcher(compile_run.id, self.problem.id).do_compile_run()
+        mocked_request.assert_called_once()
+        self.assertEqual(mocked_request.call_args.kwargs["data"]["inputs"], ["1 2", "3 4"])
+
+    def test_use_samples(self, mocked_delay):
+        compile_run = self.run_code(use_samples=True)
+        self.assertEqual(compile_run.results, [{"input": "test"}])
+        self.problem.samples = []
+        self.problem.save()
+        resp = self.client.post(self.url, data={**self.data, "use_samples": True}, format="json")
+        self.assertFailed(resp, "Problem has no samples")
+
+    def test_no_input(self, mocked_delay):
+        resp = self.client.post(self.url, data=self.data, format="json")
+        self.assertFailed(resp)
+        mocked_delay.assert_not_called()
+
+
+class CompileRunWaitTest(APITestCase):
+    def setUp(self):
+        user = self.create_user("test", "test123")
+        problem_data = deepcopy(DEFAULT_PROBLEM_DATA)
+        problem_data.pop("tags")
+        problem = Problem.objects.create(created_by=user, **problem_data)
+        self.compile_run = CompileRun.objects.create(user=user, language="C", code="", input="", problem=problem)
+        self.url = self.reverse("compile_run_wait_api")
+
+    def test_wait(self):
+        resp = self.client.get(self.url, data={"id": self.compile_run.id, "timeout": 0.1})
+        self.assertSuccess(resp)
+        self.assertEqual((resp.data["data"]["finished"], resp.data["data"]["result"]), (False, None))
+
+        CompileRun.objects.filter(id=self.compile_run.id).update(result=CompileRunStatus.ACCEPTED)
+        resp = self.client.get(self.url, data={"id": self.compile_run.id})
+        self.assertEqual((resp.data["data"]["finished"], resp.data["data"]["result"]), (True, CompileRunStatus.ACCEPTED))
+
+    def test_method_not_allowed(self):
+        self.assertEqual(self.client.post(self.url, data={"id": self.compile_run.id}).status_code, 405)
+
+    def test_permission(self):
+        self.create_user("other", "test123")
+        self.assertFailed(self.client.get(self.url, data={"id": self.compile_run.id}), "No permission for this compile run")
+        self.client.logout()
+        self.assertFailed(self.client.get(self.url, data={"id": self.compile_run.id}), "Please login first")
@@ -1,6 +1,7 @@
 from django.conf.urls import url
-from compilerun.views import CompileAPI
+from compilerun.views import CompileAPI, CompileRunWaitAPI
 
 urlpatterns = [
     url(r"^compile_run/?$", CompileAPI.as_view(), name="compile_api"),
+    url(r"^compile_run_wait/?$", CompileRunWaitAPI, name="compile_run_wait_api"),
 ]
@@ -5,11 +5,14 @@ from rest_framework import status
 
 from account.decorators import login_required
 from options.options import SysOptions
-from compilerun.models import CompileRun
+from compilerun.dispatcher import CompileRunDispatcher
+from compilerun.models import CompileRun, CompileRunStatus
 from compilerun.tasks import compile_run_task
-from compilerun.serializers import CreateCompileRunSerializer, CompileRunModelSerializer
+from compilerun.serializers import MAX_INPUTS, CreateCompileRunSerializer, CompileRunModelSerializer
+from judge.notifier import ResultKind, wait_result_view
+from judge.result_cache import compile_run_cache
 from problem.models import Problem
-from utils.api import APIView, validate_serializer
+from utils.api import APIError, APIView, validate_serializer
 from utils.throttling import TokenBucket
 from utils.cache import cache
 
@@ -36,14 +39,29 @@ class CompileAPI(APIView):
             message = "code: This field may not be blank."
             return Response({"message": message}, status=status.HTTP_400_BAD_REQUEST)
 
-        compile_run = CompileRun.objects.create(
+        # 多组输入时只编译一次, 每组的结果保存在 results 中
+        inputs = data.get("inputs")
+        if data.get("use_samples"):
+            inputs = [sample["input"] for sample in problem.samples][:MAX_INPUTS]
+            if not inputs:
+                return self.error("Problem has no samples")
+        compile_run = CompileRun(
             user=request.user,
             language=data["language"],
             code=data["code"],
-            input=input_data,
+            input=None if inputs else input_data,
+            results=[{"input": item} for item in inputs] if inputs else [],
             problem=problem,
         )
-        compile_run_task.delay(compile_run.id, problem_id)
+        # 重复运行相同的代码和输入时直接使用之前的结果, 不经过 judge server
+        resp = compile_run_cache.get(
+            compile_run_cache.key(CompileRunDispatcher.build_payload(compile_run, problem))
+        )
+        if resp:
+            CompileRunDispatcher.apply_result(compile_run, resp)
+        compile_run.save()
+        if not resp:
+            compile_run_task.delay(compile_run.id, problem_id, enqueue_time=time.time())
         return self.success({"compile_run_id": compile_run.id})
 
     @login_required
@@ -61,3 +79,24 @@ class CompileAPI(APIView):
 
         data = CompileRunModelSerializer(compile_run).data
         return self.success({"data": data})
+
+
+def load_compile_run_result(request, compile_run_id):
+    """
+    CompileRunWaitAPI 使用, 运行没有结束时返回 None
+    """
+    if not request.user.is_authenticated:
+        raise APIError("Please login first", err="permission-denied")
+    try:
+        compile_run = CompileRun.objects.get(id=compile_run_id)
+    except (CompileRun.DoesNotExist, ValueError):
+        raise APIError("CompileRun doesn't exist")
+    if not compile_run.check_user_permission(request.user):
+        raise APIError("No permission for this compile run")
+    if compile_run.result in (CompileRunStatus.PENDING, CompileRunStatus.JUDGING):
+        return None
+    return compile_run.result
+
+
+# 长轮询等待运行结束, 结束后再调用 CompileAPI.get 获取输出
+CompileRunWaitAPI = wait_result_view(ResultKind.COMPILE_RUN, load_compile_run_result)
@@ -1,6 +1,9 @@
 from django.db import models
 from django.utils import timezone
 
+# 增加一秒延时，提高对网络环境的适应性
+HEARTBEAT_TIMEOUT = 6
+
 
 class JudgeServer(models.Model):
     hostname = models.TextField()
@@ -17,8 +20,7 @@ class JudgeServer(models.Model):
 
     @property
     def status(self):
-        # 增加一秒延时，提高对网络环境的适应性
-        if (timezone.now() - self.last_heartbeat).total_seconds() > 6:
+        if (timezone.now() - self.last_heartbeat).total_seconds() > HEARTBEAT_TIMEOUT:
             return "abnormal"
         return "normal"
 
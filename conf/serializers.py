@@ -46,6 +46,12 @@ class JudgeServerHeartbeatSerializer(serializers.Serializer):
     service_url = serializers.CharField(max_length=256)
 
 
+class JudgeServerCallbackSerializer(serializers.Serializer):
+    submission_id = serializers.CharField(max_length=32)
+    # judge server /judge 的返回值, null 表示判题失败
+    result = serializers.DictField(allow_null=True)
+
+
 class EditJudgeServerSerializer(serializers.Serializer):
     id = serializers.IntegerField()
     is_disabled = serializers.BooleanField()
@@ -4,6 +4,10 @@ from unittest import mock
 from django.conf import settings
 from django.utils import timezone
 
+from judge.admission import judge_admission
+from judge.heartbeat import heartbeat_store
+from judge.metrics import judge_metrics
+from judge.mock_server import MockHeartbeatClient, start_mock_server
 from options.options import SysOptions
 from utils.api.tests import APITestCase
 from .models import JudgeServer
@@ -89,6 +93,7 @@ class JudgeServerHeartbeatTest(APITestCase):
         self.hashed_token = hashlib.sha256(self.token.encode("utf-8")).hexdigest()
         SysOptions.judge_server_token = self.token
         self.headers = {"HTTP_X_JUDGE_SERVER_TOKEN": self.hashed_token, settings.IP_HEADER: "1.2.3.4"}
+        heartbeat_store.remove(self.data["hostname"])
 
     def test_new_heartbeat(self):
         resp = self.client.post(self.url, data=self.data, **self.headers)
@@ -96,6 +101,17 @@ class JudgeServerHeartbeatTest(APITestCase):
         server = JudgeServer.objects.first()
         self.assertEqual(server.ip, "127.0.0.1")
 
+    def test_mock_heartbeat_client(self):
+        server = start_mock_server(work=0, cpu_core=2)
+        try:
+            client = MockHeartbeatClient(server, "http://testserver", self.token, hostname=self.data["hostname"])
+            resp = self.client.post(self.url, data=client.data(), HTTP_X_JUDGE_SERVER_TOKEN=client.token)
+            self.assertSuccess(resp)
+            self.assertEqual(JudgeServer.objects.get(hostname=self.data["hostname"]).service_url, server.url)
+        finally:
+            server.shutdown()
+            server.server_close()
+
     def test_update_heartbeat(self):
         self.test_new_heartbeat()
         data = self.data
@@ -104,6 +120,21 @@ class JudgeServerHeartbeatTest(APITestCase):
         self.assertSuccess(resp)
         self.assertEqual(JudgeServer.objects.get(hostname=self.data["hostname"]).judger_version, data["judger_version"])
 
+    def test_heartbeat_is_cached(self):
+        self.test_new_heartbeat()
+        data = self.data
+        data["cpu"] = 10
+        with mock.patch("judge.heartbeat.JudgeServer.objects.update_or_create") as mocked_update:
+            resp = self.client.post(self.url, data=data, **self.headers)
+            mocked_update.assert_not_called()
+        self.assertSuccess(resp)
+        server = JudgeServer.objects.get(hostname=self.data["hostname"])
+        self.assertEqual(server.cpu_usage, 90.5)
+        self.assertEqual(heartbeat_store.apply([server])[0].cpu_usage, 10)
+
+        self.assertEqual(heartbeat_store.flush(), 1)
+        self.assertEqual(JudgeServer.objects.get(id=server.id).cpu_usage, 10)
+
 
 class JudgeServerAPITest(APITestCase):
     def setUp(self):
@@ -117,6 +148,9 @@ class JudgeServerAPITest(APITestCase):
         resp = self.client.get(self.url)
         self.assertSuccess(resp)
         self.assertEqual(len(resp.data["data"]["servers"]), 1)
+        self.assertIn("stats", resp.data["data"]["servers"][0])
+        self.assertEqual(resp.data["data"]["servers"][0]["breaker"]["state"], "closed")
+        self.assertIn("judge", resp.data["data"]["queue"])
 
     def test_delete_judge_server(self):
         resp = self.client.delete(self.url + "?hostname=testhostname")
@@ -135,6 +169,33 @@ class LanguageListAPITest(APITestCase):
         self.assertSuccess(resp)
 
 
+class JudgeStatusAPITest(APITestCase):
+    def test_get_judge_status(self):
+        judge_admission.invalidate()
+        resp = self.client.get(self.reverse("judge_status_api"))
+        self.assertSuccess(resp)
+        self.assertTrue(resp.data["data"]["accepting"])
+
+
+class JudgeMetricsAPITest(APITestCase):
+    def setUp(self):
+        self.create_super_admin()
+        self.url = self.reverse("judge_metrics_api")
+        judge_metrics.clear()
+        judge_metrics.observe_many("judge", "server1", [("judge", 0.5), ("save", 0.01)])
+
+    def test_get_metrics(self):
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp["Content-Type"].startswith("text/plain"))
+        self.assertIn('stage="save",server="server1",quantile="0.5"', resp.content.decode("utf-8"))
+
+    def test_get_metrics_json(self):
+        resp = self.client.get(self.url, data={"format": "json", "window": 60})
+        self.assertSuccess(resp)
+        self.assertEqual([item["stage"] for item in resp.data["data"]], ["judge", "save"])
+
+
 class TestCasePruneAPITest(APITestCase):
     def setUp(self):
         self.url = self.reverse("prune_test_case_api")
@@ -10,13 +10,24 @@ from datetime import datetime
 import pytz
 import requests
 from django.conf import settings
+from django.http import HttpResponse
 from django.utils import timezone
 from requests.exceptions import RequestException
 
 from account.decorators import super_admin_required
 from account.models import User
 from contest.models import Contest
-from judge.dispatcher import process_pending_task
+from judge.admission import judge_admission
+from judge.allocator import slot_allocator
+from judge.breaker import circuit_breaker
+from judge.client import get_client_stats
+from compilerun.dispatcher import process_pending_task as process_pending_compile_run_task
+from judge.dispatcher import handle_judge_callback, process_pending_task
+from judge.heartbeat import heartbeat_store
+from judge.metrics import DEFAULT_WINDOW, RETENTION, judge_metrics
+from judge.registry import judge_server_registry
+from judge.result_cache import compile_run_cache, result_cache
+from judge.scheduler import queue_depth
 from options.options import SysOptions
 from problem.models import Problem
 from submission.models import Submission
@@ -26,7 +37,7 @@ from utils.xss_filter import XSSHtml
 from .models import JudgeServer
 from .serializers import (CreateEditWebsiteConfigSerializer,
                           CreateSMTPConfigSerializer, EditSMTPConfigSerializer,
-                          JudgeServerHeartbeatSerializer,
+                          JudgeServerCallbackSerializer, JudgeServerHeartbeatSerializer,
                           JudgeServerSerializer, TestSMTPConfigSerializer, EditJudgeServerSerializer)
 
 
@@ -108,15 +119,25 @@ class WebsiteConfigAPI(APIView):
 class JudgeServerAPI(APIView):
     @super_admin_required
     def get(self, request):
-        servers = JudgeServer.objects.all().order_by("-last_heartbeat")
+        servers = heartbeat_store.apply(JudgeServer.objects.all())
+        servers.sort(key=lambda server: server.last_heartbeat, reverse=True)
+        servers = JudgeServerSerializer(servers, many=True).data
+        for server in servers:
+            server["stats"] = get_client_stats(server["service_url"])
+            server["breaker"] = circuit_breaker.status(server["id"])
         return self.success({"token": SysOptions.judge_server_token,
-                             "servers": JudgeServerSerializer(servers, many=True).data})
+                             "servers": servers,
+                             "queue": queue_depth(),
+                             "result_cache": result_cache.stats(),
+                             "compile_run_cache": compile_run_cache.stats()})
 
     @super_admin_required
     def delete(self, request):
         hostname = request.GET.get("hostname")
         if hostname:
             JudgeServer.objects.filter(hostname=hostname).delete()
+            heartbeat_store.remove(hostname)
+            slot_allocator.refresh(force=True)
         return self.success()
 
     @validate_serializer(EditJudgeServerSerializer)
@@ -124,42 +145,65 @@ class JudgeServerAPI(APIView):
     def put(self, request):
         is_disabled = request.data.get("is_disabled", False)
         JudgeServer.objects.filter(id=request.data["id"]).update(is_disabled=is_disabled)
+        slot_allocator.refresh(force=True)
         if not is_disabled:
             process_pending_task()
+            process_pending_compile_run_task()
         return self.success()
 
 
+class JudgeMetricsAPI(APIView):
+    @super_admin_required
+    def get(self, request):
+        """
+        判题各阶段耗时的 p50/p95/p99, 以 Prometheus 文本格式返回, 传入 format=json 时返回 json
+        window: 统计最近多少秒, 最多保留 RETENTION 秒
+        """
+        try:
+            window = min(int(request.GET.get("window", DEFAULT_WINDOW)), RETENTION)
+        except ValueError:
+            return self.error("Invalid window")
+        if request.GET.get("format") == "json":
+            return self.success(judge_metrics.summary(window))
+        return HttpResponse(judge_metrics.exposition(window), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def judge_server_token_matches(client_token):
+    return hashlib.sha256(SysOptions.judge_server_token.encode("utf-8")).hexdigest() == client_token
+
+
+def judge_server_token_valid(request):
+    return judge_server_token_matches(request.META.get("HTTP_X_JUDGE_SERVER_TOKEN"))
+
+
 class JudgeServerHeartbeatAPI(CSRFExemptAPIView):
     @validate_serializer(JudgeServerHeartbeatSerializer)
     def post(self, request):
         data = request.data
-        client_token = request.META.get("HTTP_X_JUDGE_SERVER_TOKEN")
-        if hashlib.sha256(SysOptions.judge_server_token.encode("utf-8")).hexdigest() != client_token:
+        if not judge_server_token_valid(request):
             return self.error("Invalid token")
 
-        try:
-            server = JudgeServer.objects.get(hostname=data["hostname"])
-            server.judger_version = data["judger_version"]
-            server.cpu_core = data["cpu_core"]
-            server.memory_usage = data["memory"]
-            server.cpu_usage = data["cpu"]
-            server.service_url = data["service_url"]
-            server.ip = request.ip
-            server.last_heartbeat = timezone.now()
-            server.save(update_fields=["judger_version", "cpu_core", "memory_usage", "service_url", "ip", "last_heartbeat"])
-        except JudgeServer.DoesNotExist:
-            JudgeServer.objects.create(hostname=data["hostname"],
-                                       judger_version=data["judger_version"],
-                                       cpu_core=data["cpu_core"],
-                                       memory_usage=data["memory"],
-                                       cpu_usage=data["cpu"],
-                                       ip=request.META["REMOTE_ADDR"],
-                                       service_url=data["service_url"],
-                                       last_heartbeat=timezone.now(),
-                                       )
-        # 新server上线 处理队列中的，防止没有新的提交而导致一直waiting
-        process_pending_task()
+        _, online = heartbeat_store.beat(data["hostname"], {"judger_version": data["judger_version"],
+                                                            "cpu_core": data["cpu_core"],
+                                                            "service_url": data["service_url"],
+                                                            "cpu_usage": data["cpu"],
+                                                            "memory_usage": data["memory"]}, request.ip, request.META["REMOTE_ADDR"])
+        # 新server上线或恢复心跳时 处理队列中的，防止没有新的提交而导致一直waiting
+        if online:
+            slot_allocator.refresh(force=True)
+            process_pending_task()
+            process_pending_compile_run_task()
+
+        return self.success()
 
+
+class JudgeServerCallbackAPI(CSRFExemptAPIView):
+    @validate_serializer(JudgeServerCallbackSerializer)
+    def post(self, request):
+        if not judge_server_token_valid(request):
+            return self.error("Invalid token")
+        if not handle_judge_callback(request.data["submission_id"], request.data["result"]):
+            return self.error("Judge task does not exist or has finished")
         return self.success()
 
 
@@ -168,6 +212,18 @@ class LanguagesAPI(APIView):
         return self.success({"languages": SysOptions.languages, "spj_languages": SysOptions.spj_languages})
 
 
+class JudgeStatusAPI(APIView):
+    def get(self, request):
+        """
+        判题队列的长度和预计等待时间, accepting 为 False 时非比赛提交会被拒绝
+        """
+        status = judge_admission.status()
+        return self.success({"depth": status["depth"],
+                             "estimated_wait": status["estimated_wait"],
+                             "accepting": not status["retry_after"],
+                             "retry_after": status["retry_after"]})
+
+
 class TestCasePruneAPI(APIView):
     @super_admin_required
     def get(self, request):
@@ -228,7 +284,7 @@ class DashboardInfoAPI(APIView):
         today_submission_count = Submission.objects.filter(
             create_time__gte=datetime(today.year, today.month, today.day, 0, 0, tzinfo=pytz.UTC)).count()
         recent_contest_count = Contest.objects.exclude(end_time__lt=timezone.now()).count()
-        judge_server_count = len(list(filter(lambda x: x.status == "normal", JudgeServer.objects.all())))
+        judge_server_count = len(judge_server_registry.active())
         return self.success({
             "user_count": User.objects.count(),
             "recent_contest_count": recent_contest_count,
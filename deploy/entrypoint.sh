@@ -47,6 +47,20 @@ if [ -z "$MAX_WORKER_NUM" ]; then
     fi
 fi
 
+# judge_callback_proxy 只在 callback 和 batch 模式下使用, JUDGE_CALLBACK_PROXY_URL 设为空时直接请求 judge server
+if [ "$JUDGE_DISPATCH_MODE" = "callback" -o "$JUDGE_DISPATCH_MODE" = "batch" ] && [ "${JUDGE_CALLBACK_PROXY_URL-default}" != "" ]; then
+    export JUDGE_CALLBACK_PROXY_AUTOSTART=true
+else
+    export JUDGE_CALLBACK_PROXY_AUTOSTART=false
+fi
+
+# async 和 batch 模式下 celery 不再处理判题队列, 由 judge_async_worker 消费
+if [ "$JUDGE_DISPATCH_MODE" = "async" -o "$JUDGE_DISPATCH_MODE" = "batch" ]; then
+    export JUDGE_ASYNC_WORKER_AUTOSTART=true
+else
+    export JUDGE_ASYNC_WORKER_AUTOSTART=false
+fi
+
 cd $APP/dist
 if [ ! -z "$STATIC_CDN_HOST" ]; then
     find . -name "*.*" -type f -exec sed -i "s/__STATIC_CDN_HOST__/\/$STATIC_CDN_HOST/g" {} \;
@@ -62,7 +76,7 @@ do
     python manage.py migrate --no-input &&
     python manage.py inituser --username=root --password=rootroot --action=create_super_admin &&
     echo "from options.options import SysOptions; SysOptions.judge_server_token='$JUDGE_SERVER_TOKEN'" | python manage.py shell &&
-    echo "from conf.models import JudgeServer; JudgeServer.objects.update(task_number=0)" | python manage.py shell &&
+    echo "from judge.allocator import slot_allocator; slot_allocator.reset()" | python manage.py shell &&
     break
     n=$(($n+1))
     echo "Failed to migrate, going to retry..."
@@ -0,0 +1,91 @@
+import math
+import threading
+import time
+
+from django.conf import settings
+
+from judge.allocator import slot_allocator
+from judge.scheduler import JudgeTaskClass, judge_queue
+
+# 还没有判题耗时数据时假设的每个提交的耗时（秒）
+DEFAULT_LATENCY = 2
+# 进程内缓存队列状态的时间（秒）
+STATUS_TTL = 1
+
+
+class JudgeAdmission:
+    """
+    判题队列的准入控制。排队的提交数或预计等待时间超过 settings.JUDGE_ADMISSION_MAX_DEPTH 或
+    settings.JUDGE_ADMISSION_MAX_WAIT 时不再接受新的提交, 让用户稍后重试, 防止故障期间队列无限增长。
+
+    预计等待时间 = 排在前面的提交数 * 平均判题耗时 / 所有服务器的并发上限之和, rejudge 排在最后, 不计算在内
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._status = None
+        self._loaded_at = 0
+
+    def status(self):
+        """
+        :return: {"depth": 排队的提交数, "capacity": 并发上限之和, "estimated_wait": 预计等待秒数,
+                  没有可用的服务器时为 None, "retry_after": 需要等待多久才能提交, 可以提交时为 None}
+        """
+        with self._lock:
+            if self._status and time.monotonic() - self._loaded_at < STATUS_TTL:
+                return self._status
+        depth = judge_queue.depth()
+        waiting = depth[JudgeTaskClass.CONTEST] + depth[JudgeTaskClass.PRACTICE]
+        servers = [state for state, _, _ in slot_allocator.snapshot()]
+        capacity = sum(state.capacity for state in servers)
+        latencies = [state.latency for state in servers if state.latency]
+        latency = sum(latencies) / len(latencies) if latencies else DEFAULT_LATENCY
+        estimated_wait = waiting * latency / capacity if capacity else None
+        status = {
+            "depth": waiting,
+            "capacity": capacity,
+            "estimated_wait": round(estimated_wait, 1)
+            if estimated_wait is not None
+            else None,
+            "retry_after": self._retry_after(waiting, capacity, latency),
+        }
+        with self._lock:
+            self._status = status
+            self._loaded_at = time.monotonic()
+        return status
+
+    @staticmethod
+    def _retry_after(waiting, capacity, latency):
+        max_depth = settings.JUDGE_ADMISSION_MAX_DEPTH
+        max_wait = settings.JUDGE_ADMISSION_MAX_WAIT
+        excess = 0
+        if max_depth and waiting >= max_depth:
+            excess = (waiting - max_depth + 1) * latency / max(capacity, 1)
+        if max_wait and waiting:
+            if not capacity:
+                # 没有可用的服务器, 无法估计
+                excess = max(excess, max_wait)
+            elif waiting * latency / capacity >= max_wait:
+                excess = max(excess, waiting * latency / capacity - max_wait)
+        return max(math.ceil(excess), 1) if excess else None
+
+    def check(self, contest_id=None):
+        """
+        :param contest_id: 比赛中的提交不受限制
+        :return: 需要等待的秒数, 可以提交时返回 None
+        """
+        if contest_id:
+            return None
+        if (
+            not settings.JUDGE_ADMISSION_MAX_DEPTH
+            and not settings.JUDGE_ADMISSION_MAX_WAIT
+        ):
+            return None
+        return self.status()["retry_after"]
+
+    def invalidate(self):
+        with self._lock:
+            self._status = None
+
+
+judge_admission = JudgeAdmission()
@@ -0,0 +1,412 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from conf.models import JudgeServer
+from judge.breaker import CircuitState, circuit_breaker
+from judge.policies import (
+    MIN_LIMIT,
+    ServerState,
+    adjust_limit,
+    get_policy,
+    initial_limit,
+    max_limit,
+)
+from judge.registry import REGISTRY_TTL, judge_server_registry
+from submission.models import JudgeStatus
+from utils.cache import cache
+from utils.constants import CacheKey
+
+logger = logging.getLogger(__name__)
+
+# 租约默认有效期（秒），进程崩溃后未释放的名额会在到期后自动回收
+DEFAULT_LEASE_TIMEOUT = 600
+# 两次数据库对账之间的最小间隔（秒）
+RECONCILE_INTERVAL = 5
+# 进程内缓存 snapshot 的时间（秒）, 与服务器列表的缓存一致。
+# 缓存只用于给候选服务器排序, 名额是否足够以 ACQUIRE_SCRIPT 为准
+SNAPSHOT_TTL = REGISTRY_TTL
+
+
+class JudgeLane:
+    JUDGE = "judge"
+    COMPILE_RUN = "compile_run"
+
+
+# 每个通道在单台服务器上最多能占用的名额比例。两者之和大于 1, 空闲时可以互相借用,
+# 满载时判题至少保留一半名额, 运行自定义输入至少保留 20%
+LANE_BUDGET = {JudgeLane.JUDGE: 0.8, JudgeLane.COMPILE_RUN: 0.5}
+
+# 按给定的顺序依次尝试候选服务器, 在第一台总名额和通道名额都未满的服务器上登记一个租约
+# KEYS[1]: 服务器并发上限 hash {server_id: limit}
+# ARGV[1]: 当前时间戳  ARGV[2]: 租约到期时间戳  ARGV[3]: 租约 id  ARGV[4]: 租约 key 前缀
+# ARGV[5]: 通道  ARGV[6]: 通道预算比例  ARGV[7...]: 按优先顺序排列的候选 server_id
+ACQUIRE_SCRIPT = """
+for i = 7, #ARGV do
+    local limit = redis.call("HGET", KEYS[1], ARGV[i])
+    if limit then
+        local key = ARGV[4] .. ARGV[i]
+        local lane_key = key .. ":" .. ARGV[5]
+        redis.call("ZREMRANGEBYSCORE", key, "-inf", ARGV[1])
+        redis.call("ZREMRANGEBYSCORE", lane_key, "-inf", ARGV[1])
+        local capacity = math.max(math.floor(tonumber(limit)), 1)
+        local lane_capacity = math.max(math.floor(capacity * tonumber(ARGV[6])), 1)
+        if redis.call("ZCARD", key) < capacity and redis.call("ZCARD", lane_key) < lane_capacity then
+            redis.call("ZADD", key, ARGV[2], ARGV[3])
+            redis.call("ZADD", lane_key, ARGV[2], ARGV[3])
+            return ARGV[i]
+        end
+    end
+end
+return false
+"""
+
+
+# 判题结果中表示超时的 result
+TIME_LIMIT_RESULTS = (
+    JudgeStatus.CPU_TIME_LIMIT_EXCEEDED,
+    JudgeStatus.REAL_TIME_LIMIT_EXCEEDED,
+)
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _finished(resp):
+    # 返回了判题结果, 编译错误也是正常的结果
+    return bool(resp) and resp.get("err") in (None, "CompileError")
+
+
+def time_limit_exceeded(resp):
+    """
+    :param resp: judge server 的返回值, 即 Submission.info
+    """
+    if not resp or resp.get("err") or not isinstance(resp.get("data"), list):
+        return False
+    return any(
+        isinstance(item, dict) and item.get("result") in TIME_LIMIT_RESULTS
+        for item in resp["data"]
+    )
+
+
+class JudgeSlot:
+    """
+    一个判题名额，__exit__ 或 release 之后失效
+    """
+
+    def __init__(self, id, hostname, service_url, lease_id, lane=JudgeLane.JUDGE):
+        self.id = id
+        self.hostname = hostname
+        self.service_url = service_url
+        self.lease_id = lease_id
+        self.lane = lane
+
+    def __repr__(self):
+        return f"<JudgeSlot {self.hostname} {self.lease_id}>"
+
+
+class JudgeSlotAllocator:
+    """
+    基于 redis 的判题名额分配，获取和释放都是单次原子操作，不再对 judge_server 表加行锁。
+    数据库只在对账时读取：同步可用服务器的信息，并把当前租约数写回 task_number 供后台展示。
+
+    每台服务器的并发上限不再固定为 cpu_core * 2, 而是根据判题请求的结果用 AIMD 动态调整,
+    具体挑选哪一台由 judge.policies 中的策略决定。
+
+    选择服务器用的状态在进程内缓存, 每次获取名额只需要执行一次 ACQUIRE_SCRIPT, 不随服务器数量增加。
+    """
+
+    def __init__(self):
+        self._acquire_script = None
+        self._lock = threading.Lock()
+        # {lane: (过期时间, [[ServerState, 剩余名额, 是否只能发送试探请求], ...])}
+        self._snapshots = {}
+
+    @staticmethod
+    def _lease_key(server_id, lane=None):
+        if lane:
+            return f"{CacheKey.judge_slot_leases}:{server_id}:{lane}"
+        return f"{CacheKey.judge_slot_leases}:{server_id}"
+
+    def _release_lease(self, server_id, lease_id, lane):
+        pipe = cache.pipeline()
+        pipe.zrem(self._lease_key(server_id), lease_id)
+        pipe.zrem(self._lease_key(server_id, lane), lease_id)
+        pipe.execute()
+
+    def snapshot(self, lane=JudgeLane.JUDGE):
+        """
+        所有可用服务器的实时状态, 熔断器断开的服务器没有剩余名额, 可以试探的服务器最多一个名额
+        :return: [(ServerState, 该通道剩余名额, 是否只能发送试探请求), ...]
+        """
+        pipe = cache.pipeline(transaction=False)
+        pipe.hgetall(CacheKey.judge_slot_capacity)
+        pipe.hgetall(CacheKey.judge_slot_servers)
+        pipe.hgetall(CacheKey.judge_slot_latency)
+        limits, servers, latencies = pipe.execute()
+        limits = {_decode(k): float(v) for k, v in limits.items()}
+        servers = {_decode(k): json.loads(_decode(v)) for k, v in servers.items()}
+        latencies = {_decode(k): float(v) for k, v in latencies.items()}
+
+        # 对账之后才停止心跳或被禁用的服务器
+        active_ids = judge_server_registry.active_ids()
+        server_ids = [
+            server_id
+            for server_id in limits
+            if server_id in servers and int(server_id) in active_ids
+        ]
+        now = time.time()
+        pipe = cache.pipeline(transaction=False)
+        for server_id in server_ids:
+            pipe.zcount(self._lease_key(server_id), now, "+inf")
+            pipe.zcount(self._lease_key(server_id, lane), now, "+inf")
+        used = pipe.execute()
+        breaker_states, probes = circuit_breaker.states(server_ids)
+
+        result = []
+        for i, server_id in enumerate(server_ids):
+            capacity = max(int(limits[server_id]), 1)
+            lane_capacity = max(int(capacity * LANE_BUDGET[lane]), 1)
+            info = servers[server_id]
+            state = ServerState(
+                int(server_id),
+                capacity,
+                used[i * 2],
+                info["cpu_core"],
+                cpu_usage=info["cpu_usage"],
+                memory_usage=info["memory_usage"],
+                latency=latencies.get(server_id, 0),
+            )
+            free = max(min(capacity - used[i * 2], lane_capacity - used[i * 2 + 1]), 0)
+            probe = server_id in probes
+            if probe:
+                free = min(free, 1)
+            elif breaker_states[server_id] != CircuitState.CLOSED:
+                free = 0
+            result.append((state, free, probe))
+        return result
+
+    def cached_snapshot(self, lane=JudgeLane.JUDGE, force=False):
+        """
+        在进程内缓存 SNAPSHOT_TTL 秒的 snapshot, 获取和释放名额时不必每次读取所有服务器的状态
+        """
+        with self._lock:
+            expires_at, items = self._snapshots.get(lane, (0, None))
+            if not force and items is not None and time.monotonic() < expires_at:
+                return items
+        items = [list(item) for item in self.snapshot(lane)]
+        with self._lock:
+            self._snapshots[lane] = (time.monotonic() + SNAPSHOT_TTL, items)
+        return items
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshots = {}
+
+    def _update_cached(self, server_id, lane, delta):
+        """
+        本进程获取或释放名额后同步更新缓存中的数量, 其他进程的变化在缓存过期后才能看到
+        """
+        with self._lock:
+            for cached_lane, (_, items) in self._snapshots.items():
+                for item in items:
+                    state = item[0]
+                    if state.id != server_id:
+                        continue
+                    state.used = max(state.used + delta, 0)
+                    if cached_lane == lane:
+                        item[1] = max(item[1] - delta, 0)
+                    # 其他通道只受总名额的限制
+                    item[1] = min(item[1], max(state.capacity - state.used, 0))
+
+    def acquire(
+        self,
+        lane=JudgeLane.JUDGE,
+        timeout=DEFAULT_LEASE_TIMEOUT,
+        policy=None,
+        key=None,
+        exclude=None,
+    ):
+        """
+        :param policy: judge.policies 中的策略名, 默认使用 settings.JUDGE_SELECTION_POLICY
+        :param key: 亲和键, 见 judge.policies.AffinityPolicy
+        :param exclude: 尽量避开的 server_id, 没有其他服务器可用时仍然会选择
+        """
+        self.refresh()
+        policy = get_policy(policy or settings.JUDGE_SELECTION_POLICY)
+        snapshot = [item for item in self.cached_snapshot(lane) if item[1] > 0]
+        if not snapshot:
+            # 缓存中没有剩余名额时重新读取一次, 其他进程释放的或过期的租约可能已经空出名额
+            snapshot = [
+                item for item in self.cached_snapshot(lane, force=True) if item[1] > 0
+            ]
+        if exclude:
+            snapshot = [
+                item for item in snapshot if item[0].id not in exclude
+            ] or snapshot
+        candidates = policy.order(
+            [state for state, _, probe in snapshot if not probe], key=key
+        )
+        # 熔断器到了试探时间的服务器, 抢到试探机会的请求优先发给它
+        for state, _, probe in snapshot:
+            if probe and circuit_breaker.try_probe(state.id):
+                candidates.insert(0, state)
+                break
+        if not candidates:
+            return None
+        if self._acquire_script is None:
+            self._acquire_script = cache.register_script(ACQUIRE_SCRIPT)
+        now = time.time()
+        lease_id = uuid.uuid4().hex
+        server_id = self._acquire_script(
+            keys=[CacheKey.judge_slot_capacity],
+            args=[
+                now,
+                now + timeout,
+                lease_id,
+                f"{CacheKey.judge_slot_leases}:",
+                lane,
+                LANE_BUDGET[lane],
+                *[state.id for state in candidates],
+            ],
+        )
+        if not server_id:
+            # 缓存中的剩余名额已经过时
+            self.invalidate()
+            return None
+        server_id = _decode(server_id)
+        self._update_cached(int(server_id), lane, 1)
+        info = cache.hget(CacheKey.judge_slot_servers, server_id)
+        if not info:
+            # 对账过程中服务器被移除了
+            self._release_lease(server_id, lease_id, lane)
+            self.invalidate()
+            return None
+        info = json.loads(_decode(info))
+        return JudgeSlot(
+            int(server_id), info["hostname"], info["service_url"], lease_id, lane
+        )
+
+    def available(self, lane=JudgeLane.JUDGE):
+        """
+        所有可用服务器上该通道剩余名额的总数, 来自进程内缓存, 最多滞后 SNAPSHOT_TTL 秒
+        """
+        return sum(free for _, free, _ in self.cached_snapshot(lane))
+
+    def release(self, slot):
+        self._release_lease(slot.id, slot.lease_id, slot.lane)
+        self._update_cached(slot.id, slot.lane, -1)
+
+    def report(self, slot, cost, ok=True, timeout=None, resp=None):
+        """
+        根据一次判题请求的结果调整该服务器的并发上限、延迟统计和熔断器
+        :param cost: 请求耗时, 秒
+        :param ok: 请求是否成功
+        :param timeout: 请求的超时时间, 用于判断是否过慢
+        :param resp: judge server 的返回值, 超时的测试点作为可能过载的信号
+        """
+        state = circuit_breaker.record(
+            slot.id, ok, cost=cost, timeout=timeout, finished=_finished(resp)
+        )
+        with self._lock:
+            probing = any(
+                item[2] and item[0].id == slot.id
+                for _, items in self._snapshots.values()
+                for item in items
+            )
+        if state != CircuitState.CLOSED or probing:
+            # 熔断器状态不在 ACQUIRE_SCRIPT 中检查, 断开或恢复时不能等缓存过期
+            self.invalidate()
+        server_id = str(slot.id)
+        pipe = cache.pipeline(transaction=False)
+        pipe.hget(CacheKey.judge_slot_servers, server_id)
+        pipe.hget(CacheKey.judge_slot_capacity, server_id)
+        pipe.hget(CacheKey.judge_slot_latency, server_id)
+        info, limit, latency = pipe.execute()
+        if not info or not limit:
+            return
+        info = json.loads(_decode(info))
+        # 并发更新时可能丢失个别样本, 对于估算来说可以接受
+        limit, latency = adjust_limit(
+            float(limit),
+            float(latency or 0),
+            cost,
+            ok,
+            info["cpu_core"],
+            timeout=timeout,
+            cpu_usage=info["cpu_usage"],
+            time_limit_exceeded=time_limit_exceeded(resp),
+        )
+        pipe = cache.pipeline(transaction=False)
+        pipe.hset(CacheKey.judge_slot_capacity, server_id, limit)
+        pipe.hset(CacheKey.judge_slot_latency, server_id, latency)
+        pipe.execute()
+
+    def refresh(self, force=False):
+        # 多个 worker 之间只有抢到锁的那个去数据库对账
+        if force:
+            judge_server_registry.invalidate()
+        if force or cache.set(
+            CacheKey.judge_slot_reconcile_lock, 1, timeout=RECONCILE_INTERVAL, nx=True
+        ):
+            self.reconcile()
+
+    def reconcile(self):
+        self.invalidate()
+        servers = judge_server_registry.active()
+        # 保留已经调整过的并发上限, 新上线的服务器从初始值开始
+        limits = {
+            _decode(k): float(v)
+            for k, v in cache.hgetall(CacheKey.judge_slot_capacity).items()
+        }
+        pipe = cache.pipeline()
+        pipe.delete(CacheKey.judge_slot_capacity, CacheKey.judge_slot_servers)
+        for server in servers:
+            limit = limits.get(str(server.id), initial_limit(server.cpu_core))
+            limit = min(max(limit, MIN_LIMIT), max_limit(server.cpu_core))
+            pipe.hset(CacheKey.judge_slot_capacity, server.id, limit)
+            pipe.hset(
+                CacheKey.judge_slot_servers,
+                server.id,
+                json.dumps(
+                    {
+                        "hostname": server.hostname,
+                        "service_url": server.service_url,
+                        "cpu_core": server.cpu_core,
+                        "cpu_usage": server.cpu_usage,
+                        "memory_usage": server.memory_usage,
+                    }
+                ),
+            )
+        pipe.execute()
+
+        # task_number 只作展示用，以 redis 中未过期的租约数为准
+        now = time.time()
+        task_numbers = list(JudgeServer.objects.values_list("id", "task_number"))
+        pipe = cache.pipeline()
+        for server_id, _ in task_numbers:
+            pipe.zremrangebyscore(self._lease_key(server_id), "-inf", now)
+            pipe.zcard(self._lease_key(server_id))
+        used = pipe.execute()[1::2]
+        for (server_id, task_number), count in zip(task_numbers, used):
+            if task_number != count:
+                JudgeServer.objects.filter(id=server_id).update(task_number=count)
+
+    def reset(self):
+        """
+        清空所有租约、并发上限和熔断器状态，仅在服务启动时使用
+        """
+        cache.delete_pattern(f"{CacheKey.judge_slot_leases}:*")
+        cache.delete(CacheKey.judge_slot_capacity)
+        cache.delete(CacheKey.judge_slot_latency)
+        circuit_breaker.reset()
+        JudgeServer.objects.update(task_number=0)
+        self.refresh(force=True)
+
+
+slot_allocator = JudgeSlotAllocator()
@@ -0,0 +1,387 @@
+import asyncio
+import logging
+import time
+from urllib.parse import urljoin
+
+import aiohttp
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from account.models import User
+from judge.allocator import JudgeLane, slot_allocator
+from judge.client import CONNECT_TIMEOUT, record_stats, record_straggler
+from judge.context import problem_context_cache
+from judge.dispatcher import JudgeDispatcher
+from judge.notifier import ResultKind, result_notifier
+from judge.result_cache import result_cache
+from judge.scheduler import LEASE_GRACE_PERIOD, judge_queue
+from judge.statistics import judge_statistics
+from submission.models import JudgeStatus, Submission
+
+logger = logging.getLogger(__name__)
+
+# 队列为空或没有空闲名额时的轮询间隔（秒）
+POLL_INTERVAL = 0.2
+# 判题结果批量写回数据库的间隔（秒）和每批最大数量
+FLUSH_INTERVAL = 0.5
+FLUSH_BATCH_SIZE = 200
+
+RESULT_FIELDS = ["result", "info", "score", "memory", "is_judging", "statistic_result"]
+
+
+class AsyncJudgeWorker:
+    """
+    用一个事件循环并发处理判题队列中的任务, 所有请求共用一个 aiohttp 连接池,
+    判题结果攒批后用 bulk_update 写回数据库。
+
+    数据库操作都放在 sync_to_async 的线程中批量执行, 释放名额、调整并发上限、写结果缓存等 redis 操作
+    在线程池中执行, 事件循环只负责 http 请求。
+    batch 模式下同一台服务器上的任务合并成一个请求发送。
+    """
+
+    def __init__(self, concurrency=1000, flush_interval=FLUSH_INTERVAL, batch_size=1):
+        """
+        :param batch_size: 大于 1 时同一台服务器上的任务每最多 batch_size 个合并成一个请求
+        """
+        self.concurrency = concurrency
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.inflight = set()
+        self.results = []
+        self.stopping = False
+
+    def fetch(self):
+        """
+        按队列顺序为排在前面的任务获取判题名额并生成判题数据, 拿到名额后才从队列中取出,
+        名额不足时剩下的任务留在原位。命中结果缓存的直接保存
+        :return: [(dispatcher, slot, data), ...]
+        """
+        count = min(
+            slot_allocator.available(JudgeLane.JUDGE),
+            self.concurrency - len(self.inflight),
+        )
+        tasks = judge_queue.peek(count)
+        if not tasks:
+            return []
+
+        submissions = Submission.objects.in_bulk(
+            [task["data"]["submission_id"] for task in tasks]
+        )
+        problems = problem_context_cache.get_many(
+            [task["data"]["problem_id"] for task in tasks]
+        )
+        disabled_users = set(
+            User.objects.filter(
+                id__in=[s.user_id for s in submissions.values()], is_disabled=True
+            ).values_list("id", flat=True)
+        )
+
+        jobs = []
+        skipped = []
+        cached = []
+        for task in tasks:
+            submission = submissions.get(task["data"]["submission_id"])
+            problem = problems.get(task["data"]["problem_id"])
+            if (
+                not submission
+                or not problem
+                or problem.contest_id != submission.contest_id
+                or submission.user_id in disabled_users
+            ):
+                if not judge_queue.take(task):
+                    break
+                skipped.append(task["id"])
+                continue
+            dispatcher = JudgeDispatcher(
+                submission.id, problem.id, submission=submission, problem=problem
+            )
+            data = dispatcher.build_payload()
+            resp = result_cache.get(result_cache.key(data))
+            if resp:
+                if not judge_queue.take(task):
+                    break
+                cached.append((dispatcher, resp, None))
+                continue
+            slot = slot_allocator.acquire(
+                timeout=dispatcher.timeout + LEASE_GRACE_PERIOD,
+                key=dispatcher.affinity_key,
+                exclude=task["data"].get("exclude"),
+            )
+            # 名额被其他进程抢走了, 剩下的任务留在原位等下一轮
+            if not slot:
+                break
+            # 队列在 peek 之后被其他进程改变了, 下一轮重新查看
+            if not judge_queue.take(task, dispatcher.timeout + LEASE_GRACE_PERIOD):
+                slot_allocator.release(slot)
+                break
+            jobs.append((dispatcher, slot, data))
+
+        if skipped:
+            Submission.objects.filter(id__in=skipped).update(is_judging=False)
+            for task_id in skipped:
+                judge_queue.ack(task_id)
+        if cached:
+            self.flush(cached)
+        Submission.objects.filter(
+            id__in=[dispatcher.submission.id for dispatcher, _, _ in jobs]
+        ).update(result=JudgeStatus.JUDGING)
+        return jobs
+
+    def group(self, jobs):
+        """
+        按服务器分组, 每组最多 batch_size 个
+        :return: [[(dispatcher, slot, data), ...], ...]
+        """
+        groups = []
+        by_server = {}
+        for job in jobs:
+            group = by_server.get(job[1].id)
+            if group is None or len(group) >= self.batch_size:
+                group = by_server[job[1].id] = []
+                groups.append(group)
+            group.append(job)
+        return groups
+
+    def flush(self, results):
+        """
+        批量保存已经完成的判题结果, 调用失败的放回队列重试
+        :param results: [(dispatcher, resp, server_id), ...]
+        """
+        finished = []
+        retried = []
+        for dispatcher, resp, server_id in results:
+            if not resp and judge_queue.retry(
+                dispatcher.submission.id, exclude=server_id
+            ):
+                retried.append(dispatcher.submission.id)
+                continue
+            dispatcher.apply_result(resp)
+            finished.append(dispatcher)
+        if retried:
+            Submission.objects.filter(id__in=retried).update(result=JudgeStatus.PENDING)
+        changes = judge_statistics.collect(
+            [(dispatcher.submission, dispatcher.problem) for dispatcher in finished]
+        )
+        Submission.objects.bulk_update(
+            [dispatcher.submission for dispatcher in finished],
+            RESULT_FIELDS,
+            batch_size=FLUSH_BATCH_SIZE,
+        )
+        for dispatcher in finished:
+            judge_queue.ack(dispatcher.submission.id)
+        result_notifier.publish_many(
+            ResultKind.SUBMISSION,
+            [(d.submission.id, d.submission.result) for d in finished],
+        )
+        judge_statistics.record(changes)
+
+    @staticmethod
+    async def run_in_thread(func, *args, **kwargs):
+        # 只访问 redis, 不需要和数据库操作在同一个线程中, 在线程池中并发执行
+        return await sync_to_async(func, thread_sensitive=False)(*args, **kwargs)
+
+    @staticmethod
+    def settle(slot, cost, result, timeout):
+        """
+        请求结束后释放名额, 并按结果调整该服务器的并发上限和熔断器
+        """
+        slot_allocator.release(slot)
+        slot_allocator.report(slot, cost, ok=bool(result), timeout=timeout, resp=result)
+
+    @staticmethod
+    def record_result(data, result, stragglers=()):
+        """
+        写入结果缓存, 记录被丢弃的请求
+        :param stragglers: 被丢弃的请求的 service_url
+        """
+        for service_url in stragglers:
+            record_straggler(service_url)
+        result_cache.set(result_cache.key(data), result)
+
+    async def post(self, session, url, data, token, timeout, service_url):
+        """
+        :param timeout: 读超时（秒）
+        :param service_url: 记录统计信息用
+        :return: 返回的 json, 失败时为 None
+        """
+        start = time.time()
+        try:
+            async with session.post(
+                url,
+                json=data,
+                headers={"X-Judge-Server-Token": token},
+                timeout=aiohttp.ClientTimeout(
+                    total=CONNECT_TIMEOUT + timeout, sock_connect=CONNECT_TIMEOUT
+                ),
+            ) as resp:
+                resp.raise_for_status()
+                result = await resp.json()
+            error = None
+        except asyncio.TimeoutError:
+            logger.error(f"Judge request to {url} timed out")
+            result, error = None, "timeouts"
+        except Exception as e:
+            logger.exception(e)
+            result, error = None, "errors"
+        await self.run_in_thread(
+            record_stats, service_url, time.time() - start, error=error
+        )
+        return result
+
+    async def request(self, session, dispatcher, slot, data):
+        """
+        向一台服务器发送判题请求, 结束或被取消时释放名额
+        :return: judge server 的返回值, 失败时为 None
+        """
+        start = time.time()
+        try:
+            result = await self.post(
+                session,
+                urljoin(slot.service_url, "/judge"),
+                data,
+                dispatcher.token,
+                dispatcher.timeout,
+                slot.service_url,
+            )
+        except asyncio.CancelledError:
+            # 另一个请求已经返回, 只释放名额
+            await self.run_in_thread(slot_allocator.release, slot)
+            raise
+        await self.run_in_thread(
+            self.settle, slot, time.time() - start, result, dispatcher.timeout
+        )
+        return result
+
+    async def judge_batch(self, session, jobs):
+        """
+        把同一台服务器上的多个任务合并成一个 /judge_batch 请求。judge server 不支持时经由
+        judge_callback_proxy 转发, 由它并发调用 /judge
+        :param jobs: [(dispatcher, slot, data), ...], 名额都在同一台服务器上
+        """
+        service_url = jobs[0][1].service_url
+        timeout = max(dispatcher.timeout for dispatcher, _, _ in jobs)
+        start = time.time()
+        try:
+            resp = await self.post(
+                session,
+                urljoin(
+                    settings.JUDGE_CALLBACK_PROXY_URL or service_url, "/judge_batch"
+                ),
+                {
+                    "service_url": service_url,
+                    "timeout": timeout,
+                    "tasks": [data for _, _, data in jobs],
+                },
+                jobs[0][0].token,
+                timeout,
+                service_url,
+            )
+        except asyncio.CancelledError:
+            for _, slot, _ in jobs:
+                await self.run_in_thread(slot_allocator.release, slot)
+            raise
+        if resp and not resp["err"] and len(resp["data"]) == len(jobs):
+            results = resp["data"]
+        else:
+            if resp:
+                logger.error(f"Invalid judge batch response: {resp}")
+            results = [None] * len(jobs)
+        await self.run_in_thread(
+            self.settle_batch, jobs, results, time.time() - start, timeout
+        )
+        for (dispatcher, slot, _), result in zip(jobs, results):
+            self.results.append((dispatcher, result, slot.id))
+
+    def settle_batch(self, jobs, results, cost, timeout):
+        for (_, slot, data), result in zip(jobs, results):
+            self.settle(slot, cost, result, timeout)
+            self.record_result(data, result)
+
+    async def judge(self, session, dispatcher, slot, data):
+        """
+        开启 hedging 时, 超过 hedge_delay 还没有返回就在另一台服务器上再发一份,
+        使用先返回的成功结果并取消另一个请求
+        """
+        pending = {
+            asyncio.ensure_future(self.request(session, dispatcher, slot, data)): slot
+        }
+        delay = dispatcher.hedge_delay
+        if delay:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                # 获取名额时可能需要从数据库刷新服务器列表, 不能在事件循环中执行
+                try:
+                    hedge = await sync_to_async(dispatcher.acquire_hedge)(
+                        slot, dispatcher.timeout
+                    )
+                except Exception as e:
+                    # 获取失败时只等待原来的请求
+                    logger.exception(e)
+                    hedge = None
+                if hedge:
+                    future = asyncio.ensure_future(
+                        self.request(session, dispatcher, hedge, data)
+                    )
+                    pending[future] = hedge
+
+        result, winner = None, slot
+        while pending and not result:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                winner = pending.pop(future)
+                result = future.result()
+                if result:
+                    break
+        for future in pending:
+            future.cancel()
+        # 等待被取消的请求释放名额
+        await asyncio.gather(*pending, return_exceptions=True)
+        await self.run_in_thread(
+            self.record_result,
+            data,
+            result,
+            [loser.service_url for loser in pending.values()],
+        )
+        self.results.append((dispatcher, result, winner.id))
+
+    async def flush_loop(self):
+        while not self.stopping or self.inflight or self.results:
+            await asyncio.sleep(self.flush_interval)
+            # 在事件循环中取走结果, 避免与 judge 中的 append 竞争
+            results, self.results = self.results, []
+            if not results:
+                continue
+            try:
+                await sync_to_async(self.flush)(results)
+            except Exception as e:
+                logger.exception(e)
+
+    async def run(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=0)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            flusher = asyncio.ensure_future(self.flush_loop())
+            while not self.stopping:
+                try:
+                    jobs = await sync_to_async(self.fetch)()
+                except Exception as e:
+                    logger.exception(e)
+                    jobs = []
+                if not jobs:
+                    await asyncio.sleep(POLL_INTERVAL)
+                    continue
+                if self.batch_size > 1:
+                    futures = [
+                        self.judge_batch(session, batch) for batch in self.group(jobs)
+                    ]
+                else:
+                    futures = [self.judge(session, *job) for job in jobs]
+                for future in futures:
+                    future = asyncio.ensure_future(future)
+                    self.inflight.add(future)
+                    future.add_done_callback(self.inflight.discard)
+            if self.inflight:
+                await asyncio.wait(self.inflight)
+            await flusher
+
+    def stop(self):
+        self.stopping = True
@@ -0,0 +1,168 @@
+import time
+
+from judge.policies import is_slow
+from utils.cache import cache
+from utils.constants import CacheKey
+
+# 统计失败率的时间窗口（秒）
+WINDOW = 60
+# 窗口内至少有这么多请求才会根据失败率断开
+MIN_REQUESTS = 5
+# 失败（包括超时和过慢）的比例达到这个值就断开, 过慢的定义见 judge.policies.SLOW_RATIO
+FAILURE_RATE_THRESHOLD = 0.5
+# 断开后多久允许发送一个试探请求（秒）
+OPEN_DURATION = 30
+# 试探请求迟迟没有结果时, 多久之后允许再试探一次（秒）
+PROBE_TIMEOUT = 60
+
+
+class CircuitState:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+# 记录一次请求的结果, 并完成状态转换
+# KEYS[1]: 熔断器 hash  ARGV[1]: 当前时间  ARGV[2]: 是否成功  ARGV[3]: 窗口长度
+# ARGV[4]: 最少请求数  ARGV[5]: 失败率阈值
+RECORD_SCRIPT = """
+local state = redis.call("HGET", KEYS[1], "state") or "closed"
+local now = tonumber(ARGV[1])
+if state == "half_open" then
+    if ARGV[2] == "1" then
+        redis.call("HSET", KEYS[1], "state", "closed", "window_start", now, "requests", 0, "failures", 0)
+        return "closed"
+    end
+    redis.call("HSET", KEYS[1], "state", "open", "opened_at", now)
+    return "open"
+end
+if state == "open" then
+    -- 断开之前发出的请求, 结果不再影响状态
+    return state
+end
+local window_start = tonumber(redis.call("HGET", KEYS[1], "window_start") or 0)
+if now - window_start > tonumber(ARGV[3]) then
+    redis.call("HSET", KEYS[1], "state", "closed", "window_start", now, "requests", 0, "failures", 0)
+end
+local requests = redis.call("HINCRBY", KEYS[1], "requests", 1)
+local failures = redis.call("HINCRBY", KEYS[1], "failures", ARGV[2] == "1" and 0 or 1)
+if requests >= tonumber(ARGV[4]) and failures / requests >= tonumber(ARGV[5]) then
+    redis.call("HSET", KEYS[1], "state", "open", "opened_at", now)
+    return "open"
+end
+return "closed"
+"""
+
+# 断开时间已到或上一次试探超时时, 允许一个试探请求
+# KEYS[1]: 熔断器 hash  ARGV[1]: 当前时间  ARGV[2]: 断开时长  ARGV[3]: 试探超时
+PROBE_SCRIPT = """
+local state = redis.call("HGET", KEYS[1], "state")
+local now = tonumber(ARGV[1])
+if (state == "open" and now >= tonumber(redis.call("HGET", KEYS[1], "opened_at")) + tonumber(ARGV[2]))
+        or (state == "half_open" and now >= tonumber(redis.call("HGET", KEYS[1], "probe_until"))) then
+    redis.call("HSET", KEYS[1], "state", "half_open", "probe_until", now + tonumber(ARGV[3]))
+    return 1
+end
+return 0
+"""
+
+
+class CircuitBreaker:
+    """
+    每台 judge server 一个熔断器, 状态保存在 redis 中, 所有 worker 共享。
+
+    closed: 正常分配任务, 时间窗口内失败率过高时转为 open
+    open: 不再分配任务, OPEN_DURATION 之后允许一个试探请求并转为 half_open
+    half_open: 试探请求成功则恢复 closed, 失败则重新 open
+    """
+
+    def __init__(self):
+        self._record_script = None
+        self._probe_script = None
+
+    @staticmethod
+    def _key(server_id):
+        return f"{CacheKey.judge_breaker}:{server_id}"
+
+    def record(self, server_id, ok, cost=None, timeout=None, finished=False):
+        """
+        :param ok: 请求是否成功
+        :param cost: 请求耗时（秒）, 和 timeout 一起用于判断是否过慢
+        :param finished: judge server 正常返回了判题结果, 耗时由提交的代码决定, 不算过慢
+        :return: 记录之后的状态
+        """
+        if ok and not finished and cost is not None and is_slow(cost, timeout):
+            ok = False
+        if self._record_script is None:
+            self._record_script = cache.register_script(RECORD_SCRIPT)
+        state = self._record_script(
+            keys=[self._key(server_id)],
+            args=[
+                time.time(),
+                int(ok),
+                WINDOW,
+                MIN_REQUESTS,
+                FAILURE_RATE_THRESHOLD,
+            ],
+        )
+        return state.decode("utf-8") if isinstance(state, bytes) else state
+
+    def try_probe(self, server_id):
+        """
+        :return: 是否获得了发送试探请求的机会
+        """
+        if self._probe_script is None:
+            self._probe_script = cache.register_script(PROBE_SCRIPT)
+        return bool(
+            self._probe_script(
+                keys=[self._key(server_id)],
+                args=[time.time(), OPEN_DURATION, PROBE_TIMEOUT],
+            )
+        )
+
+    def states(self, server_ids):
+        """
+        :return: {server_id: CircuitState.CLOSED | OPEN | HALF_OPEN}, 以及其中可以试探的 server_id 集合
+        """
+        pipe = cache.pipeline(transaction=False)
+        for server_id in server_ids:
+            pipe.hmget(self._key(server_id), "state", "opened_at", "probe_until")
+        now = time.time()
+        states = {}
+        probes = set()
+        for server_id, (state, opened_at, probe_until) in zip(
+            server_ids, pipe.execute()
+        ):
+            state = state.decode("utf-8") if state else CircuitState.CLOSED
+            states[server_id] = state
+            if (
+                state == CircuitState.OPEN
+                and now >= float(opened_at) + OPEN_DURATION
+                or state == CircuitState.HALF_OPEN
+                and now >= float(probe_until)
+            ):
+                probes.add(server_id)
+        return states, probes
+
+    def status(self, server_id):
+        """
+        供后台展示
+        """
+        data = {
+            k.decode("utf-8"): v.decode("utf-8")
+            for k, v in cache.hgetall(self._key(server_id)).items()
+        }
+        requests = int(data.get("requests", 0))
+        failures = int(data.get("failures", 0))
+        return {
+            "state": data.get("state", CircuitState.CLOSED),
+            "requests": requests,
+            "failures": failures,
+            "failure_rate": failures / requests if requests else 0,
+        }
+
+    def reset(self):
+        cache.delete_pattern(f"{CacheKey.judge_breaker}:*")
+
+
+circuit_breaker = CircuitBreaker()
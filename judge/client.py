@@ -0,0 +1,160 @@
+import logging
+import threading
+import time
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.cache import cache
+from utils.constants import CacheKey
+
+logger = logging.getLogger(__name__)
+
+# 秒
+CONNECT_TIMEOUT = 3
+# 编译、准备沙箱等与测试点数量无关的固定开销
+READ_TIMEOUT_BASE = 10
+# 不能超过 judge slot 租约的有效期
+READ_TIMEOUT_MAX = 500
+COMPILE_TIMEOUT = 30
+# 编译、准备沙箱的典型耗时, 用于估算正常情况下的判题时间
+EXPECTED_COMPILE_TIME = 2
+# 只对建立连接失败重试, 请求一旦发出就不再重试, 避免同一份代码被判两次
+MAX_RETRIES = 2
+POOL_MAXSIZE = 16
+
+
+def judge_timeout(time_limit, test_case_number=1):
+    """
+    根据题目时限估算判题请求的读超时
+    :param time_limit: 单个测试点的 cpu 时限, ms
+    :param test_case_number: 测试点数量
+    :return: 秒
+    """
+    # judge server 中 real time 的限制是 cpu time 的 3 倍
+    timeout = READ_TIMEOUT_BASE + time_limit * 3 * max(test_case_number, 1) / 1000
+    return min(timeout, READ_TIMEOUT_MAX)
+
+
+def hedge_delay(time_limit, test_case_number=1, percentile=0):
+    """
+    判题请求超过这个时间还没有返回时, 在另一台服务器上再发一份
+    :param time_limit: 单个测试点的 cpu 时限, ms
+    :param percentile: 占预计判题时间的百分比, 预计判题时间按每个测试点都用满 cpu 时限计算; 0 表示不开启
+    :return: 秒, 不开启时为 None
+    """
+    if not percentile:
+        return None
+    expected = EXPECTED_COMPILE_TIME + time_limit * max(test_case_number, 1) / 1000
+    return min(expected * percentile / 100, judge_timeout(time_limit, test_case_number))
+
+
+class JudgeServerClient:
+    """
+    与单个 judge server 通信的 http 客户端, 复用 keep-alive 连接, 并在 redis 中记录延迟和错误计数
+    """
+
+    def __init__(self, service_url):
+        self.service_url = service_url
+        self.session = requests.Session()
+        retry = Retry(
+            total=MAX_RETRIES,
+            connect=MAX_RETRIES,
+            read=0,
+            status=0,
+            backoff_factor=0.1,
+        )
+        adapter = HTTPAdapter(pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def post(self, path, data=None, headers=None, timeout=READ_TIMEOUT_BASE):
+        start = time.time()
+        try:
+            resp = self.session.post(
+                urljoin(self.service_url, path),
+                json=data,
+                headers=headers,
+                timeout=(CONNECT_TIMEOUT, timeout),
+            )
+            resp.raise_for_status()
+            result = resp.json()
+        except requests.Timeout:
+            record_stats(self.service_url, time.time() - start, error="timeouts")
+            raise
+        except Exception:
+            record_stats(self.service_url, time.time() - start, error="errors")
+            raise
+        record_stats(self.service_url, time.time() - start)
+        return result
+
+
+def record_stats(service_url, cost, error=None):
+    """
+    :param cost: 请求耗时, 秒
+    :param error: "timeouts" 或 "errors"
+    """
+    key = f"{CacheKey.judge_client_stats}:{service_url}"
+    try:
+        pipe = cache.pipeline(transaction=False)
+        pipe.hincrby(key, "requests", 1)
+        pipe.hincrby(key, "latency", int(cost * 1000))
+        if error:
+            pipe.hincrby(key, error, 1)
+        else:
+            pipe.hset(key, "last_latency", int(cost * 1000))
+        pipe.execute()
+    except Exception as e:
+        # 统计失败不能影响判题
+        logger.warning(f"Failed to record judge client stats: {e}")
+
+
+def record_straggler(service_url):
+    """
+    记录一次被另一台服务器抢先返回结果的请求
+    """
+    try:
+        cache.hincrby(f"{CacheKey.judge_client_stats}:{service_url}", "stragglers", 1)
+    except Exception as e:
+        logger.warning(f"Failed to record judge client stats: {e}")
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service_url):
+    """
+    每个进程内按 service_url 复用同一个客户端
+    """
+    client = _clients.get(service_url)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(service_url)
+            if client is None:
+                client = _clients[service_url] = JudgeServerClient(service_url)
+    return client
+
+
+def get_client_stats(service_url):
+    """
+    所有进程汇总的请求统计, 延迟单位为 ms
+    """
+    data = {
+        k.decode("utf-8"): int(v)
+        for k, v in cache.hgetall(
+            f"{CacheKey.judge_client_stats}:{service_url}"
+        ).items()
+    }
+    requests_number = data.get("requests", 0)
+    latency = data.pop("latency", 0)
+    return {
+        "requests": requests_number,
+        "errors": data.get("errors", 0),
+        "timeouts": data.get("timeouts", 0),
+        "stragglers": data.get("stragglers", 0),
+        "avg_latency": latency // requests_number if requests_number else 0,
+        "last_latency": data.get("last_latency", 0),
+    }
@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+
+from options.options import SysOptions
+from problem.models import Problem
+from problem.utils import parse_problem_template
+from utils.cache import cache
+from utils.constants import CacheKey
+
+# 生成判题数据和处理结果用到的题目字段, 题面等大字段不加载
+CONTEXT_FIELDS = (
+    "id",
+    "_id",
+    "contest_id",
+    "time_limit",
+    "memory_limit",
+    "test_case_id",
+    "test_case_score",
+    "template",
+    "io_mode",
+    "spj",
+    "spj_language",
+    "spj_code",
+    "spj_version",
+    "rule_type",
+)
+# 进程内最多缓存的题目数
+MAX_CONTEXTS = 1024
+# 即使版本号没有变化, 超过这个时间（秒）也重新加载, 以便使用修改后的语言配置
+CONTEXT_TTL = 300
+
+
+class ProblemJudgeContext:
+    """
+    判题时需要的题目数据, 模板已经解析好, 语言配置按名称索引
+    """
+
+    def __init__(self, version, **fields):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        for field in CONTEXT_FIELDS:
+            setattr(self, field, fields[field])
+        self.templates = {
+            language: parse_problem_template(template)
+            for language, template in self.template.items()
+        }
+        self.language_configs = {item["name"]: item for item in SysOptions.languages}
+        spj_config = {}
+        if self.spj_code:
+            spj_config = self.language_configs.get(self.spj_language, {}).get("spj", {})
+        self.spj_config = spj_config
+
+
+class ProblemJudgeContextCache:
+    """
+    进程内的 ProblemJudgeContext 缓存。题目修改后调用 invalidate 增加 redis 中的版本号,
+    各个进程在下次使用时发现版本号变化后重新加载
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contexts = OrderedDict()
+
+    def get(self, problem_id):
+        """
+        :raise Problem.DoesNotExist:
+        """
+        context = self.get_many([problem_id]).get(problem_id)
+        if context is None:
+            raise Problem.DoesNotExist()
+        return context
+
+    def get_many(self, problem_ids):
+        """
+        :return: {problem_id: ProblemJudgeContext}, 不存在的题目不在其中
+        """
+        problem_ids = list(set(problem_ids))
+        if not problem_ids:
+            return {}
+        versions = cache.hmget(CacheKey.problem_judge_version, problem_ids)
+        versions = {
+            problem_id: int(version or 0)
+            for problem_id, version in zip(problem_ids, versions)
+        }
+        now = time.monotonic()
+        result = {}
+        with self._lock:
+            for problem_id in problem_ids:
+                context = self._contexts.get(problem_id)
+                if (
+                    context
+                    and context.version == versions[problem_id]
+                    and now - context.loaded_at < CONTEXT_TTL
+                ):
+                    self._contexts.move_to_end(problem_id)
+                    result[problem_id] = context
+
+        missing = [problem_id for problem_id in problem_ids if problem_id not in result]
+        if missing:
+            for fields in Problem.objects.filter(id__in=missing).values(
+                *CONTEXT_FIELDS
+            ):
+                result[fields["id"]] = ProblemJudgeContext(
+                    versions[fields["id"]], **fields
+                )
+            with self._lock:
+                for problem_id in missing:
+                    if problem_id in result:
+                        self._contexts[problem_id] = result[problem_id]
+                while len(self._contexts) > MAX_CONTEXTS:
+                    self._contexts.popitem(last=False)
+        return result
+
+    def invalidate(self, problem_id):
+        cache.hincrby(CacheKey.problem_judge_version, problem_id, 1)
+
+    def clear(self):
+        with self._lock:
+            self._contexts.clear()
+
+
+problem_context_cache = ProblemJudgeContextCache()
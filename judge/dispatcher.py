@@ -1,62 +1,161 @@
 import hashlib
-import json
 import logging
-from urllib.parse import urljoin
-
-import requests
-from django.db import transaction, IntegrityError
-from django.db.models import F
-
-from account.models import User
-from conf.models import JudgeServer
-from contest.models import ContestRuleType, ACMContestRank, OIContestRank, ContestStatus
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.utils.functional import cached_property
+
+from contest.models import Contest, ContestStatus
+from judge.allocator import JudgeLane, JudgeSlot, slot_allocator
+from judge.client import (
+    COMPILE_TIMEOUT,
+    READ_TIMEOUT_BASE,
+    get_client,
+    hedge_delay,
+    judge_timeout,
+    record_straggler,
+)
+from judge.context import problem_context_cache
+from judge.metrics import JudgeStage, StageTimer
+from judge.notifier import ResultKind, result_notifier
+from judge.result_cache import result_cache
+from judge.scheduler import LEASE_GRACE_PERIOD, JudgeTaskClass, judge_queue
+from judge.statistics import judge_statistics
 from options.options import SysOptions
 from problem.models import Problem, ProblemRuleType
-from problem.utils import parse_problem_template
 from submission.models import JudgeStatus, Submission
 from utils.cache import cache
 from utils.constants import CacheKey
 
 logger = logging.getLogger(__name__)
 
+# sync 模式下并发发送 hedged 请求的线程池大小, 被丢弃的请求在返回或超时前仍会占用线程
+HEDGE_WORKERS = 8
+_hedge_executor = None
+
+
+def get_hedge_executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        _hedge_executor = ThreadPoolExecutor(
+            max_workers=HEDGE_WORKERS, thread_name_prefix="judge-hedge"
+        )
+    return _hedge_executor
+
+
+class JudgeDispatchMode:
+    # celery worker 阻塞等待判题结果
+    SYNC = "sync"
+    # 发出判题任务后立即返回, 结果由 judge server 或 judge_callback_proxy 回调 JudgeServerCallbackAPI
+    CALLBACK = "callback"
+    # 任务全部放入队列, 由 judge_async_worker 并发判题
+    ASYNC = "async"
+    # 同 async, judge_async_worker 把同一台服务器上的任务合并成一个 /judge_batch 请求
+    BATCH = "batch"
+
 
-# 继续处理在队列中的问题
+# 继续处理在队列中的问题, 有多少空闲名额就取出多少任务
 def process_pending_task():
-    if cache.llen(CacheKey.waiting_queue):
-        # 防止循环引入
-        from judge.tasks import judge_task
+    # async 和 batch 模式下队列由 judge_async_worker 消费
+    if settings.JUDGE_DISPATCH_MODE in (
+        JudgeDispatchMode.ASYNC,
+        JudgeDispatchMode.BATCH,
+    ):
+        return
+    # 防止循环引入
+    from judge.tasks import judge_task
+
+    # 先获取名额再从队列中取出任务, 名额被其他进程抢走时任务留在原位
+    tasks = judge_queue.peek(slot_allocator.available(JudgeLane.JUDGE))
+    problems = problem_context_cache.get_many(
+        [task["data"]["problem_id"] for task in tasks]
+    )
+    for task in tasks:
+        problem = problems.get(task["data"]["problem_id"])
+        slot = None
+        # 题目已经被删除的任务不需要名额, 由 judge_task 结束并 ack
+        if problem:
+            slot = slot_allocator.acquire(
+                timeout=judge_timeout(problem.time_limit, len(problem.test_case_score))
+                + LEASE_GRACE_PERIOD,
+                key=problem_affinity_key(problem),
+                exclude=task["data"].get("exclude"),
+            )
+            if not slot:
+                break
+        if not judge_queue.take(task):
+            if slot:
+                slot_allocator.release(slot)
+            break
+        judge_task.delay(
+            **task["data"],
+            enqueue_time=task.get("enqueue_time"),
+            slot=vars(slot) if slot else None,
+        )
 
-        tmp_data = cache.rpop(CacheKey.waiting_queue)
-        if tmp_data:
-            data = json.loads(tmp_data.decode("utf-8"))
-            judge_task.delay(**data)
+
+def judge_task_class(contest=None, rejudge=False):
+    """
+    :param contest: 提交所在的比赛
+    :param rejudge: 提交已经有判题结果
+    """
+    if rejudge:
+        return JudgeTaskClass.REJUDGE
+    if contest and contest.status == ContestStatus.CONTEST_UNDERWAY:
+        return JudgeTaskClass.CONTEST
+    return JudgeTaskClass.PRACTICE
+
+
+def problem_affinity_key(problem):
+    # judge server 按 test_case_id 读取测试用例, 按 spj_version 缓存编译好的 spj
+    if problem.spj:
+        return f"{problem.test_case_id}:{problem.spj_version}"
+    return problem.test_case_id
+
+
+def handle_judge_callback(submission_id, resp):
+    """
+    处理回调的判题结果, resp 为 None 表示判题失败
+    :return: 任务不存在或已经处理过时返回 False
+    """
+    key = f"{CacheKey.judge_callback}:{submission_id}"
+    pending = cache.get(key)
+    # 重复的回调只有一个能删除成功
+    if not pending or not cache.delete(key):
+        return False
+    slot = JudgeSlot(**pending["slot"])
+    slot_allocator.release(slot)
+    elapsed = time.time() - pending["start_time"]
+    slot_allocator.report(
+        slot, elapsed, ok=bool(resp), timeout=pending["timeout"], resp=resp
+    )
+    if pending.get("result_key"):
+        result_cache.set(pending["result_key"], resp)
+    dispatcher = JudgeDispatcher(submission_id, pending["problem_id"])
+    dispatcher.timer.server = slot.hostname
+    dispatcher.timer.add(JudgeStage.JUDGE, elapsed)
+    dispatcher.process_result(resp, server_id=slot.id)
+    return True
 
 
 class ChooseJudgeServer:
-    def __init__(self):
-        self.server = None
-
-    def __enter__(self) -> [JudgeServer, None]:
-        with transaction.atomic():
-            servers = (
-                JudgeServer.objects.select_for_update()
-                .filter(is_disabled=False)
-                .order_by("task_number")
-            )
-            servers = [s for s in servers if s.status == "normal"]
-            for server in servers:
-                if server.task_number <= server.cpu_core * 2:
-                    server.task_number = F("task_number") + 1
-                    server.save(update_fields=["task_number"])
-                    self.server = server
-                    return server
-        return None
+    def __init__(self, key=None, exclude=None, slot=None):
+        """
+        :param slot: 已经获取到的名额, 直接使用, 退出时同样释放
+        """
+        self.key = key
+        self.exclude = exclude
+        self.server = slot
+
+    def __enter__(self) -> [JudgeSlot, None]:
+        if not self.server:
+            self.server = slot_allocator.acquire(key=self.key, exclude=self.exclude)
+        return self.server
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.server:
-            JudgeServer.objects.filter(id=self.server.id).update(
-                task_number=F("task_number") - 1
-            )
+            slot_allocator.release(self.server)
 
 
 class DispatcherBase(object):
@@ -65,12 +164,17 @@ class DispatcherBase(object):
             SysOptions.judge_server_token.encode("utf-8")
         ).hexdigest()
 
-    def _request(self, url, data=None):
-        kwargs = {"headers": {"X-Judge-Server-Token": self.token}}
-        if data:
-            kwargs["json"] = data
+    def _request(self, server, path, data=None, timeout=READ_TIMEOUT_BASE):
+        return self._post(server.service_url, path, data=data, timeout=timeout)
+
+    def _post(self, service_url, path, data=None, timeout=READ_TIMEOUT_BASE):
         try:
-            return requests.post(url, **kwargs).json()
+            return get_client(service_url).post(
+                path,
+                data=data,
+                headers={"X-Judge-Server-Token": self.token},
+                timeout=timeout,
+            )
         except Exception as e:
             logger.exception(e)
 
@@ -94,7 +198,7 @@ class SPJCompiler(DispatcherBase):
             if not server:
                 return "No available judge_server"
             result = self._request(
-                urljoin(server.service_url, "compile_spj"), data=self.data
+                server, "compile_spj", data=self.data, timeout=COMPILE_TIMEOUT
             )
             if not result:
                 return "Failed to call judge server"
@@ -103,19 +207,70 @@ class SPJCompiler(DispatcherBase):
 
 
 class JudgeDispatcher(DispatcherBase):
-    def __init__(self, submission_id, problem_id):
+    def __init__(
+        self, submission_id, problem_id, submission=None, problem=None, timer=None
+    ):
+        """
+        submission 和 problem 可以直接传入已经查询好的对象, 批量处理时避免逐个查询
+        :param timer: judge.metrics.StageTimer, 在 process_result 中写入
+        """
         super().__init__()
-        self.submission = Submission.objects.get(id=submission_id)
+        self.timer = timer or StageTimer(JudgeLane.JUDGE)
+        self.submission = submission or Submission.objects.get(id=submission_id)
         self.contest_id = self.submission.contest_id
         self.last_result = self.submission.result if self.submission.info else None
+        # judge.context.ProblemJudgeContext, 只包含判题需要的字段
+        self.problem = problem or problem_context_cache.get(problem_id)
+        if self.problem.contest_id != self.contest_id:
+            raise Problem.DoesNotExist()
+
+    @cached_property
+    def contest(self):
+        return Contest.objects.get(id=self.contest_id)
+
+    @property
+    def task_class(self):
+        return judge_task_class(
+            self.contest if self.contest_id else None,
+            rejudge=self.last_result is not None,
+        )
+
+    @property
+    def affinity_key(self):
+        return problem_affinity_key(self.problem)
+
+    @property
+    def timeout(self):
+        return judge_timeout(self.problem.time_limit, len(self.problem.test_case_score))
+
+    @property
+    def hedge_delay(self):
+        return hedge_delay(
+            self.problem.time_limit,
+            len(self.problem.test_case_score),
+            settings.JUDGE_HEDGE_PERCENTILE,
+        )
 
-        if self.contest_id:
-            self.problem = Problem.objects.select_related("contest").get(
-                id=problem_id, contest_id=self.contest_id
+    def acquire_hedge(self, server, timeout):
+        """
+        为 hedged 请求获取另一台服务器上的名额
+        :param server: 正在判题的服务器
+        :return: JudgeSlot, 没有其他服务器可用时返回 None
+        """
+        slot = slot_allocator.acquire(
+            timeout=timeout + LEASE_GRACE_PERIOD,
+            key=self.affinity_key,
+            exclude=[server.id],
+        )
+        # exclude 只是优先级, 同一台服务器上再发一份没有意义
+        if slot and slot.id == server.id:
+            slot_allocator.release(slot)
+            return None
+        if slot:
+            logger.info(
+                f"Submission {self.submission.id} is slow on {server.hostname}, hedge to {slot.hostname}"
             )
-            self.contest = self.problem.contest
-        else:
-            self.problem = Problem.objects.get(id=problem_id)
+        return slot
 
     def _compute_statistic_info(self, resp_data):
         # 用时和内存占用保存为多个测试点中最长的那个
@@ -140,26 +295,21 @@ class JudgeDispatcher(DispatcherBase):
                 return
             self.submission.score = score
 
-    def judge(self):
+    def build_payload(self):
+        """
+        生成发给 judge server 的判题数据
+        """
         language = self.submission.language
-        sub_config = list(
-            filter(lambda item: language == item["name"], SysOptions.languages)
-        )[0]
-        spj_config = {}
-        if self.problem.spj_code:
-            for lang in SysOptions.spj_languages:
-                if lang["name"] == self.problem.spj_language:
-                    spj_config = lang["spj"]
-                    break
-
-        if language in self.problem.template:
-            template = parse_problem_template(self.problem.template[language])
+        sub_config = self.problem.language_configs[language]
+        spj_config = self.problem.spj_config
+        template = self.problem.templates.get(language)
+        if template:
             code = (
                 f"{template['prepend']}\n{self.submission.code}\n{template['append']}"
             )
         else:
             code = self.submission.code
-        data = {
+        return {
             "language_config": sub_config["config"],
             "src": code,
             "max_cpu_time": self.problem.time_limit,
@@ -173,22 +323,168 @@ class JudgeDispatcher(DispatcherBase):
             "io_mode": self.problem.io_mode,
         }
 
-        with ChooseJudgeServer() as server:
+    def judge(self, exclude=None, slot=None):
+        """
+        :param exclude: 之前判题失败的 server_id, 尽量不再分配给它们
+        :param slot: process_pending_task 取出任务前已经获取的名额
+        """
+        task = {"submission_id": self.submission.id, "problem_id": self.problem.id}
+        if exclude:
+            task["exclude"] = exclude
+        if settings.JUDGE_DISPATCH_MODE in (
+            JudgeDispatchMode.ASYNC,
+            JudgeDispatchMode.BATCH,
+        ):
+            if slot:
+                slot_allocator.release(slot)
+            self._enqueue(task)
+            return
+        data = self.build_payload()
+        result_key = result_cache.key(data)
+        resp = result_cache.get(result_key)
+        if resp:
+            logger.info(f"Submission {self.submission.id} hits the judge result cache")
+            if slot:
+                slot_allocator.release(slot)
+            self.process_result(resp)
+            return
+        timeout = self.timeout
+        if settings.JUDGE_DISPATCH_MODE == JudgeDispatchMode.CALLBACK:
+            self._judge_with_callback(data, task, timeout, exclude, result_key, slot)
+            return
+
+        start = time.perf_counter()
+        with ChooseJudgeServer(
+            key=self.affinity_key, exclude=exclude, slot=slot
+        ) as server:
             if not server:
-                data = {
-                    "submission_id": self.submission.id,
-                    "problem_id": self.problem.id,
-                }
-                cache.lpush(CacheKey.waiting_queue, json.dumps(data))
+                self._enqueue(task)
                 return
-            Submission.objects.filter(id=self.submission.id).update(
-                result=JudgeStatus.JUDGING
+            self._start(task, timeout)
+            self.timer.add(JudgeStage.ACQUIRE, time.perf_counter() - start)
+            with self.timer.measure(JudgeStage.JUDGE):
+                resp, server = self._request_judge(server, data, timeout)
+            self.timer.server = server.hostname
+        result_cache.set(result_key, resp)
+        self.process_result(resp, server_id=server.id)
+
+    def _request_judge(self, server, data, timeout):
+        """
+        发送判题请求。开启 hedging 时, 超过 hedge_delay 还没有返回就在另一台服务器上再发一份,
+        使用先返回的成功结果, 另一个请求的结果丢弃, 名额立即释放
+        :return: (resp, 返回 resp 的服务器)
+        """
+        delay = self.hedge_delay
+        start = time.time()
+        if not delay:
+            resp = self._request(server, "/judge", data=data, timeout=timeout)
+            slot_allocator.report(
+                server, time.time() - start, ok=bool(resp), timeout=timeout, resp=resp
             )
-            resp = self._request(urljoin(server.service_url, "/judge"), data=data)
+            return resp, server
+
+        executor = get_hedge_executor()
+        pending = {
+            executor.submit(
+                self._request, server, "/judge", data=data, timeout=timeout
+            ): (server, start)
+        }
+        hedge = None
+        if not wait(pending, timeout=delay).done:
+            hedge = self.acquire_hedge(server, timeout)
+            if hedge:
+                future = executor.submit(
+                    self._request, hedge, "/judge", data=data, timeout=timeout
+                )
+                pending[future] = (hedge, time.time())
+
+        resp, winner = None, server
+        while pending and not resp:
+            for future in wait(pending, return_when=FIRST_COMPLETED).done:
+                winner, sent = pending.pop(future)
+                resp = future.result()
+                slot_allocator.report(
+                    winner,
+                    time.time() - sent,
+                    ok=bool(resp),
+                    timeout=timeout,
+                    resp=resp,
+                )
+                if resp:
+                    break
+        # 已经发出的 http 请求无法中断, 只丢弃它的结果
+        for future, (slot, _) in pending.items():
+            future.cancel()
+            record_straggler(slot.service_url)
+        if hedge:
+            slot_allocator.release(hedge)
+        return resp, winner
+
+    def _enqueue(self, task):
+        judge_queue.push(
+            self.submission.id, self.task_class, self.submission.user_id, task
+        )
+
+    def _start(self, task, timeout):
+        judge_queue.lease(
+            self.submission.id,
+            self.task_class,
+            self.submission.user_id,
+            task,
+            timeout + LEASE_GRACE_PERIOD,
+        )
+        Submission.objects.filter(id=self.submission.id).update(
+            result=JudgeStatus.JUDGING
+        )
+
+    def _judge_with_callback(
+        self, data, task, timeout, exclude=None, result_key=None, slot=None
+    ):
+        # 名额一直占用到回调到达, 回调丢失时租约到期后由 recover_judge_tasks 重新放回队列
+        lease_timeout = timeout + LEASE_GRACE_PERIOD
+        server = slot or slot_allocator.acquire(
+            timeout=lease_timeout, key=self.affinity_key, exclude=exclude
+        )
+        if not server:
+            self._enqueue(task)
+            return
+        self._start(task, timeout)
+        key = f"{CacheKey.judge_callback}:{self.submission.id}"
+        cache.set(
+            key,
+            {
+                "problem_id": self.problem.id,
+                "slot": vars(server),
+                "start_time": time.time(),
+                "timeout": timeout,
+                "result_key": result_key,
+            },
+            timeout=lease_timeout,
+        )
+        resp = self._post(
+            settings.JUDGE_CALLBACK_PROXY_URL or server.service_url,
+            "/judge_async",
+            data={
+                "submission_id": self.submission.id,
+                "service_url": server.service_url,
+                "callback_url": settings.JUDGE_CALLBACK_URL,
+                "timeout": timeout,
+                "data": data,
+            },
+        )
+        # 没有发出去, 不算作这台服务器的失败
+        if (not resp or resp["err"]) and cache.delete(key):
+            slot_allocator.release(server)
+            self.process_result(None)
+
+    def apply_result(self, resp):
+        """
+        把判题结果写到 self.submission 上, 不保存
+        :param resp: judge server 的返回值, None 表示调用失败
+        """
+        self.submission.is_judging = False
         if not resp:
-            Submission.objects.filter(id=self.submission.id).update(
-                result=JudgeStatus.SYSTEM_ERROR
-            )
+            self.submission.result = JudgeStatus.SYSTEM_ERROR
             return
 
         if resp["err"]:
@@ -210,307 +506,50 @@ class JudgeDispatcher(DispatcherBase):
                 self.submission.result = error_test_case[0]["result"]
             else:
                 self.submission.result = JudgeStatus.PARTIALLY_ACCEPTED
-        self.submission.is_judging = False
-        self.submission.save()
-
-        # if self.contest_id:
-        #     if (
-        #         self.contest.status != ContestStatus.CONTEST_UNDERWAY
-        #         or User.objects.get(id=self.submission.user_id).is_contest_admin(
-        #             self.contest
-        #         )
-        #     ):
-        #         logger.info(
-        #             "Contest debug mode, id: "
-        #             + str(self.contest_id)
-        #             + ", submission id: "
-        #             + self.submission.id
-        #         )
-        #         return
-        #     with transaction.atomic():
-        #         self.update_contest_problem_status()
-        #         self.update_contest_rank()
-        # else:
-        #     if self.last_result:
-        #         self.update_problem_status_rejudge()
-        #     else:
-        #         self.update_problem_status()
 
-        # 至此判题结束，尝试处理任务队列中剩余的任务
+    def retry(self, server_id=None):
+        """
+        调用 judge server 失败时放回队列重试
+        :param server_id: 本次失败的服务器, 重试时尽量避开
+        :return: 超过重试次数时返回 False
+        """
+        if not judge_queue.retry(self.submission.id, exclude=server_id):
+            return False
+        logger.warning(f"Failed to judge submission {self.submission.id}, retry")
+        Submission.objects.filter(id=self.submission.id).update(
+            result=JudgeStatus.PENDING
+        )
         process_pending_task()
-
-    def update_problem_status_rejudge(self):
-        result = str(self.submission.result)
-        problem_id = str(self.problem.id)
-        with transaction.atomic():
-            # update problem status
-            problem = Problem.objects.select_for_update().get(
-                contest_id=self.contest_id, id=self.problem.id
-            )
-            if (
-                self.last_result != JudgeStatus.ACCEPTED
-                and self.submission.result == JudgeStatus.ACCEPTED
-            ):
-                problem.accepted_number += 1
-            problem_info = problem.statistic_info
-            problem_info[self.last_result] = problem_info.get(self.last_result, 1) - 1
-            problem_info[result] = problem_info.get(result, 0) + 1
-            problem.save(update_fields=["accepted_number", "statistic_info"])
-
-            profile = (
-                User.objects.select_for_update()
-                .get(id=self.submission.user_id)
-                .userprofile
-            )
-            if problem.rule_type == ProblemRuleType.ACM:
-                acm_problems_status = profile.acm_problems_status.get("problems", {})
-                if acm_problems_status[problem_id]["status"] != JudgeStatus.ACCEPTED:
-                    acm_problems_status[problem_id]["status"] = self.submission.result
-                    if self.submission.result == JudgeStatus.ACCEPTED:
-                        profile.accepted_number += 1
-                profile.acm_problems_status["problems"] = acm_problems_status
-                profile.save(update_fields=["accepted_number", "acm_problems_status"])
-
-            else:
-                oi_problems_status = profile.oi_problems_status.get("problems", {})
-                score = self.submission.statistic_info["score"]
-                if oi_problems_status[problem_id]["status"] != JudgeStatus.ACCEPTED:
-                    # minus last time score, add this tim score
-                    profile.add_score(
-                        this_time_score=score,
-                        last_time_score=oi_problems_status[problem_id]["score"],
-                    )
-                    oi_problems_status[problem_id]["score"] = score
-                    oi_problems_status[problem_id]["status"] = self.submission.result
-                    if self.submission.result == JudgeStatus.ACCEPTED:
-                        profile.accepted_number += 1
-                profile.oi_problems_status["problems"] = oi_problems_status
-                profile.save(update_fields=["accepted_number", "oi_problems_status"])
-
-    def update_problem_status(self):
-        result = str(self.submission.result)
-        problem_id = str(self.problem.id)
-        with transaction.atomic():
-            # update problem status
-            problem = Problem.objects.select_for_update().get(
-                contest_id=self.contest_id, id=self.problem.id
-            )
-            problem.submission_number += 1
-            if self.submission.result == JudgeStatus.ACCEPTED:
-                problem.accepted_number += 1
-            problem_info = problem.statistic_info
-            problem_info[result] = problem_info.get(result, 0) + 1
-            problem.save(
-                update_fields=["accepted_number", "submission_number", "statistic_info"]
-            )
-
-            # update_userprofile
-            user = User.objects.select_for_update().get(id=self.submission.user_id)
-            user_profile = user.userprofile
-            user_profile.submission_number += 1
-            if problem.rule_type == ProblemRuleType.ACM:
-                acm_problems_status = user_profile.acm_problems_status.get(
-                    "problems", {}
-                )
-                if problem_id not in acm_problems_status:
-                    acm_problems_status[problem_id] = {
-                        "status": self.submission.result,
-                        "_id": self.problem._id,
-                    }
-                    if self.submission.result == JudgeStatus.ACCEPTED:
-                        user_profile.accepted_number += 1
-                elif acm_problems_status[problem_id]["status"] != JudgeStatus.ACCEPTED:
-                    acm_problems_status[problem_id]["status"] = self.submission.result
-                    if self.submission.result == JudgeStatus.ACCEPTED:
-                        user_profile.accepted_number += 1
-                user_profile.acm_problems_status["problems"] = acm_problems_status
-                user_profile.save(
-                    update_fields=[
-                        "submission_number",
-                        "accepted_number",
-                        "acm_problems_status",
-                    ]
+        return True
+
+    def process_result(self, resp, server_id=None):
+        """
+        保存判题结果并更新统计信息
+        :param resp: judge server 的返回值, None 表示调用失败, 会先放回队列重试
+        :param server_id: 判题的服务器
+        """
+        if not resp and self.retry(server_id):
+            self.timer.flush()
+            return
+        with self.timer.measure(JudgeStage.SAVE):
+            self.apply_result(resp)
+            changes = judge_statistics.collect([(self.submission, self.problem)])
+            if not resp:
+                Submission.objects.filter(id=self.submission.id).update(
+                    result=self.submission.result,
+                    is_judging=False,
+                    statistic_result=self.submission.statistic_result,
                 )
-
             else:
-                oi_problems_status = user_profile.oi_problems_status.get("problems", {})
-                score = self.submission.statistic_info["score"]
-                if problem_id not in oi_problems_status:
-                    user_profile.add_score(score)
-                    oi_problems_status[problem_id] = {
-                        "status": self.submission.result,
-                        "_id": self.problem._id,
-                        "score": score,
-                    }
-                    if self.submission.result == JudgeStatus.ACCEPTED:
-                        user_profile.accepted_number += 1
-                elif oi_problems_status[problem_id]["status"] != JudgeStatus.ACCEPTED:
-                    # minus last time score, add this time score
-                    user_profile.add_score(
-                        this_time_score=score,
-                        last_time_score=oi_problems_status[problem_id]["score"],
-                    )
-                    oi_problems_status[problem_id]["score"] = score
-                    oi_problems_status[problem_id]["status"] = self.submission.result
-                    if self.submission.result == JudgeStatus.ACCEPTED:
-                        user_profile.accepted_number += 1
-                user_profile.oi_problems_status["problems"] = oi_problems_status
-                user_profile.save(
-                    update_fields=[
-                        "submission_number",
-                        "accepted_number",
-                        "oi_problems_status",
-                    ]
-                )
-
-    def update_contest_problem_status(self):
-        with transaction.atomic():
-            user = User.objects.select_for_update().get(id=self.submission.user_id)
-            user_profile = user.userprofile
-            problem_id = str(self.problem.id)
-            if self.contest.rule_type == ContestRuleType.ACM:
-                contest_problems_status = user_profile.acm_problems_status.get(
-                    "contest_problems", {}
-                )
-                if problem_id not in contest_problems_status:
-                    contest_problems_status[problem_id] = {
-                        "status": self.submission.result,
-                        "_id": self.problem._id,
-                    }
-                elif (
-                    contest_problems_status[problem_id]["status"]
-                    != JudgeStatus.ACCEPTED
-                ):
-                    contest_problems_status[problem_id][
-                        "status"
-                    ] = self.submission.result
-                else:
-                    # 如果已AC， 直接跳过 不计入任何计数器
-                    return
-                user_profile.acm_problems_status[
-                    "contest_problems"
-                ] = contest_problems_status
-                user_profile.save(update_fields=["acm_problems_status"])
-
-            elif self.contest.rule_type == ContestRuleType.OI:
-                contest_problems_status = user_profile.oi_problems_status.get(
-                    "contest_problems", {}
-                )
-                score = self.submission.statistic_info["score"]
-                if problem_id not in contest_problems_status:
-                    contest_problems_status[problem_id] = {
-                        "status": self.submission.result,
-                        "_id": self.problem._id,
-                        "score": score,
-                    }
-                else:
-                    contest_problems_status[problem_id]["score"] = score
-                    contest_problems_status[problem_id][
-                        "status"
-                    ] = self.submission.result
-                user_profile.oi_problems_status[
-                    "contest_problems"
-                ] = contest_problems_status
-                user_profile.save(update_fields=["oi_problems_status"])
-
-            problem = Problem.objects.select_for_update().get(
-                contest_id=self.contest_id, id=self.problem.id
-            )
-            result = str(self.submission.result)
-            problem_info = problem.statistic_info
-            problem_info[result] = problem_info.get(result, 0) + 1
-            problem.submission_number += 1
-            if self.submission.result == JudgeStatus.ACCEPTED:
-                problem.accepted_number += 1
-            problem.save(
-                update_fields=["submission_number", "accepted_number", "statistic_info"]
+                self.submission.save()
+            judge_queue.ack(self.submission.id)
+            result_notifier.publish(
+                ResultKind.SUBMISSION, self.submission.id, self.submission.result
             )
+            # 统计信息只记录增量, 由 flush_judge_statistics 定期写回数据库
+            judge_statistics.record(changes)
 
-    def update_contest_rank(self):
-        if self.contest.rule_type == ContestRuleType.OI or self.contest.real_time_rank:
-            cache.delete(f"{CacheKey.contest_rank_cache}:{self.contest.id}")
-
-        def get_rank(model):
-            return model.objects.select_for_update().get(
-                user_id=self.submission.user_id, contest=self.contest
-            )
-
-        if self.contest.rule_type == ContestRuleType.ACM:
-            model = ACMContestRank
-            func = self._update_acm_contest_rank
-        else:
-            model = OIContestRank
-            func = self._update_oi_contest_rank
-
-        try:
-            rank = get_rank(model)
-        except model.DoesNotExist:
-            try:
-                model.objects.create(
-                    user_id=self.submission.user_id, contest=self.contest
-                )
-                rank = get_rank(model)
-            except IntegrityError:
-                rank = get_rank(model)
-        func(rank)
-
-    def _update_acm_contest_rank(self, rank):
-        info = rank.submission_info.get(str(self.submission.problem_id))
-        # 因前面更改过，这里需要重新获取
-        problem = Problem.objects.select_for_update().get(
-            contest_id=self.contest_id, id=self.problem.id
-        )
-        # 此题提交过
-        if info:
-            if info["is_ac"]:
-                return
-
-            rank.submission_number += 1
-            if self.submission.result == JudgeStatus.ACCEPTED:
-                rank.accepted_number += 1
-                info["is_ac"] = True
-                info["ac_time"] = (
-                    self.submission.create_time - self.contest.start_time
-                ).total_seconds()
-                rank.total_time += info["ac_time"] + info["error_number"] * 20 * 60
-
-                if problem.accepted_number == 1:
-                    info["is_first_ac"] = True
-            elif self.submission.result != JudgeStatus.COMPILE_ERROR:
-                info["error_number"] += 1
-
-        # 第一次提交
-        else:
-            rank.submission_number += 1
-            info = {
-                "is_ac": False,
-                "ac_time": 0,
-                "error_number": 0,
-                "is_first_ac": False,
-            }
-            if self.submission.result == JudgeStatus.ACCEPTED:
-                rank.accepted_number += 1
-                info["is_ac"] = True
-                info["ac_time"] = (
-                    self.submission.create_time - self.contest.start_time
-                ).total_seconds()
-                rank.total_time += info["ac_time"]
-
-                if problem.accepted_number == 1:
-                    info["is_first_ac"] = True
-
-            elif self.submission.result != JudgeStatus.COMPILE_ERROR:
-                info["error_number"] = 1
-        rank.submission_info[str(self.submission.problem_id)] = info
-        rank.save()
-
-    def _update_oi_contest_rank(self, rank):
-        problem_id = str(self.submission.problem_id)
-        current_score = self.submission.statistic_info["score"]
-        last_score = rank.submission_info.get(problem_id)
-        if last_score:
-            rank.total_score = rank.total_score - last_score + current_score
-        else:
-            rank.total_score = rank.total_score + current_score
-        rank.submission_info[problem_id] = current_score
-        rank.save()
+        # 至此判题结束，尝试处理任务队列中剩余的任务
+        with self.timer.measure(JudgeStage.PENDING):
+            process_pending_task()
+        self.timer.flush()
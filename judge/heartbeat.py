@@ -0,0 +1,146 @@
+import logging
+import time
+from datetime import datetime
+
+from django.utils import timezone
+
+from conf.models import JudgeServer, HEARTBEAT_TIMEOUT
+from utils.cache import cache
+from utils.constants import CacheKey
+
+logger = logging.getLogger(__name__)
+
+# 这些字段只在 judge server 重新部署时变化, 变化时立即写入数据库
+STATIC_FIELDS = ("judger_version", "cpu_core", "service_url")
+# 每次心跳都会变化的字段, 只写 redis, 由 flush_judge_heartbeats 定期写回数据库
+LIVE_FIELDS = ("cpu_usage", "memory_usage", "ip", "last_heartbeat")
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class JudgeHeartbeatStore:
+    """
+    judge server 心跳数据的热存储。每台服务器一个 redis hash, 另有一个按最后心跳时间排序的 zset,
+    心跳请求在正常情况下不访问数据库, judge_server 表中的数据最多落后一个写回周期。
+    """
+
+    @staticmethod
+    def _key(hostname):
+        return f"{CacheKey.judge_heartbeat}:{hostname}"
+
+    def beat(self, hostname, data, ip, remote_addr=None):
+        """
+        :param data: 心跳中的 judger_version, cpu_core, service_url, cpu_usage, memory_usage
+        :param ip: request.ip
+        :param remote_addr: REMOTE_ADDR, 第一次注册的服务器记录这个地址
+        :return: (server_id, 是否为新上线、恢复心跳或重新部署的服务器)
+        """
+        now = time.time()
+        old = {
+            _decode(k): _decode(v)
+            for k, v in cache.hgetall(self._key(hostname)).items()
+        }
+        changed = not old or any(
+            str(data[field]) != old.get(field) for field in STATIC_FIELDS
+        )
+        if changed:
+            # 第一次收到心跳或者重新部署时才访问数据库
+            server, created = JudgeServer.objects.update_or_create(
+                hostname=hostname,
+                defaults={**data, "ip": ip, "last_heartbeat": timezone.now()},
+            )
+            if created and remote_addr and remote_addr != ip:
+                ip = remote_addr
+                JudgeServer.objects.filter(id=server.id).update(ip=ip)
+            server_id = server.id
+        else:
+            server_id = int(old["id"])
+
+        pipe = cache.pipeline(transaction=False)
+        pipe.hset(
+            self._key(hostname),
+            mapping={**data, "id": server_id, "ip": ip, "last_heartbeat": now},
+        )
+        pipe.zadd(CacheKey.judge_heartbeat_active, {hostname: now})
+        pipe.execute()
+        online = changed or now - float(old["last_heartbeat"]) > HEARTBEAT_TIMEOUT
+        return server_id, online
+
+    def load(self, hostnames):
+        """
+        :return: {hostname: 心跳数据}, 没有心跳数据的服务器不在其中
+        """
+        pipe = cache.pipeline(transaction=False)
+        for hostname in hostnames:
+            pipe.hgetall(self._key(hostname))
+        result = {}
+        for hostname, data in zip(hostnames, pipe.execute()):
+            if not data:
+                continue
+            data = {_decode(k): _decode(v) for k, v in data.items()}
+            result[hostname] = {
+                "id": int(data["id"]),
+                "judger_version": data["judger_version"],
+                "cpu_core": int(data["cpu_core"]),
+                "service_url": data["service_url"],
+                "cpu_usage": float(data["cpu_usage"]),
+                "memory_usage": float(data["memory_usage"]),
+                "ip": data["ip"],
+                "last_heartbeat": datetime.fromtimestamp(
+                    float(data["last_heartbeat"]), tz=timezone.utc
+                ),
+            }
+        return result
+
+    def apply(self, servers):
+        """
+        用 redis 中的心跳数据覆盖 JudgeServer 对象上可能过期的字段
+        """
+        servers = list(servers)
+        live = self.load([server.hostname for server in servers])
+        for server in servers:
+            data = live.get(server.hostname)
+            if (
+                data
+                and data["id"] == server.id
+                and data["last_heartbeat"] > server.last_heartbeat
+            ):
+                for field in STATIC_FIELDS + LIVE_FIELDS:
+                    setattr(server, field, data[field])
+        return servers
+
+    def flush(self):
+        """
+        把心跳数据写回数据库
+        :return: 更新的服务器数
+        """
+        hostnames = [
+            _decode(hostname)
+            for hostname in cache.zrange(CacheKey.judge_heartbeat_active, 0, -1)
+        ]
+        if not hostnames:
+            return 0
+        servers = self.apply(JudgeServer.objects.filter(hostname__in=hostnames))
+        JudgeServer.objects.bulk_update(servers, LIVE_FIELDS)
+        return len(servers)
+
+    def alive(self, since):
+        """
+        :param since: 时间戳
+        :return: 在这之后有心跳的 hostname
+        """
+        return [
+            _decode(hostname)
+            for hostname in cache.zrangebyscore(
+                CacheKey.judge_heartbeat_active, since, "+inf"
+            )
+        ]
+
+    def remove(self, hostname):
+        cache.delete(self._key(hostname))
+        cache.zrem(CacheKey.judge_heartbeat_active, hostname)
+
+
+heartbeat_store = JudgeHeartbeatStore()
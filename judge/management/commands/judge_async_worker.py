@@ -0,0 +1,59 @@
+import asyncio
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from judge.async_worker import FLUSH_INTERVAL, AsyncJudgeWorker
+from judge.dispatcher import JudgeDispatchMode
+
+
+class Command(BaseCommand):
+    help = "Consume the judge queue with asyncio, used when JUDGE_DISPATCH_MODE is async or batch"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency", type=int, default=1000, help="max in-flight judge requests"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=None,
+            help="max submissions per judge request, defaults to JUDGE_BATCH_SIZE in batch mode and 1 otherwise",
+        )
+        parser.add_argument(
+            "--flush-interval",
+            type=float,
+            default=FLUSH_INTERVAL,
+            help="seconds between batched result writes",
+        )
+
+    def handle(self, *args, **options):
+        mode = settings.JUDGE_DISPATCH_MODE
+        if mode not in (JudgeDispatchMode.ASYNC, JudgeDispatchMode.BATCH):
+            self.stdout.write(
+                self.style.ERROR(
+                    "JUDGE_DISPATCH_MODE must be async or batch to run this worker"
+                )
+            )
+            exit(1)
+
+        batch_size = options["batch_size"]
+        if batch_size is None:
+            batch_size = (
+                settings.JUDGE_BATCH_SIZE if mode == JudgeDispatchMode.BATCH else 1
+            )
+        worker = AsyncJudgeWorker(
+            concurrency=options["concurrency"],
+            flush_interval=options["flush_interval"],
+            batch_size=batch_size,
+        )
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, worker.stop)
+        self.stdout.write(self.style.SUCCESS("Async judge worker started"))
+        try:
+            loop.run_until_complete(worker.run())
+        finally:
+            loop.close()
@@ -0,0 +1,116 @@
+import asyncio
+import time
+from urllib.parse import urljoin
+
+import aiohttp
+from django.core.management.base import BaseCommand
+
+from judge.mock_server import start_mock_server
+
+
+def payload(i):
+    # 和 JudgeDispatcher.build_payload 生成的数据大小相近
+    return {
+        "language_config": {
+            "compile": {"src_name": "main.c"},
+            "run": {"command": "{exe_path}"},
+        },
+        "src": f"// submission {i}\n" + "int main() { return 0; }\n" * 40,
+        "max_cpu_time": 1000,
+        "max_memory": 256 * 1024 * 1024,
+        "test_case_id": "benchmark",
+        "output": False,
+        "spj_version": None,
+        "spj_config": None,
+        "spj_compile_config": None,
+        "spj_src": None,
+        "io_mode": {
+            "io_mode": "Standard IO",
+            "input": "input.txt",
+            "output": "output.txt",
+        },
+    }
+
+
+async def run(url, submissions, batch_size, concurrency):
+    """
+    :return: (耗时, 请求数, 成功的提交数)
+    """
+    tasks = [payload(i) for i in range(submissions)]
+    batches = []
+    for start in range(0, submissions, batch_size):
+        end = start + batch_size
+        batches.append(tasks[start:end])
+    # 同时进行的提交数相同, 只比较请求的粒度
+    semaphore = asyncio.Semaphore(max(concurrency // batch_size, 1))
+    done = 0
+
+    async def send(session, batch):
+        nonlocal done
+        async with semaphore:
+            if batch_size == 1:
+                async with session.post(urljoin(url, "/judge"), json=batch[0]) as resp:
+                    results = [await resp.json()]
+            else:
+                async with session.post(
+                    urljoin(url, "/judge_batch"),
+                    json={"service_url": url, "timeout": 60, "tasks": batch},
+                ) as resp:
+                    results = (await resp.json())["data"]
+        done += sum(1 for result in results if result and not result["err"])
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.time()
+        await asyncio.gather(*[send(session, batch) for batch in batches])
+        return time.time() - start, len(batches), done
+
+
+class Command(BaseCommand):
+    help = "Compare judge throughput of single and batched requests against a mock judge server"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url",
+            type=str,
+            default=None,
+            help="judge server or judge_callback_proxy url, a mock judge server is started if omitted",
+        )
+        parser.add_argument("--submissions", type=int, default=2000)
+        parser.add_argument("--batch-sizes", type=str, default="1,5,20,50")
+        parser.add_argument(
+            "--concurrency", type=int, default=64, help="submissions in flight"
+        )
+        parser.add_argument(
+            "--work",
+            type=float,
+            default=0.001,
+            help="judge seconds per submission of the mock server",
+        )
+        parser.add_argument(
+            "--cpu-core", type=int, default=64, help="cpu cores of the mock server"
+        )
+
+    def handle(self, *args, **options):
+        server = None
+        url = options["url"]
+        if not url:
+            server = start_mock_server(
+                work=options["work"], cpu_core=options["cpu_core"]
+            )
+            url = server.url
+        try:
+            self.stdout.write(
+                f"{'batch':>6}{'requests':>10}{'done':>8}{'seconds':>10}{'subs/s':>10}"
+            )
+            for batch_size in map(int, options["batch_sizes"].split(",")):
+                cost, requests, done = asyncio.run(
+                    run(url, options["submissions"], batch_size, options["concurrency"])
+                )
+                self.stdout.write(
+                    f"{batch_size:>6}{requests:>10}{done:>8}{cost:>10.2f}{done / cost:>10.1f}"
+                )
+        finally:
+            if server:
+                server.shutdown()
+                server.server_close()
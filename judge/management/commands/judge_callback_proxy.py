@@ -0,0 +1,128 @@
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.core.management.base import BaseCommand
+
+from conf.views import judge_server_token_matches
+from judge.client import get_client
+
+logger = logging.getLogger(__name__)
+
+# 回调失败时的重试次数, 全部失败后由 recover_judge_tasks 在租约到期后重新判题
+CALLBACK_RETRIES = 3
+
+
+def forward(job, token):
+    """
+    同步调用 judge server, 然后把结果回调给 OJ
+    """
+    headers = {"X-Judge-Server-Token": token}
+    try:
+        result = get_client(job["service_url"]).post(
+            "/judge", data=job["data"], headers=headers, timeout=job["timeout"]
+        )
+    except Exception as e:
+        logger.exception(e)
+        result = None
+    data = {"submission_id": job["submission_id"], "result": result}
+    for i in range(CALLBACK_RETRIES):
+        try:
+            requests.post(
+                job["callback_url"], json=data, headers=headers, timeout=30
+            ).raise_for_status()
+            return
+        except Exception as e:
+            logger.warning(f"Callback of submission {job['submission_id']} failed: {e}")
+            time.sleep(2**i)
+
+
+def judge_batch(batch, token, executor):
+    """
+    并发调用 judge server 的 /judge, 按顺序返回结果, 失败的为 None
+    """
+    headers = {"X-Judge-Server-Token": token}
+    client = get_client(batch["service_url"])
+
+    def judge(data):
+        try:
+            return client.post(
+                "/judge", data=data, headers=headers, timeout=batch["timeout"]
+            )
+        except Exception as e:
+            logger.exception(e)
+
+    return list(executor.map(judge, batch["tasks"]))
+
+
+class JudgeProxyHandler(BaseHTTPRequestHandler):
+    """
+    只接受带有正确 X-Judge-Server-Token 的请求, 和 JudgeServerHeartbeatAPI 的校验方式相同
+    """
+
+    def respond(self, status, body):
+        body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        path = self.path.rstrip("/")
+        if path not in ("/judge_async", "/judge_batch"):
+            self.send_error(404)
+            return
+        token = self.headers.get("X-Judge-Server-Token")
+        if not judge_server_token_matches(token):
+            self.respond(403, {"err": "InvalidToken", "data": "Invalid token"})
+            return
+        executor = self.server.executor
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length))
+            if path == "/judge_batch":
+                # 同步等待整批结果
+                body = {"err": None, "data": judge_batch(job, token, executor)}
+            else:
+                executor.submit(forward, job, token)
+                body = {"err": None, "data": "accepted"}
+        except Exception as e:
+            body = {"err": "InvalidRequest", "data": str(e)}
+        self.respond(200, body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host, port, executor):
+    server = ThreadingHTTPServer((host, port), JudgeProxyHandler)
+    server.executor = executor
+    return server
+
+
+class Command(BaseCommand):
+    help = "Forward judge jobs for judge servers without callback or batch support"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", type=str, default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8090)
+        parser.add_argument(
+            "--workers", type=int, default=256, help="max concurrent judge requests"
+        )
+
+    def handle(self, *args, **options):
+        executor = ThreadPoolExecutor(max_workers=options["workers"])
+        server = make_server(options["host"], options["port"], executor)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Judge callback proxy listening on {options['host']}:{options['port']}"
+            )
+        )
+        try:
+            server.serve_forever()
+        finally:
+            executor.shutdown(wait=False)
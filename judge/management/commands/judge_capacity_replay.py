@@ -0,0 +1,181 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from judge.allocator import time_limit_exceeded
+from judge.client import judge_timeout
+from judge.policies import get_policy
+from judge.scheduler import JudgeTaskClass
+from judge.simulator import Simulation, SimulatedServer, estimate_work
+from submission.models import Submission
+
+
+def load_jobs(submissions, time_scale=1.0, compile_cost=0.5, default_work=1.0):
+    """
+    把历史提交转换为 Simulation.replay 的输入, 到达时间从第一个提交开始计算
+    :param time_scale: 大于 1 时按比例压缩提交间隔, 模拟更密集的提交
+    """
+    rows = (
+        submissions.order_by("create_time")
+        .values_list(
+            "create_time",
+            "problem__test_case_id",
+            "problem__time_limit",
+            "problem__test_case_score",
+            "user_id",
+            "contest_id",
+            "info",
+            "exec_time",
+        )
+        .iterator(chunk_size=2000)
+    )
+    jobs = []
+    start = None
+    for (
+        create_time,
+        test_case_id,
+        time_limit,
+        test_case_score,
+        user_id,
+        contest_id,
+        info,
+        exec_time,
+    ) in rows:
+        start = start or create_time
+        jobs.append(
+            (
+                (create_time - start).total_seconds() / time_scale,
+                estimate_work(info, exec_time, compile_cost, default_work),
+                test_case_id,
+                JudgeTaskClass.CONTEST if contest_id else JudgeTaskClass.PRACTICE,
+                user_id,
+                judge_timeout(time_limit, len(test_case_score or [])),
+                time_limit_exceeded(info),
+            )
+        )
+    return jobs
+
+
+class Command(BaseCommand):
+    help = "Replay historical submissions against simulated judge fleets to predict queue wait and feedback latency"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--contest-id", type=int, default=None)
+        parser.add_argument("--problem-id", type=int, default=None)
+        parser.add_argument(
+            "--start", type=str, default=None, help="ISO datetime, inclusive"
+        )
+        parser.add_argument(
+            "--end", type=str, default=None, help="ISO datetime, exclusive"
+        )
+        parser.add_argument(
+            "--servers",
+            type=str,
+            default="1,2,4,8",
+            help="comma separated fleet sizes to simulate",
+        )
+        parser.add_argument("--cpu-core", type=int, default=4)
+        parser.add_argument(
+            "--speed",
+            type=float,
+            default=1.0,
+            help="speed of the simulated servers relative to the ones that judged the history",
+        )
+        parser.add_argument(
+            "--policy",
+            type=str,
+            default=None,
+            help="selection policy, defaults to JUDGE_SELECTION_POLICY",
+        )
+        parser.add_argument(
+            "--time-scale",
+            type=float,
+            default=1.0,
+            help="compress submission intervals by this factor",
+        )
+        parser.add_argument(
+            "--compile-cost",
+            type=float,
+            default=0.5,
+            help="compile seconds per submission",
+        )
+        parser.add_argument(
+            "--default-work",
+            type=float,
+            default=1.0,
+            help="judge seconds of submissions without timing info",
+        )
+        parser.add_argument(
+            "--target-p95",
+            type=float,
+            default=None,
+            help="report the smallest fleet whose p95 feedback latency is within this many seconds",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        submissions = Submission.objects.all()
+        if options["contest_id"]:
+            submissions = submissions.filter(contest_id=options["contest_id"])
+        if options["problem_id"]:
+            submissions = submissions.filter(problem_id=options["problem_id"])
+        for name, lookup in (("start", "create_time__gte"), ("end", "create_time__lt")):
+            if options[name]:
+                value = parse_datetime(options[name])
+                if not value:
+                    raise CommandError(f"Invalid --{name} {options[name]}")
+                submissions = submissions.filter(**{lookup: value})
+        try:
+            policy = get_policy(options["policy"] or settings.JUDGE_SELECTION_POLICY)
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options["time_scale"] <= 0:
+            raise CommandError("--time-scale must be positive")
+
+        jobs = load_jobs(
+            submissions,
+            options["time_scale"],
+            options["compile_cost"],
+            options["default_work"],
+        )
+        if not jobs:
+            raise CommandError("No submissions matched")
+        span = jobs[-1][0]
+        self.stdout.write(
+            f"{len(jobs)} submissions over {span:.0f}s, {len(jobs) / max(span, 1):.2f}/s, "
+            f"mean work {sum(job[1] for job in jobs) / len(jobs):.2f}s"
+        )
+
+        header = f"{'servers':>8}{'cores':>7}{'done':>8}{'errors':>8}{'retries':>8}{'tput/s':>9}{'wait50':>9}{'wait95':>9}{'wait99':>9}{'p50':>8}{'p95':>8}{'p99':>8}{'max_q':>8}"
+        self.stdout.write(header)
+        recommended = None
+        for count in sorted(map(int, options["servers"].split(","))):
+            servers = [
+                SimulatedServer(i + 1, options["cpu_core"], speed=options["speed"])
+                for i in range(count)
+            ]
+            result = Simulation(servers, policy, seed=options["seed"]).replay(jobs)
+            self.stdout.write(
+                f"{count:>8}{count * options['cpu_core']:>7}{result['completed']:>8}{result['errors']:>8}{result['retries']:>8}"
+                f"{result['throughput']:>9.2f}{result['wait_p50']:>9.2f}{result['wait_p95']:>9.2f}{result['wait_p99']:>9.2f}"
+                f"{result['p50']:>8.2f}{result['p95']:>8.2f}{result['p99']:>8.2f}{result['max_queue_length']:>8}"
+            )
+            if (
+                options["target_p95"] is not None
+                and recommended is None
+                and result["p95"] <= options["target_p95"]
+            ):
+                recommended = count
+        if options["target_p95"] is not None:
+            if recommended:
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f"{recommended} servers keep p95 feedback latency within {options['target_p95']}s"
+                    )
+                )
+            else:
+                self.stdout.write(
+                    self.style.WARNING(
+                        f"None of the simulated fleets keeps p95 feedback latency within {options['target_p95']}s"
+                    )
+                )
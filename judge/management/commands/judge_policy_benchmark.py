@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+
+from judge.policies import POLICIES
+from judge.simulator import Simulation, SimulatedServer
+
+
+def default_cluster():
+    # 配置不一的集群: 其中一台明显偏慢, 一台偶尔出错
+    return [
+        SimulatedServer(1, cpu_core=8, speed=1.0),
+        SimulatedServer(2, cpu_core=8, speed=0.4),
+        SimulatedServer(3, cpu_core=4, speed=1.0, error_rate=0.05),
+        SimulatedServer(4, cpu_core=4, speed=1.5),
+    ]
+
+
+class Command(BaseCommand):
+    help = "Compare judge server selection policies in a simulated cluster"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rate", type=float, default=12, help="submissions per second"
+        )
+        parser.add_argument(
+            "--duration", type=float, default=600, help="simulated seconds"
+        )
+        parser.add_argument(
+            "--work", type=float, default=1.0, help="mean judge seconds per submission"
+        )
+        parser.add_argument(
+            "--problems", type=int, default=50, help="distinct problems submitted to"
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        header = f"{'policy':<14}{'limit':<10}{'done':>8}{'errors':>8}{'retries':>8}{'cold':>8}{'tput/s':>9}{'mean':>8}{'p50':>8}{'p95':>8}{'p99':>8}{'max_q':>8}"
+        self.stdout.write(header)
+        for name, policy in POLICIES.items():
+            for adaptive in (False, True):
+                result = Simulation(
+                    default_cluster(), policy, adaptive=adaptive, seed=options["seed"]
+                ).run(
+                    options["rate"],
+                    options["duration"],
+                    options["work"],
+                    options["problems"],
+                )
+                self.stdout.write(
+                    f"{name:<14}{'aimd' if adaptive else 'fixed':<10}"
+                    f"{result['completed']:>8}{result['errors']:>8}{result['retries']:>8}{result['cold_starts']:>8}{result['throughput']:>9.2f}"
+                    f"{result['mean']:>8.2f}{result['p50']:>8.2f}{result['p95']:>8.2f}{result['p99']:>8.2f}"
+                    f"{result['max_queue_length']:>8}"
+                )
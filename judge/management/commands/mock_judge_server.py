@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand
+
+from judge.mock_server import LatencyDistribution, MockHeartbeatClient, MockJudgeServer
+
+
+class Command(BaseCommand):
+    help = "Run a stand-in judge server that accepts /judge, /judge_batch, /compile_spj and /compile_run without running code"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", type=str, default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8081)
+        parser.add_argument(
+            "--work", type=float, default=0.01, help="mean judge seconds per submission"
+        )
+        parser.add_argument(
+            "--distribution",
+            type=str,
+            default=LatencyDistribution.CONSTANT,
+            choices=(
+                LatencyDistribution.CONSTANT,
+                LatencyDistribution.UNIFORM,
+                LatencyDistribution.EXPONENTIAL,
+                LatencyDistribution.LOGNORMAL,
+            ),
+        )
+        parser.add_argument(
+            "--sigma", type=float, default=1.0, help="sigma of the lognormal latency"
+        )
+        parser.add_argument(
+            "--failure-rate",
+            type=float,
+            default=0.0,
+            help="fraction of requests answered with 500",
+        )
+        parser.add_argument("--cpu-core", type=int, default=4)
+        parser.add_argument("--seed", type=int, default=None)
+        parser.add_argument(
+            "--backend-url",
+            type=str,
+            default=None,
+            help="send heartbeats to this backend, e.g. http://127.0.0.1:8000",
+        )
+        parser.add_argument(
+            "--token", type=str, default="", help="judge server token of the backend"
+        )
+        parser.add_argument("--hostname", type=str, default=None)
+        parser.add_argument("--heartbeat-interval", type=float, default=5)
+
+    def handle(self, *args, **options):
+        server = MockJudgeServer(
+            (options["host"], options["port"]),
+            work=options["work"],
+            cpu_core=options["cpu_core"],
+            distribution=options["distribution"],
+            sigma=options["sigma"],
+            failure_rate=options["failure_rate"],
+            seed=options["seed"],
+        )
+        heartbeat = None
+        if options["backend_url"]:
+            heartbeat = MockHeartbeatClient(
+                server,
+                options["backend_url"],
+                options["token"],
+                hostname=options["hostname"],
+                interval=options["heartbeat_interval"],
+            ).start()
+        self.stdout.write(
+            self.style.SUCCESS(f"Mock judge server listening on {server.url}")
+        )
+        try:
+            server.serve_forever()
+        finally:
+            if heartbeat:
+                heartbeat.stop()
+            server.server_close()
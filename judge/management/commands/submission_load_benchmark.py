@@ -0,0 +1,335 @@
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from celery import current_app
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from account.models import User, UserProfile
+from conf.models import JudgeServer
+from judge.allocator import slot_allocator
+from judge.heartbeat import heartbeat_store
+from judge.mock_server import LatencyDistribution, start_mock_server
+from judge.scheduler import judge_queue
+from judge.simulator import percentile
+from problem.models import Problem
+from submission.models import JudgeStatus, Submission
+from submission.views.oj import SubmissionAPI
+
+# 每次查询判题是否完成的提交数
+POLL_CHUNK_SIZE = 500
+
+
+class SubmissionLoadBenchmark:
+    """
+    按固定速率调用 SubmissionAPI.post（开环, 不等待前一个返回）, 轮询数据库得到每个提交判完的时间。
+    判题由正在运行的 celery worker 或 judge_async_worker 完成, eager 模式下在请求中直接判题
+    """
+
+    def __init__(
+        self,
+        problem,
+        users,
+        language,
+        code,
+        rate,
+        duration,
+        concurrency=16,
+        poll_interval=0.05,
+        report_interval=1,
+        throttle=False,
+        on_sample=None,
+    ):
+        self.problem = problem
+        self.users = users
+        self.language = language
+        self.code = code
+        self.rate = rate
+        self.duration = duration
+        self.poll_interval = poll_interval
+        self.report_interval = report_interval
+        self.throttle = throttle
+        self.on_sample = on_sample
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="submit"
+        )
+        self.view = SubmissionAPI.as_view()
+        self.factory = RequestFactory()
+        # {submission_id: 发出请求的时间}
+        self.pending = {}
+        self.completed = []
+        self.latencies = []
+        self.request_latencies = []
+        self.queries = []
+        self.errors = Counter()
+        self.submitted = 0
+        self.timeline = []
+
+    def submit(self, index):
+        body = {
+            "problem_id": self.problem.id,
+            "language": self.language,
+            "code": f"// {index}\n{self.code}",
+        }
+        if self.problem.contest_id:
+            body["contest_id"] = self.problem.contest_id
+        request = self.factory.post(
+            "/api/submission", data=json.dumps(body), content_type="application/json"
+        )
+        request.user = self.users[index % len(self.users)]
+        request.session = {"ip": "127.0.0.1"}
+        if not self.throttle:
+            # 和 open api 一样跳过按用户的限流
+            request.auth_method = "api_key"
+        sent = time.time()
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.view(request)
+        self.request_latencies.append(time.time() - sent)
+        self.queries.append(len(queries))
+        data = json.loads(resp.content)
+        if data["error"]:
+            self.errors[data["error"]] += 1
+            return
+        self.pending[data["data"]["submission_id"]] = sent
+
+    def poll(self):
+        now = time.time()
+        ids = list(self.pending)
+        for start in range(0, len(ids), POLL_CHUNK_SIZE):
+            end = start + POLL_CHUNK_SIZE
+            done = Submission.objects.filter(
+                id__in=ids[start:end], is_judging=False
+            ).values_list("id", flat=True)
+            for submission_id in done:
+                self.latencies.append(now - self.pending.pop(submission_id))
+                self.completed.append(submission_id)
+
+    def sample(self, elapsed):
+        row = {
+            "time": elapsed,
+            "submitted": self.submitted,
+            "completed": len(self.latencies),
+            "judging": len(self.pending),
+            "queue": judge_queue.depth(),
+        }
+        self.timeline.append(row)
+        if self.on_sample:
+            self.on_sample(row)
+
+    def run(self, drain_timeout=60):
+        start = time.time()
+        next_poll = next_sample = start
+        futures = []
+        while True:
+            now = time.time()
+            elapsed = now - start
+            if elapsed < self.duration:
+                due = min(int(elapsed * self.rate) + 1, int(self.duration * self.rate))
+                while self.submitted < due:
+                    futures.append(self.executor.submit(self.submit, self.submitted))
+                    self.submitted += 1
+            elif all(future.done() for future in futures) and (
+                not self.pending or elapsed > self.duration + drain_timeout
+            ):
+                break
+            if now >= next_poll:
+                self.poll()
+                next_poll = now + self.poll_interval
+            if now >= next_sample:
+                self.sample(elapsed)
+                next_sample = now + self.report_interval
+            wake = min(next_poll, next_sample)
+            if elapsed < self.duration:
+                wake = min(wake, start + self.submitted / self.rate)
+            time.sleep(max(wake - time.time(), 0))
+        for future in futures:
+            # 抛出请求中的异常
+            future.result()
+        self.executor.shutdown()
+        self.sample(time.time() - start)
+        return self.report(time.time() - start)
+
+    def report(self, elapsed):
+        results = Counter()
+        for start in range(0, len(self.completed), POLL_CHUNK_SIZE):
+            end = start + POLL_CHUNK_SIZE
+            results.update(
+                Submission.objects.filter(id__in=self.completed[start:end]).values_list(
+                    "result", flat=True
+                )
+            )
+        return {
+            "elapsed": elapsed,
+            "submitted": self.submitted,
+            "rejected": dict(self.errors),
+            "completed": len(self.latencies),
+            "unfinished": len(self.pending),
+            "system_error": results[JudgeStatus.SYSTEM_ERROR],
+            "throughput": len(self.latencies) / elapsed if elapsed else 0,
+            "latency": {p: percentile(self.latencies, p) for p in (50, 95, 99, 100)},
+            "request_latency": {
+                p: percentile(self.request_latencies, p) for p in (50, 95, 99, 100)
+            },
+            "queries": {
+                "mean": sum(self.queries) / len(self.queries) if self.queries else 0,
+                "p95": percentile(self.queries, 95),
+                "max": max(self.queries, default=0),
+            },
+            "timeline": self.timeline,
+        }
+
+
+class Command(BaseCommand):
+    help = "Drive SubmissionAPI at a fixed rate and report end-to-end judge latency, throughput, queue depth and DB queries"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--problem-id", type=int, required=True)
+        parser.add_argument("--language", type=str, default="C")
+        parser.add_argument("--code", type=str, default="int main() { return 0; }")
+        parser.add_argument(
+            "--users", type=int, default=20, help="submit as users benchmark_0..N-1"
+        )
+        parser.add_argument(
+            "--rate", type=float, default=10, help="submissions per second"
+        )
+        parser.add_argument(
+            "--duration", type=float, default=30, help="seconds to keep submitting"
+        )
+        parser.add_argument(
+            "--drain-timeout",
+            type=float,
+            default=60,
+            help="seconds to wait for judging after the last submission",
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=16, help="requests in flight"
+        )
+        parser.add_argument("--report-interval", type=float, default=1)
+        parser.add_argument(
+            "--throttle",
+            action="store_true",
+            help="apply the per-user submission throttling",
+        )
+        parser.add_argument(
+            "--eager",
+            action="store_true",
+            help="judge inside the request instead of a celery worker, DB queries then include judging",
+        )
+        parser.add_argument(
+            "--mock-servers",
+            type=int,
+            default=0,
+            help="start and register this many mock judge servers in process",
+        )
+        parser.add_argument(
+            "--work",
+            type=float,
+            default=0.05,
+            help="mean judge seconds of the mock servers",
+        )
+        parser.add_argument(
+            "--distribution",
+            type=str,
+            default=LatencyDistribution.EXPONENTIAL,
+            help="latency distribution of the mock servers",
+        )
+        parser.add_argument("--failure-rate", type=float, default=0.0)
+        parser.add_argument("--cpu-core", type=int, default=4)
+
+    def register(self, servers):
+        for server in servers:
+            heartbeat_store.beat(
+                f"benchmark-{server.server_address[1]}",
+                {
+                    "judger_version": "mock",
+                    "cpu_core": server.cpu_core,
+                    "service_url": server.url,
+                    "cpu_usage": 0,
+                    "memory_usage": 0,
+                },
+                "127.0.0.1",
+            )
+
+    def handle(self, *args, **options):
+        if options["rate"] <= 0:
+            raise CommandError("--rate must be positive")
+        try:
+            problem = Problem.objects.get(id=options["problem_id"])
+        except Problem.DoesNotExist:
+            raise CommandError("Problem does not exist")
+        users = []
+        for i in range(options["users"]):
+            user, created = User.objects.get_or_create(username=f"benchmark_{i}")
+            if created:
+                UserProfile.objects.create(user=user)
+            users.append(user)
+        if options["eager"]:
+            current_app.conf.update(CELERY_TASK_ALWAYS_EAGER=True)
+
+        servers = [
+            start_mock_server(
+                work=options["work"],
+                cpu_core=options["cpu_core"],
+                distribution=options["distribution"],
+                failure_rate=options["failure_rate"],
+                seed=i,
+            )
+            for i in range(options["mock_servers"])
+        ]
+        self.register(servers)
+        slot_allocator.refresh(force=True)
+
+        def on_sample(row):
+            # 保持 mock server 在线
+            self.register(servers)
+            queue = " ".join(f"{k}={v}" for k, v in row["queue"].items())
+            self.stdout.write(
+                f"{row['time']:>7.1f}s submitted={row['submitted']} completed={row['completed']} "
+                f"judging={row['judging']} queue[{queue}]"
+            )
+
+        benchmark = SubmissionLoadBenchmark(
+            problem,
+            users,
+            options["language"],
+            options["code"],
+            options["rate"],
+            options["duration"],
+            concurrency=options["concurrency"],
+            report_interval=options["report_interval"],
+            throttle=options["throttle"],
+            on_sample=on_sample,
+        )
+        try:
+            result = benchmark.run(drain_timeout=options["drain_timeout"])
+        finally:
+            for server in servers:
+                hostname = f"benchmark-{server.server_address[1]}"
+                JudgeServer.objects.filter(hostname=hostname).delete()
+                heartbeat_store.remove(hostname)
+                server.shutdown()
+                server.server_close()
+            slot_allocator.refresh(force=True)
+
+        latency, request_latency = result["latency"], result["request_latency"]
+        self.stdout.write(
+            f"submitted={result['submitted']} completed={result['completed']} unfinished={result['unfinished']} "
+            f"system_error={result['system_error']} rejected={result['rejected']}"
+        )
+        self.stdout.write(
+            f"throughput={result['throughput']:.2f}/s over {result['elapsed']:.1f}s"
+        )
+        self.stdout.write(
+            f"end-to-end latency  p50={latency[50]:.3f}s p95={latency[95]:.3f}s p99={latency[99]:.3f}s max={latency[100]:.3f}s"
+        )
+        self.stdout.write(
+            f"submit request      p50={request_latency[50]:.3f}s p95={request_latency[95]:.3f}s "
+            f"p99={request_latency[99]:.3f}s max={request_latency[100]:.3f}s"
+        )
+        self.stdout.write(
+            f"db queries/request  mean={result['queries']['mean']:.1f} p95={result['queries']['p95']} max={result['queries']['max']}"
+        )
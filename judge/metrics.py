@@ -0,0 +1,208 @@
+import logging
+import math
+import time
+from contextlib import contextmanager
+
+from utils.cache import cache
+from utils.constants import CacheKey
+
+logger = logging.getLogger(__name__)
+
+# 每个时间片的长度（秒）, 直方图按时间片分别累计, 查询时合并最近的若干个
+SLOT_SECONDS = 60
+# 时间片保留的时间（秒）
+RETENTION = 3600
+# 默认统计最近多少秒
+DEFAULT_WINDOW = 300
+# 桶的上界按 BUCKET_BASE 的倍数递增, 从 1ms 到约 10 分钟, 估计分位数的相对误差不超过 25%
+BUCKET_START = 0.001
+BUCKET_BASE = 1.25
+BUCKET_COUNT = 60
+BUCKETS = [BUCKET_START * BUCKET_BASE**i for i in range(BUCKET_COUNT)]
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class JudgeStage:
+    # 从放入队列（或直接调用 celery 任务）到 worker 开始处理
+    QUEUE_WAIT = "queue_wait"
+    # 读取 Submission/CompileRun 和题目
+    FETCH = "fetch"
+    # 选择服务器、获取名额并登记租约
+    ACQUIRE = "acquire"
+    # 请求 judge server 的时间
+    JUDGE = "judge"
+    # 保存结果、记录统计信息
+    SAVE = "save"
+    # 判题结束后调用 process_pending_task
+    PENDING = "pending"
+
+
+def _bucket(seconds):
+    if seconds <= BUCKET_START:
+        return 0
+    index = math.ceil(math.log(seconds / BUCKET_START, BUCKET_BASE) - 1e-9)
+    return min(index, BUCKET_COUNT)
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class StageTimer:
+    """
+    记录一次判题或自定义输入运行中各个阶段的耗时, flush 时用一个 pipeline 写入 judge_metrics
+    """
+
+    def __init__(self, lane):
+        self.lane = lane
+        # 判题的服务器, 选定之前的阶段也记在这台服务器下
+        self.server = None
+        self.timings = []
+
+    def add(self, stage, seconds):
+        self.timings.append((stage, max(seconds, 0)))
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def flush(self):
+        if not self.timings:
+            return
+        timings, self.timings = self.timings, []
+        try:
+            judge_metrics.observe_many(self.lane, self.server, timings)
+        except Exception as e:
+            # 统计失败不影响判题
+            logger.exception(e)
+
+
+class JudgeMetrics:
+    """
+    判题各阶段耗时的直方图, 保存在 redis 中, 所有 worker 共享。
+
+    {prefix}:{时间片} 为 hash, 字段 "{lane}|{stage}|{server}|{桶}" 为落在该桶中的次数,
+    {prefix}:total 为 hash, 字段 "{lane}|{stage}|{server}|count" 和 "|sum" 为累计的次数和总耗时
+    """
+
+    prefix = CacheKey.judge_metrics
+
+    def observe_many(self, lane, server, timings, now=None):
+        """
+        :param timings: [(stage, 秒), ...]
+        """
+        slot = int((now or time.time()) // SLOT_SECONDS)
+        slot_key = f"{self.prefix}:{slot}"
+        total_key = f"{self.prefix}:total"
+        pipe = cache.pipeline()
+        for stage, seconds in timings:
+            series = f"{lane}|{stage}|{server or '-'}"
+            pipe.hincrby(slot_key, f"{series}|{_bucket(seconds)}", 1)
+            pipe.hincrby(total_key, f"{series}|count", 1)
+            pipe.hincrbyfloat(total_key, f"{series}|sum", seconds)
+        pipe.expire(slot_key, RETENTION + SLOT_SECONDS)
+        pipe.execute()
+
+    def histograms(self, window=DEFAULT_WINDOW, now=None):
+        """
+        :return: {(lane, stage, server): [每个桶的次数, 最后一个为超出上界的]}
+        """
+        current = int((now or time.time()) // SLOT_SECONDS)
+        slots = range(current - max(window // SLOT_SECONDS, 1) + 1, current + 1)
+        pipe = cache.pipeline()
+        for slot in slots:
+            pipe.hgetall(f"{self.prefix}:{slot}")
+        result = {}
+        for data in pipe.execute():
+            for field, count in data.items():
+                lane, stage, server, bucket = _decode(field).split("|")
+                counts = result.setdefault(
+                    (lane, stage, server), [0] * (BUCKET_COUNT + 1)
+                )
+                counts[int(bucket)] += int(count)
+        return result
+
+    def totals(self):
+        """
+        :return: {(lane, stage, server): {"count", "sum"}}
+        """
+        result = {}
+        for field, value in cache.hgetall(f"{self.prefix}:total").items():
+            lane, stage, server, name = _decode(field).split("|")
+            total = result.setdefault((lane, stage, server), {"count": 0, "sum": 0.0})
+            total[name] = float(value) if name == "sum" else int(value)
+        return result
+
+    @staticmethod
+    def quantile(counts, q):
+        """
+        按直方图估计分位数, 在桶内按几何插值
+        :return: 秒, 没有数据时返回 None
+        """
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if not count or seen + count < rank:
+                seen += count
+                continue
+            if index == 0:
+                return BUCKET_START
+            if index >= BUCKET_COUNT:
+                return BUCKETS[-1]
+            lower = BUCKETS[index - 1]
+            return lower * BUCKET_BASE ** ((rank - seen) / count)
+        return BUCKETS[-1]
+
+    def summary(self, window=DEFAULT_WINDOW):
+        """
+        :return: [{"lane", "stage", "server", "count", "sum", "quantiles": {q: 秒}}, ...],
+                 quantiles 只统计最近 window 秒, count 和 sum 为累计值
+        """
+        histograms = self.histograms(window)
+        totals = self.totals()
+        result = []
+        for series in sorted(set(histograms) | set(totals)):
+            counts = histograms.get(series, [])
+            total = totals.get(series, {"count": 0, "sum": 0.0})
+            result.append(
+                {
+                    "lane": series[0],
+                    "stage": series[1],
+                    "server": series[2],
+                    "count": total["count"],
+                    "sum": total["sum"],
+                    "quantiles": {q: self.quantile(counts, q) for q in QUANTILES},
+                }
+            )
+        return result
+
+    def exposition(self, window=DEFAULT_WINDOW):
+        """
+        以 Prometheus 文本格式输出
+        """
+        name = "oj_judge_stage_seconds"
+        lines = [
+            f"# HELP {name} Time spent in each judge pipeline stage, quantiles over the last {window}s.",
+            f"# TYPE {name} summary",
+        ]
+        for item in self.summary(window):
+            labels = f'lane="{item["lane"]}",stage="{item["stage"]}",server="{item["server"]}"'
+            for q, value in item["quantiles"].items():
+                if value is not None:
+                    lines.append(f'{name}{{{labels},quantile="{q}"}} {value:.6f}')
+            lines.append(f"{name}_sum{{{labels}}} {item['sum']:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {item['count']}")
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        cache.delete_pattern(f"{self.prefix}:*")
+
+
+judge_metrics = JudgeMetrics()
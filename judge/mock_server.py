@@ -0,0 +1,268 @@
+"""
+用于压测和本地调试的 judge server 替身, 接口和返回值格式与 judge server 相同, 另外支持 /judge_batch。
+不真正编译运行代码, 每个提交按给定分布的耗时占用一个 cpu 核后返回 Accepted, 可以按比例模拟调用失败。
+"""
+import hashlib
+import json
+import logging
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urljoin
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyDistribution:
+    CONSTANT = "constant"
+    UNIFORM = "uniform"
+    EXPONENTIAL = "exponential"
+    LOGNORMAL = "lognormal"
+
+
+class MockJudgeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        work=0.01,
+        cpu_core=4,
+        distribution=LatencyDistribution.CONSTANT,
+        sigma=1.0,
+        failure_rate=0.0,
+        seed=None,
+    ):
+        """
+        :param work: 每个提交的平均判题耗时（秒）
+        :param cpu_core: 同时判题的提交数, 超出的排队等待
+        :param distribution: 判题耗时的分布, 均值都是 work
+        :param sigma: lognormal 分布的 sigma, 越大长尾越明显
+        :param failure_rate: 返回 500 的比例, /judge_batch 中按提交计算, 失败的提交结果为 null
+        """
+        super().__init__(address, MockJudgeHandler)
+        self.work = work
+        self.cpu_core = cpu_core
+        self.distribution = distribution
+        self.sigma = sigma
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.cores = threading.Semaphore(cpu_core)
+        self.requests = 0
+        self.submissions = 0
+        self.failures = 0
+        self.busy = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def sample_work(self):
+        with self._lock:
+            if self.distribution == LatencyDistribution.UNIFORM:
+                return self.random.uniform(0, 2 * self.work)
+            if self.distribution == LatencyDistribution.EXPONENTIAL:
+                return self.random.expovariate(1 / self.work) if self.work else 0
+            if self.distribution == LatencyDistribution.LOGNORMAL:
+                if not self.work:
+                    return 0
+                mu = math.log(self.work) - self.sigma**2 / 2
+                return self.random.lognormvariate(mu, self.sigma)
+            return self.work
+
+    def occupy(self, work):
+        """
+        占用一个核 work 秒
+        """
+        with self.cores:
+            with self._lock:
+                self.busy += 1
+            try:
+                time.sleep(work)
+            finally:
+                with self._lock:
+                    self.busy -= 1
+
+    def should_fail(self):
+        with self._lock:
+            failed = self.random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+            return failed
+
+    def judge(self, data):
+        work = self.sample_work()
+        self.occupy(work)
+        if self.should_fail():
+            return None
+        return self.result(work)
+
+    def judge_batch(self, tasks):
+        # 一批提交在 cpu_core 个核上并行, 按总耗时平摊到每个核计算
+        works = [self.sample_work() for _ in tasks]
+        time.sleep(max(sum(works) / self.cpu_core, max(works, default=0)))
+        return [None if self.should_fail() else self.result(work) for work in works]
+
+    def compile_run(self, data):
+        # 有 inputs 时编译一次后依次运行每组输入
+        inputs = data.get("inputs") or [data.get("input_data") or ""]
+        work = self.sample_work()
+        self.occupy(work)
+        if self.should_fail():
+            return None
+        with self._lock:
+            self.submissions += 1
+        return {
+            "err": None,
+            "data": [
+                {
+                    "result": 0,
+                    "cpu_time": int(work * 1000),
+                    "real_time": int(work * 1000),
+                    "memory": 1024 * 1024,
+                    "signal": 0,
+                    "exit_code": 0,
+                    "error": 0,
+                    # 原样输出自定义输入
+                    "output": input_data,
+                }
+                for input_data in inputs
+            ],
+        }
+
+    def result(self, work=None):
+        work = self.work if work is None else work
+        with self._lock:
+            self.submissions += 1
+        return {
+            "err": None,
+            "data": [
+                {
+                    "test_case": "1",
+                    "result": 0,
+                    "cpu_time": int(work * 1000),
+                    "real_time": int(work * 1000),
+                    "memory": 1024 * 1024,
+                    "signal": 0,
+                    "exit_code": 0,
+                    "error": 0,
+                    "output_md5": None,
+                    "output": None,
+                }
+            ],
+        }
+
+    def handle_json(self, path, data):
+        with self._lock:
+            self.requests += 1
+        if path == "/ping":
+            return {"err": None, "data": {"cpu_core": self.cpu_core}}
+        if path == "/judge":
+            return self.judge(data)
+        if path == "/compile_run":
+            return self.compile_run(data)
+        if path == "/judge_batch":
+            return {"err": None, "data": self.judge_batch(data["tasks"])}
+        if path == "/compile_spj":
+            return {"err": None, "data": "success"}
+        return None
+
+
+class MockJudgeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        data = json.loads(self.rfile.read(length) or b"null")
+        path = self.path.rstrip("/")
+        body = self.server.handle_json(path, data)
+        if body is None:
+            self.send_error(404 if path not in MOCK_PATHS else 500)
+            return
+        body = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+MOCK_PATHS = ("/ping", "/judge", "/judge_batch", "/compile_spj", "/compile_run")
+
+
+class MockHeartbeatClient:
+    """
+    像 judge server 一样定时调用 JudgeServerHeartbeatAPI, 让后端把 mock server 当作一台普通的服务器
+    """
+
+    def __init__(self, server, backend_url, token, hostname=None, interval=5):
+        """
+        :param backend_url: 后端地址, 如 http://127.0.0.1:8000
+        :param token: judge_server_token 的原文, 请求时使用它的 sha256
+        """
+        self.server = server
+        self.url = urljoin(backend_url, "/api/judge_server_heartbeat/")
+        self.token = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        self.hostname = hostname or f"mock-{server.server_address[1]}"
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def data(self):
+        # 按正在判题的提交数估计 cpu 占用
+        busy = min(self.server.busy, self.server.cpu_core)
+        return {
+            "hostname": self.hostname,
+            "judger_version": "mock",
+            "cpu_core": self.server.cpu_core,
+            "memory": 10.0,
+            "cpu": round(100 * busy / self.server.cpu_core, 1),
+            "action": "heartbeat",
+            "service_url": self.server.url,
+        }
+
+    def beat(self):
+        """
+        :return: 后端的返回值, 请求失败时返回 None
+        """
+        try:
+            return requests.post(
+                self.url,
+                json=self.data(),
+                headers={"X-Judge-Server-Token": self.token},
+                timeout=5,
+            ).json()
+        except Exception as e:
+            logger.warning(f"Heartbeat to {self.url} failed: {e}")
+            return None
+
+    def run(self):
+        while not self._stopped.is_set():
+            resp = self.beat()
+            if resp and resp.get("error"):
+                logger.warning(f"Heartbeat rejected: {resp['data']}")
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+
+def start_mock_server(host="127.0.0.1", port=0, **kwargs):
+    """
+    在后台线程中启动, port 为 0 时随机选择端口
+    """
+    server = MockJudgeServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseNotAllowed
+
+from utils.api import APIError, JSONResponse
+from utils.cache import cache
+from utils.constants import CacheKey
+
+logger = logging.getLogger(__name__)
+
+# 等待结果的默认和最长时间（秒）, 超时后客户端重新发起请求
+WAIT_TIMEOUT = 30
+WAIT_TIMEOUT_MAX = 60
+# 订阅线程读取消息的超时（秒）, 断线后重新订阅的间隔
+LISTEN_TIMEOUT = 1
+RECONNECT_INTERVAL = 1
+# 订阅尚未建立时最多等待的时间（秒）
+READY_TIMEOUT = 3
+
+
+class ResultKind:
+    SUBMISSION = "submission"
+    COMPILE_RUN = "compile_run"
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _resolve(future, data):
+    if not future.done():
+        future.set_result(data)
+
+
+class ResultNotifier:
+    """
+    判题或自定义输入运行结束时通过 redis pub/sub 发布结果, 等待的请求不再轮询数据库。
+
+    每个进程只有一个订阅线程, 用模式 {prefix}:* 订阅所有结果, 收到消息后唤醒各个事件循环中等待的 future,
+    所以同时等待的请求数不受线程数限制
+    """
+
+    prefix = CacheKey.result_notify
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {channel: {future, ...}}
+        self._waiters = {}
+        self._ready = threading.Event()
+        self._thread = None
+
+    def channel(self, kind, object_id):
+        return f"{self.prefix}:{kind}:{object_id}"
+
+    def publish(self, kind, object_id, result):
+        try:
+            cache.publish(self.channel(kind, object_id), json.dumps(result))
+        except Exception as e:
+            # 通知失败时等待的请求超时后会重新读取数据库
+            logger.exception(e)
+
+    def publish_many(self, kind, results):
+        """
+        :param results: [(object_id, result), ...]
+        """
+        if not results:
+            return
+        try:
+            pipe = cache.pipeline()
+            for object_id, result in results:
+                pipe.publish(self.channel(kind, object_id), json.dumps(result))
+            pipe.execute()
+        except Exception as e:
+            logger.exception(e)
+
+    def _listen(self):
+        while True:
+            pubsub = None
+            try:
+                pubsub = cache.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f"{self.prefix}:*")
+                self._ready.set()
+                while True:
+                    message = pubsub.get_message(timeout=LISTEN_TIMEOUT)
+                    if message and message["type"] == "pmessage":
+                        self._dispatch(_decode(message["channel"]), message["data"])
+            except Exception as e:
+                logger.exception(e)
+                self._ready.clear()
+                if pubsub:
+                    pubsub.close()
+                time.sleep(RECONNECT_INTERVAL)
+
+    def _dispatch(self, channel, data):
+        with self._lock:
+            futures = list(self._waiters.get(channel, ()))
+        for future in futures:
+            try:
+                future.get_loop().call_soon_threadsafe(_resolve, future, data)
+            except RuntimeError:
+                # 请求已经结束, 事件循环已关闭
+                pass
+
+    def _start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._listen, name="result-notifier", daemon=True
+            )
+            self._thread.start()
+
+    async def wait(self, kind, object_id, check, timeout=WAIT_TIMEOUT):
+        """
+        等待结果的通知
+        :param check: 返回当前结果的协程函数, 未完成时返回 None. 在订阅之后调用, 避免错过在此之前发布的通知
+        :return: 结果, 超时仍未完成时返回 None
+        """
+        self._start()
+        if not self._ready.is_set():
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._ready.wait, READY_TIMEOUT
+            )
+        channel = self.channel(kind, object_id)
+        future = asyncio.get_running_loop().create_future()
+        with self._lock:
+            self._waiters.setdefault(channel, set()).add(future)
+        try:
+            result = await check()
+            if result is not None:
+                return result
+            try:
+                return json.loads(await asyncio.wait_for(future, timeout))
+            except asyncio.TimeoutError:
+                # 通知可能因为 redis 断线丢失, 超时后以数据库为准
+                return await check()
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(channel)
+                waiters.discard(future)
+                if not waiters:
+                    self._waiters.pop(channel)
+
+    def waiting(self):
+        with self._lock:
+            return sum(len(futures) for futures in self._waiters.values())
+
+
+result_notifier = ResultNotifier()
+
+
+def wait_result_view(kind, load):
+    """
+    生成长轮询等待结果的异步视图, 只接受 GET, 参数 id 和 timeout（秒）, 返回 {"id", "finished", "result"}。
+    在 ASGI 下运行时不占用线程, 在 WSGI 下也能使用, 但每个等待的请求会占用一个线程
+    :param load: load(request, object_id) 返回结果, 未完成时返回 None, 没有权限等情况抛出 APIError. 在线程中调用
+    """
+
+    async def view(request):
+        # 和 APIView 一样, 没有实现的方法返回 405
+        if request.method != "GET":
+            return HttpResponseNotAllowed(["GET"])
+        object_id = request.GET.get("id")
+        if not object_id:
+            return JSONResponse.response(
+                {"error": "error", "data": "Parameter id doesn't exist"}
+            )
+        try:
+            timeout = float(request.GET.get("timeout", WAIT_TIMEOUT))
+        except ValueError:
+            return JSONResponse.response({"error": "error", "data": "Invalid timeout"})
+        timeout = min(max(timeout, 0), WAIT_TIMEOUT_MAX)
+
+        async def check():
+            return await sync_to_async(load)(request, object_id)
+
+        try:
+            result = await result_notifier.wait(kind, object_id, check, timeout)
+        except APIError as e:
+            return JSONResponse.response({"error": e.err or "error", "data": e.msg})
+        return JSONResponse.response(
+            {
+                "error": None,
+                "data": {
+                    "id": object_id,
+                    "finished": result is not None,
+                    "result": result,
+                },
+            }
+        )
+
+    return view
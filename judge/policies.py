@@ -0,0 +1,243 @@
+import bisect
+import hashlib
+import random
+from functools import lru_cache
+
+# 并发上限的调整: 请求成功时每轮加 1, 失败、超时或过慢时乘以 AIMD_DECREASE
+AIMD_DECREASE = 0.7
+# 耗时超过请求超时的这个比例视为过慢, 熔断器也使用这个定义。超时按 real time 为 cpu time 的 3 倍估算,
+# 正常判题远低于这个比例
+SLOW_RATIO = 0.5
+# 耗时超过延迟 EWMA 的这个倍数, 或心跳上报的 cpu 占用超过这个百分比时不再增大上限
+LATENCY_RISE_FACTOR = 2
+CPU_SATURATED = 90
+# 并发上限的范围, 初始值为 cpu_core * INITIAL_LIMIT_FACTOR
+MIN_LIMIT = 1
+INITIAL_LIMIT_FACTOR = 2
+MAX_LIMIT_FACTOR = 4
+# EWMA 中新样本的权重
+EWMA_ALPHA = 0.3
+# 内存占用超过这个百分比的服务器排在最后
+MEMORY_HIGH_WATERMARK = 90
+# 一致性哈希中每台服务器的虚拟节点数
+VIRTUAL_NODES = 64
+# 按亲和性分配时, 单台服务器的负载最多为平均负载的这么多倍, 超过后溢出到环上的下一台
+AFFINITY_LOAD_FACTOR = 1.25
+
+
+class ServerState:
+    """
+    选择服务器时用到的一台服务器的实时状态
+    """
+
+    def __init__(
+        self,
+        id,
+        capacity,
+        used,
+        cpu_core,
+        cpu_usage=0,
+        memory_usage=0,
+        latency=0,
+    ):
+        self.id = id
+        # 当前的并发上限
+        self.capacity = capacity
+        self.used = used
+        self.cpu_core = cpu_core
+        self.cpu_usage = cpu_usage
+        self.memory_usage = memory_usage
+        # 判题请求耗时的 EWMA, 秒, 0 表示还没有数据
+        self.latency = latency
+
+    def __repr__(self):
+        return f"<ServerState {self.id} {self.used}/{self.capacity}>"
+
+
+def is_slow(cost, timeout):
+    return bool(timeout) and cost > timeout * SLOW_RATIO
+
+
+def initial_limit(cpu_core):
+    return cpu_core * INITIAL_LIMIT_FACTOR
+
+
+def max_limit(cpu_core):
+    return cpu_core * MAX_LIMIT_FACTOR
+
+
+def adjust_limit(
+    limit,
+    latency,
+    cost,
+    ok,
+    cpu_core,
+    timeout=None,
+    cpu_usage=0,
+    time_limit_exceeded=False,
+):
+    """
+    按一次判题请求的结果更新并发上限 (AIMD) 和延迟的 EWMA。
+    失败或耗时超过 timeout 的 SLOW_RATIO 时减小上限, 但结果中有超时的测试点时耗时是代码本身造成的, 不算过慢。
+    结果中有超时的测试点、延迟明显升高或 cpu 占用饱和时既可能是代码本身的问题也可能是服务器过载,
+    保持上限不变, 只有没有这些迹象的请求才增大上限
+    :param limit: 当前并发上限
+    :param latency: 当前延迟 EWMA, 0 表示还没有数据
+    :param cost: 本次请求耗时, 秒
+    :param ok: 请求是否成功
+    :param timeout: 请求的超时时间, 秒
+    :param cpu_usage: 心跳上报的 cpu 占用百分比
+    :param time_limit_exceeded: 结果中是否有 cpu 或 real time 超时的测试点
+    :return: (limit, latency)
+    """
+    congested = (
+        time_limit_exceeded
+        or cpu_usage >= CPU_SATURATED
+        or (latency and cost > latency * LATENCY_RISE_FACTOR)
+    )
+    if not ok or (not time_limit_exceeded and is_slow(cost, timeout)):
+        limit *= AIMD_DECREASE
+    elif not congested:
+        limit += 1 / max(limit, MIN_LIMIT)
+    limit = min(max(limit, MIN_LIMIT), max_limit(cpu_core))
+    if ok:
+        latency = (
+            cost if not latency else EWMA_ALPHA * cost + (1 - EWMA_ALPHA) * latency
+        )
+    return limit, latency
+
+
+class SelectionPolicy:
+    """
+    把有空闲名额的服务器按优先顺序排好, 由 allocator 依次尝试获取名额
+    """
+
+    name = None
+
+    def order(self, servers, key=None):
+        """
+        :param servers: [ServerState, ...], 已经去掉了没有空闲名额的服务器
+        :param key: 任务的亲和键, 相同的键尽量分配到相同的服务器, 大多数策略会忽略
+        :return: 排序后的 [ServerState, ...]
+        """
+        raise NotImplementedError()
+
+
+class LeastLoadedPolicy(SelectionPolicy):
+    """
+    按每个 cpu 核上的任务数排序, 并按心跳上报的 cpu 和内存占用加权
+    """
+
+    name = "least_loaded"
+
+    @staticmethod
+    def score(server):
+        load = (server.used + 1) / max(server.cpu_core, 1)
+        pressure = max(server.cpu_usage, server.memory_usage) / 100
+        return server.memory_usage >= MEMORY_HIGH_WATERMARK, load * (1 + pressure)
+
+    def order(self, servers, key=None):
+        return sorted(servers, key=lambda server: (self.score(server), server.id))
+
+
+class EWMAPolicy(SelectionPolicy):
+    """
+    按预计完成时间排序: 延迟 EWMA 乘以排在前面的任务数, 还没有延迟数据的服务器优先
+    """
+
+    name = "ewma"
+
+    @staticmethod
+    def score(server):
+        return server.latency * (server.used + 1) / max(server.cpu_core, 1)
+
+    def order(self, servers, key=None):
+        return sorted(servers, key=lambda server: (self.score(server), server.id))
+
+
+class PowerOfTwoChoicesPolicy(SelectionPolicy):
+    """
+    随机抽两台, 负载低的排在前面, 其余随机排在后面作为备选。
+    不需要每次都比较全部服务器, 多个 worker 同时分配时也不容易扎堆到同一台
+    """
+
+    name = "p2c"
+
+    def order(self, servers, key=None):
+        servers = list(servers)
+        random.shuffle(servers)
+        head = sorted(servers[:2], key=LeastLoadedPolicy.score)
+        return head + servers[2:]
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode("utf-8")).hexdigest()[:16], 16)
+
+
+@lru_cache(maxsize=128)
+def _hash_ring(server_ids):
+    ring = sorted(
+        (_hash(f"{server_id}:{i}"), server_id)
+        for server_id in server_ids
+        for i in range(VIRTUAL_NODES)
+    )
+    return [point for point, _ in ring], [server_id for _, server_id in ring]
+
+
+class AffinityPolicy(SelectionPolicy):
+    """
+    按亲和键（测试用例和 spj 版本）做一致性哈希, 同一道题的提交集中在少数几台服务器上,
+    测试用例的页缓存和编译好的 spj 都能复用。
+    负载超过按容量分摊的平均值 AFFINITY_LOAD_FACTOR 倍的服务器会被跳过, 避免热门题目压垮一台服务器。
+    没有亲和键时退化为 least_loaded
+    """
+
+    name = "affinity"
+
+    def ring_order(self, servers, key):
+        """
+        从 key 在哈希环上的位置开始顺时针排列的服务器
+        """
+        points, server_ids = _hash_ring(tuple(sorted(server.id for server in servers)))
+        start = bisect.bisect(points, _hash(key))
+        by_id = {server.id: server for server in servers}
+        result = []
+        for i in range(len(server_ids)):
+            server = by_id.pop(server_ids[(start + i) % len(server_ids)], None)
+            if server:
+                result.append(server)
+                if not by_id:
+                    break
+        return result
+
+    def order(self, servers, key=None):
+        if key is None or not servers:
+            return POLICIES["least_loaded"].order(servers)
+        total_used = sum(server.used for server in servers) + 1
+        total_capacity = sum(server.capacity for server in servers)
+        preferred, overloaded = [], []
+        for server in self.ring_order(servers, key):
+            bound = AFFINITY_LOAD_FACTOR * total_used * server.capacity / total_capacity
+            if server.used + 1 <= max(bound, 1):
+                preferred.append(server)
+            else:
+                overloaded.append(server)
+        return preferred + POLICIES["least_loaded"].order(overloaded)
+
+
+POLICIES = {
+    policy.name: policy
+    for policy in (
+        LeastLoadedPolicy(),
+        EWMAPolicy(),
+        PowerOfTwoChoicesPolicy(),
+        AffinityPolicy(),
+    )
+}
+
+
+def get_policy(name):
+    try:
+        return POLICIES[name]
+    except KeyError:
+        raise ValueError(f"Unknown judge server selection policy {name}")
@@ -0,0 +1,64 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+from conf.models import JudgeServer, HEARTBEAT_TIMEOUT
+from judge.heartbeat import heartbeat_store
+
+# 进程内缓存可用服务器列表的时间（秒）
+REGISTRY_TTL = 0.5
+
+
+class JudgeServerRegistry:
+    """
+    当前可用（未禁用且心跳未超时）的 judge server, 在进程内缓存 REGISTRY_TTL 秒,
+    分配名额和后台统计都从这里读取, 不再逐行计算 JudgeServer.status。
+
+    心跳时间在 redis 的 zset 和数据库中按范围过滤: 有心跳数据的服务器以 redis 为准,
+    没有的（例如 redis 被清空后还没有收到心跳）按数据库中的 last_heartbeat。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers = None
+        self._ids = frozenset()
+        self._expires_at = 0
+
+    def _load(self):
+        deadline = timezone.now() - timedelta(seconds=HEARTBEAT_TIMEOUT)
+        hostnames = heartbeat_store.alive(deadline.timestamp())
+        servers = heartbeat_store.apply(
+            JudgeServer.objects.filter(is_disabled=False).filter(
+                Q(hostname__in=hostnames) | Q(last_heartbeat__gte=deadline)
+            )
+        )
+        # redis 中的心跳数据属于已经删除的同名服务器时, 仍然可能已经超时
+        return [server for server in servers if server.last_heartbeat >= deadline]
+
+    def active(self):
+        """
+        :return: [JudgeServer, ...], 调用方不要修改
+        """
+        with self._lock:
+            if self._servers is None or time.monotonic() >= self._expires_at:
+                self._servers = self._load()
+                self._ids = frozenset(server.id for server in self._servers)
+                self._expires_at = time.monotonic() + REGISTRY_TTL
+            return self._servers
+
+    def active_ids(self):
+        self.active()
+        return self._ids
+
+    def invalidate(self):
+        """
+        服务器上线、禁用或删除时调用, 其他进程中的缓存最多 REGISTRY_TTL 秒后过期
+        """
+        with self._lock:
+            self._servers = None
+
+
+judge_server_registry = JudgeServerRegistry()
@@ -0,0 +1,339 @@
+import hashlib
+import json
+import logging
+import time
+import uuid
+
+from django.conf import settings
+
+from judge.context import problem_context_cache
+from judge.dispatcher import process_pending_task
+from judge.scheduler import JudgeTaskClass, judge_queue
+from judge.statistics import judge_statistics
+from submission.models import JudgeStatus, Submission
+from utils.cache import cache
+from utils.constants import CacheKey
+
+logger = logging.getLogger(__name__)
+
+# 每次从数据库中读取的提交数
+CHUNK_SIZE = 500
+# 一个任务同时在队列中和判题中的提交数上限
+MAX_PENDING = 500
+# 两次推进之间间隔很久时, 最多补发这么多秒的额度, 避免一次放入太多
+MAX_BURST = 10
+# 结束后任务信息保留的时间（秒）
+JOB_TTL = 7 * 24 * 3600
+# 从代表提交复制给代码相同的提交的字段
+COPY_FIELDS = ["result", "info", "score", "memory"]
+
+COUNTERS = ("total", "scanned", "enqueued", "duplicated", "judged", "copied", "failed")
+
+
+class RejudgeJobStatus:
+    RUNNING = "running"
+    FINISHED = "finished"
+    CANCELLED = "cancelled"
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class RejudgeJobManager:
+    """
+    批量重新判题。按条件筛选出的提交按 id 顺序分批读取, 同一道题中代码和语言都相同的提交只判一次,
+    其余的在最后复制代表提交的结果; 判题任务以最低的 rejudge 优先级放入队列, 由 advance_rejudge_jobs
+    定时推进, 每秒最多放入 settings.JUDGE_REJUDGE_RATE 个提交。
+
+    任务的状态都保存在 redis 中:
+    {prefix}:{id} 为任务信息和计数, {prefix}:{id}:keys 为 {代码的 hash: 代表提交},
+    {prefix}:{id}:followers 为 {重复的提交: 代表提交}, {prefix}:{id}:pending 为还没有判完的代表提交
+    """
+
+    prefix = CacheKey.rejudge_job
+    jobs_key = f"{CacheKey.rejudge_job}:jobs"
+    running_key = f"{CacheKey.rejudge_job}:running"
+
+    def _key(self, job_id, name=None):
+        return f"{self.prefix}:{job_id}:{name}" if name else f"{self.prefix}:{job_id}"
+
+    @staticmethod
+    def queryset(filters):
+        """
+        :param filters: {"problem_id", "contest_id", "submission_ids", "result"} 中的一个或多个
+        """
+        submissions = Submission.objects.filter(is_judging=False)
+        if filters.get("problem_id"):
+            submissions = submissions.filter(problem_id=filters["problem_id"])
+        if filters.get("contest_id"):
+            submissions = submissions.filter(contest_id=filters["contest_id"])
+        if filters.get("submission_ids"):
+            submissions = submissions.filter(id__in=filters["submission_ids"])
+        if filters.get("result"):
+            submissions = submissions.filter(result__in=filters["result"])
+        return submissions
+
+    def create(self, filters, created_by):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        pipe = cache.pipeline()
+        pipe.hset(
+            self._key(job_id),
+            mapping={
+                "id": job_id,
+                "status": RejudgeJobStatus.RUNNING,
+                "filters": json.dumps(filters),
+                "created_by": created_by,
+                "create_time": now,
+                "cursor": "",
+                "exhausted": 0,
+                # 第一次推进时可以先放入一秒的额度
+                "last_step": now - 1,
+                "total": self.queryset(filters).count(),
+                **{counter: 0 for counter in COUNTERS if counter != "total"},
+            },
+        )
+        pipe.zadd(self.jobs_key, {job_id: now})
+        pipe.sadd(self.running_key, job_id)
+        pipe.execute()
+        return self.advance(job_id)
+
+    def get(self, job_id):
+        data = {
+            _decode(k): _decode(v) for k, v in cache.hgetall(self._key(job_id)).items()
+        }
+        if not data:
+            return None
+        job = {
+            "id": data["id"],
+            "status": data["status"],
+            "filters": json.loads(data["filters"]),
+            "created_by": int(data["created_by"]),
+            "create_time": float(data["create_time"]),
+            "cursor": data["cursor"],
+            "exhausted": data["exhausted"] == "1",
+            "last_step": float(data["last_step"]),
+        }
+        for counter in COUNTERS:
+            job[counter] = int(data[counter])
+        # 重复的提交不需要判题, 扫描到就算作完成
+        done = job["judged"] + job["duplicated"] + job["failed"]
+        job["progress"] = min(done / job["total"], 1) if job["total"] else 1
+        return job
+
+    def list(self, limit=20):
+        jobs = []
+        for job_id in cache.zrevrange(self.jobs_key, 0, limit - 1):
+            job = self.get(_decode(job_id))
+            if job:
+                jobs.append(job)
+            else:
+                cache.zrem(self.jobs_key, job_id)
+        return jobs
+
+    def cancel(self, job_id):
+        """
+        不再放入新的提交, 已经放入队列的仍会判完
+        """
+        job = self.get(job_id)
+        if job and job["status"] == RejudgeJobStatus.RUNNING:
+            cache.hset(self._key(job_id), "status", RejudgeJobStatus.CANCELLED)
+            self._expire(job_id)
+        return self.get(job_id)
+
+    def _expire(self, job_id):
+        pipe = cache.pipeline()
+        pipe.srem(self.running_key, job_id)
+        for name in (None, "keys", "followers", "pending"):
+            pipe.expire(self._key(job_id, name), JOB_TTL)
+        pipe.execute()
+
+    def advance_all(self):
+        for job_id in cache.smembers(self.running_key):
+            try:
+                self.advance(_decode(job_id))
+            except Exception as e:
+                logger.exception(e)
+
+    def advance(self, job_id):
+        """
+        统计已经判完的代表提交, 按速率放入新的提交, 全部判完后复制重复提交的结果
+        """
+        job = self.get(job_id)
+        if not job or job["status"] != RejudgeJobStatus.RUNNING:
+            return job
+        lock = self._key(job_id, "lock")
+        if not cache.set(lock, 1, timeout=60, nx=True):
+            return job
+        try:
+            pending = self._check_pending(job_id)
+            if not job["exhausted"]:
+                now = time.time()
+                budget = int(
+                    settings.JUDGE_REJUDGE_RATE * min(now - job["last_step"], MAX_BURST)
+                )
+                budget = min(budget, MAX_PENDING - pending)
+                if budget > 0:
+                    cache.hset(self._key(job_id), "last_step", now)
+                    pending += self._enqueue(job_id, job, budget)
+            job = self.get(job_id)
+            if job["exhausted"] and not pending:
+                self._finish(job_id)
+        finally:
+            cache.delete(lock)
+        return self.get(job_id)
+
+    def _check_pending(self, job_id):
+        """
+        :return: 还没有判完的代表提交数
+        """
+        pending_key = self._key(job_id, "pending")
+        pending = [_decode(i) for i in cache.smembers(pending_key)]
+        if not pending:
+            return 0
+        done = list(
+            Submission.objects.filter(id__in=pending, is_judging=False).values_list(
+                "id", "result"
+            )
+        )
+        if done:
+            failed = sum(1 for _, result in done if result == JudgeStatus.SYSTEM_ERROR)
+            pipe = cache.pipeline()
+            pipe.srem(pending_key, *[submission_id for submission_id, _ in done])
+            pipe.hincrby(self._key(job_id), "judged", len(done) - failed)
+            pipe.hincrby(self._key(job_id), "failed", failed)
+            pipe.execute()
+        return len(pending) - len(done)
+
+    @staticmethod
+    def _code_key(problem_id, language, code):
+        return hashlib.sha256(
+            f"{problem_id}:{language}:{code}".encode("utf-8")
+        ).hexdigest()
+
+    def _enqueue(self, job_id, job, budget):
+        """
+        从游标处继续读取最多 budget 个提交, 代码第一次出现的放入队列
+        :return: 放入队列的提交数
+        """
+        submissions = self.queryset(job["filters"])
+        cursor = job["cursor"]
+        enqueued = 0
+        while budget > 0:
+            rows = list(
+                submissions.filter(id__gt=cursor)
+                .order_by("id")
+                .values_list("id", "problem_id", "user_id", "language", "code")[
+                    : min(budget, CHUNK_SIZE)
+                ]
+            )
+            if not rows:
+                cache.hset(self._key(job_id), "exhausted", 1)
+                break
+            budget -= len(rows)
+            cursor = rows[-1][0]
+
+            # 同一批中代码相同的提交也只有第一个能写入
+            keys = [self._code_key(row[1], row[3], row[4]) for row in rows]
+            pipe = cache.pipeline()
+            for row, key in zip(rows, keys):
+                pipe.hsetnx(self._key(job_id, "keys"), key, row[0])
+            created = pipe.execute()
+            duplicated = [key for key, new in zip(keys, created) if not new]
+            leaders = dict(
+                zip(
+                    duplicated,
+                    cache.hmget(self._key(job_id, "keys"), duplicated)
+                    if duplicated
+                    else [],
+                )
+            )
+            followers = {}
+            leader_rows = []
+            for row, key, new in zip(rows, keys, created):
+                if new:
+                    leader_rows.append(row)
+                else:
+                    followers[row[0]] = _decode(leaders[key])
+
+            if leader_rows:
+                Submission.objects.filter(
+                    id__in=[row[0] for row in leader_rows]
+                ).update(is_judging=True)
+                for submission_id, problem_id, user_id, _, _ in leader_rows:
+                    judge_queue.push(
+                        submission_id,
+                        JudgeTaskClass.REJUDGE,
+                        user_id,
+                        {"submission_id": submission_id, "problem_id": problem_id},
+                    )
+            pipe = cache.pipeline()
+            if leader_rows:
+                pipe.sadd(
+                    self._key(job_id, "pending"), *[row[0] for row in leader_rows]
+                )
+            if followers:
+                pipe.hset(self._key(job_id, "followers"), mapping=followers)
+            pipe.hset(self._key(job_id), "cursor", cursor)
+            pipe.hincrby(self._key(job_id), "scanned", len(rows))
+            pipe.hincrby(self._key(job_id), "enqueued", len(leader_rows))
+            pipe.hincrby(self._key(job_id), "duplicated", len(followers))
+            pipe.execute()
+            enqueued += len(leader_rows)
+        if enqueued:
+            process_pending_task()
+        return enqueued
+
+    def _finish(self, job_id):
+        """
+        把代表提交的结果复制给代码相同的提交, 统计信息在最后一起写回
+        """
+        followers = {
+            _decode(k): _decode(v)
+            for k, v in cache.hgetall(self._key(job_id, "followers")).items()
+        }
+        follower_ids = list(followers)
+        leaders = Submission.objects.in_bulk(set(followers.values()))
+        for start in range(0, len(follower_ids), CHUNK_SIZE):
+            end = start + CHUNK_SIZE
+            chunk = follower_ids[start:end]
+            submissions = list(
+                Submission.objects.filter(id__in=chunk, is_judging=False)
+            )
+            problems = problem_context_cache.get_many(
+                [submission.problem_id for submission in submissions]
+            )
+            items = []
+            for submission in submissions:
+                leader = leaders.get(followers[submission.id])
+                problem = problems.get(submission.problem_id)
+                # 代表提交判题失败时保留原来的结果
+                if (
+                    not leader
+                    or not problem
+                    or leader.is_judging
+                    or leader.result == JudgeStatus.SYSTEM_ERROR
+                ):
+                    continue
+                for field in COPY_FIELDS:
+                    setattr(submission, field, getattr(leader, field))
+                items.append((submission, problem))
+            changes = judge_statistics.collect(items)
+            Submission.objects.bulk_update(
+                [submission for submission, _ in items],
+                COPY_FIELDS + ["statistic_result"],
+            )
+            judge_statistics.record(changes)
+            pipe = cache.pipeline()
+            pipe.hincrby(self._key(job_id), "copied", len(items))
+            pipe.hincrby(self._key(job_id), "failed", len(chunk) - len(items))
+            pipe.hincrby(self._key(job_id), "duplicated", -(len(chunk) - len(items)))
+            pipe.execute()
+        judge_statistics.flush()
+        cache.hset(self._key(job_id), "status", RejudgeJobStatus.FINISHED)
+        self._expire(job_id)
+        logger.info(f"Rejudge job {job_id} finished")
+
+
+rejudge_jobs = RejudgeJobManager()
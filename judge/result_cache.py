@@ -0,0 +1,169 @@
+import hashlib
+import json
+import logging
+import time
+from copy import deepcopy
+
+from django.conf import settings
+
+from submission.models import JudgeStatus
+from utils.cache import cache
+from utils.constants import CacheKey
+
+logger = logging.getLogger(__name__)
+
+# 判题数据中决定判题结果的字段。测试用例和 spj 修改后 test_case_id、spj_version 会变, 时限和内存限制直接参与计算,
+# 所以题目修改后旧的缓存自然不再命中, 只需等待过期
+KEY_FIELDS = (
+    "src",
+    "language_config",
+    "test_case_id",
+    "spj_version",
+    "max_cpu_time",
+    "max_memory",
+    "io_mode",
+)
+# 超时和系统错误受 judge server 负载影响, 不缓存
+UNSTABLE_RESULTS = (
+    JudgeStatus.CPU_TIME_LIMIT_EXCEEDED,
+    JudgeStatus.REAL_TIME_LIMIT_EXCEEDED,
+    JudgeStatus.SYSTEM_ERROR,
+)
+# 返回的错误中只有编译错误完全由代码决定, JudgeClientError、SPJCompileError 等可能是 judge server 自身的问题
+CACHEABLE_ERRORS = ("CompileError",)
+
+
+# 运行自定义输入时决定结果的字段
+COMPILE_RUN_KEY_FIELDS = (
+    "code",
+    "language_config",
+    "input_data",
+    "inputs",
+    "max_cpu_time",
+    "max_memory",
+)
+
+
+def _digest(data, fields):
+    return hashlib.sha256(
+        json.dumps([data[field] for field in fields], sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class ResultCache:
+    """
+    judge server 返回值的缓存, 子类指定键的前缀、参与计算键的字段和缓存时间的配置项。
+    缓存时间为 0 时关闭, 受 judge server 负载影响的结果和编译错误以外的错误不缓存
+    """
+
+    prefix = None
+    stats_key = None
+    key_fields = ()
+    # settings 中缓存时间（秒）的配置项
+    timeout_setting = None
+
+    def key(self, data):
+        return f"{self.prefix}:{_digest(data, self.key_fields)}"
+
+    @property
+    def timeout(self):
+        return getattr(settings, self.timeout_setting)
+
+    @property
+    def enabled(self):
+        return bool(self.timeout)
+
+    def _count(self, field):
+        try:
+            cache.hincrby(self.stats_key, field, 1)
+        except Exception as e:
+            # 统计失败不能影响判题
+            logger.warning(f"Failed to record {self.stats_key}: {e}")
+
+    def get(self, key):
+        """
+        :param key: self.key(请求 judge server 的数据)
+        :return: 缓存的返回值, 未开启或没有命中时返回 None
+        """
+        if not self.enabled:
+            return None
+        resp = cache.get(key)
+        self._count("hits" if resp else "misses")
+        return resp
+
+    def set(self, key, resp):
+        if not self.enabled or not resp:
+            return
+        if resp["err"]:
+            if resp["err"] not in CACHEABLE_ERRORS:
+                return
+        elif any(case["result"] in UNSTABLE_RESULTS for case in resp["data"]):
+            return
+        # 之后处理结果时会修改 resp, 这里保存一份副本
+        self._store(key, deepcopy(resp))
+
+    def _store(self, key, resp):
+        cache.set(key, resp, timeout=self.timeout)
+
+    def reset(self):
+        cache.delete_pattern(f"{self.prefix}:*")
+        cache.delete(self.stats_key)
+
+    def stats(self):
+        data = {
+            k.decode("utf-8"): int(v) for k, v in cache.hgetall(self.stats_key).items()
+        }
+        hits = data.get("hits", 0)
+        total = hits + data.get("misses", 0)
+        return {
+            "enabled": self.enabled,
+            "hits": hits,
+            "misses": data.get("misses", 0),
+            "hit_rate": hits / total if total else 0,
+        }
+
+
+class JudgeResultCache(ResultCache):
+    """
+    相同代码、相同判题参数的提交直接复用之前 judge server 的返回值, 由 settings.JUDGE_RESULT_CACHE_TIMEOUT 开启。
+    缓存的是 judge server 的原始返回值, 得分仍按题目当前的 test_case_score 计算
+    """
+
+    prefix = CacheKey.judge_result_cache
+    stats_key = CacheKey.judge_result_cache_stats
+    key_fields = KEY_FIELDS
+    timeout_setting = "JUDGE_RESULT_CACHE_TIMEOUT"
+
+
+class CompileRunResultCache(ResultCache):
+    """
+    代码、语言配置、输入和时空限制都相同的自定义输入运行直接返回之前 /compile_run 的结果, 不再调用 judge server。
+    缓存 settings.COMPILE_RUN_CACHE_TIMEOUT 秒, 为 0 时关闭; 最多保留 settings.COMPILE_RUN_CACHE_SIZE 条,
+    超出时淘汰最早写入的。{prefix}:index 为按写入时间排序的 zset
+    """
+
+    prefix = CacheKey.compile_run_cache
+    index_key = f"{CacheKey.compile_run_cache}:index"
+    stats_key = CacheKey.compile_run_cache_stats
+    key_fields = COMPILE_RUN_KEY_FIELDS
+    timeout_setting = "COMPILE_RUN_CACHE_TIMEOUT"
+
+    def _store(self, key, resp):
+        now = time.time()
+        timeout = self.timeout
+        pipe = cache.pipeline()
+        # 过期的缓存已经被 redis 删除, 只需清理索引
+        pipe.zremrangebyscore(self.index_key, "-inf", now - timeout)
+        pipe.zadd(self.index_key, {key: now})
+        pipe.expire(self.index_key, timeout)
+        pipe.zcard(self.index_key)
+        size = pipe.execute()[-1]
+        cache.set(key, resp, timeout=timeout)
+        excess = size - settings.COMPILE_RUN_CACHE_SIZE
+        if excess > 0:
+            evicted = [k for k, _ in cache.zpopmin(self.index_key, excess)]
+            cache.delete_many([k.decode("utf-8") for k in evicted])
+
+
+result_cache = JudgeResultCache()
+compile_run_cache = CompileRunResultCache()
@@ -0,0 +1,352 @@
+import json
+import logging
+import time
+
+from judge.allocator import JudgeLane
+from utils.cache import cache
+from utils.constants import CacheKey
+
+logger = logging.getLogger(__name__)
+
+
+class JudgeTaskClass:
+    CONTEST = "contest"
+    PRACTICE = "practice"
+    # 重判是后台任务, 不能挤占正在等待结果的用户
+    REJUDGE = "rejudge"
+    COMPILE_RUN = "compile_run"
+
+
+# 优先级从高到低
+JUDGE_TASK_CLASSES = [
+    JudgeTaskClass.CONTEST,
+    JudgeTaskClass.PRACTICE,
+    JudgeTaskClass.REJUDGE,
+]
+
+# 默认的任务租约有效期（秒）, 取出后在这段时间内没有开始判题或确认完成就会被重新放回队列
+DEFAULT_VISIBILITY_TIMEOUT = 600
+# 开始判题时登记的租约比请求超时多出的时间（秒）
+LEASE_GRACE_PERIOD = 60
+# 同一个任务最多被放回队列的次数
+MAX_ATTEMPTS = 3
+
+# {prefix}:tasks 为 hash {task_id: 任务信息}, 排队中和处理中的任务都在里面
+# {prefix}:inflight 为处理中任务的 zset, 分数是租约到期时间
+# 每个类别下: {prefix}:{class}:users 为待处理用户的 zset, 按轮转序号排序
+# {prefix}:{class}:user:{user_id} 为该用户的 task_id list, {prefix}:{class}:seq 为轮转序号
+# {prefix}:{class}:size 为该类别排队中的任务总数
+# ARGV[1]: key 前缀  ARGV[2]: task_id  ARGV[3]: 任务信息  ARGV[4]: 类别  ARGV[5]: user_id
+# ARGV[6]: "1" 表示插到最前
+PUSH_SCRIPT = """
+if redis.call("ZREM", ARGV[1] .. ":inflight", ARGV[2]) == 0
+        and redis.call("HEXISTS", ARGV[1] .. ":tasks", ARGV[2]) == 1 then
+    -- 已经在排队了
+    return 0
+end
+redis.call("HSET", ARGV[1] .. ":tasks", ARGV[2], ARGV[3])
+local prefix = ARGV[1] .. ":" .. ARGV[4]
+local tasks_key = prefix .. ":user:" .. ARGV[5]
+if ARGV[6] == "1" then
+    redis.call("LPUSH", tasks_key, ARGV[2])
+else
+    redis.call("RPUSH", tasks_key, ARGV[2])
+end
+if not redis.call("ZSCORE", prefix .. ":users", ARGV[5]) then
+    local seq = redis.call("INCR", prefix .. ":seq")
+    if ARGV[6] == "1" then
+        seq = -seq
+    end
+    redis.call("ZADD", prefix .. ":users", seq, ARGV[5])
+end
+redis.call("INCR", prefix .. ":size")
+return 1
+"""
+
+# 按优先级依次处理每个类别, 类别内每次取轮转序号最小的用户的第一个任务, 然后把该用户排到最后。
+# 取出的任务进入处理中状态, 直到 ack 或租约到期
+# ARGV[1]: key 前缀  ARGV[2]: 最多取出的任务数  ARGV[3]: 租约到期时间  ARGV[4...]: 按优先级排列的类别
+POP_SCRIPT = """
+local limit = tonumber(ARGV[2])
+local result = {}
+for i = 4, #ARGV do
+    local prefix = ARGV[1] .. ":" .. ARGV[i]
+    while #result < limit do
+        local head = redis.call("ZRANGE", prefix .. ":users", 0, 0)
+        if #head == 0 then
+            break
+        end
+        local tasks_key = prefix .. ":user:" .. head[1]
+        local task_id = redis.call("LPOP", tasks_key)
+        if task_id then
+            redis.call("DECR", prefix .. ":size")
+            local task = redis.call("HGET", ARGV[1] .. ":tasks", task_id)
+            -- 排队期间已经被 ack 的任务直接丢弃
+            if task and not redis.call("ZSCORE", ARGV[1] .. ":inflight", task_id) then
+                redis.call("ZADD", ARGV[1] .. ":inflight", ARGV[3], task_id)
+                table.insert(result, task)
+            end
+        end
+        if redis.call("LLEN", tasks_key) > 0 then
+            redis.call("ZADD", prefix .. ":users", redis.call("INCR", prefix .. ":seq"), head[1])
+        else
+            redis.call("ZREM", prefix .. ":users", head[1])
+        end
+    end
+end
+return result
+"""
+
+# 按 POP_SCRIPT 的顺序查看排在最前面的任务, 不修改队列。已经被 ack 的任务跳过, 不占轮次
+# ARGV[1]: key 前缀  ARGV[2]: 最多查看的任务数  ARGV[3...]: 按优先级排列的类别
+PEEK_SCRIPT = """
+local limit = tonumber(ARGV[2])
+local result = {}
+for i = 3, #ARGV do
+    local prefix = ARGV[1] .. ":" .. ARGV[i]
+    -- 每轮每个用户最多一个任务, 最多需要看前 limit 个用户
+    local users = redis.call("ZRANGE", prefix .. ":users", 0, limit - 1)
+    local index = 0
+    while #result < limit and #users > 0 do
+        local remaining = {}
+        for _, user_id in ipairs(users) do
+            if #result >= limit then
+                break
+            end
+            local task_id = redis.call("LINDEX", prefix .. ":user:" .. user_id, index)
+            if task_id then
+                table.insert(remaining, user_id)
+                local task = redis.call("HGET", ARGV[1] .. ":tasks", task_id)
+                if task and not redis.call("ZSCORE", ARGV[1] .. ":inflight", task_id) then
+                    table.insert(result, task)
+                end
+            end
+        end
+        users = remaining
+        index = index + 1
+    end
+end
+return result
+"""
+
+# 取出 PEEK_SCRIPT 返回的一个任务, 只有它仍是该用户排在最前面的任务时才取出, 然后把该用户排到最后。
+# 排在它前面的已经被 ack 的任务顺便丢弃, 其他情况不修改队列
+# ARGV[1]: key 前缀  ARGV[2]: task_id  ARGV[3]: 类别  ARGV[4]: user_id  ARGV[5]: 租约到期时间
+TAKE_SCRIPT = """
+local prefix = ARGV[1] .. ":" .. ARGV[3]
+local tasks_key = prefix .. ":user:" .. ARGV[4]
+local taken = 0
+while true do
+    local task_id = redis.call("LINDEX", tasks_key, 0)
+    if not task_id then
+        break
+    end
+    local acked = redis.call("HEXISTS", ARGV[1] .. ":tasks", task_id) == 0
+        or redis.call("ZSCORE", ARGV[1] .. ":inflight", task_id)
+    if not acked and task_id ~= ARGV[2] then
+        break
+    end
+    redis.call("LPOP", tasks_key)
+    redis.call("DECR", prefix .. ":size")
+    if not acked then
+        redis.call("ZADD", ARGV[1] .. ":inflight", ARGV[5], task_id)
+        taken = 1
+        break
+    end
+end
+if redis.call("LLEN", tasks_key) == 0 then
+    redis.call("ZREM", prefix .. ":users", ARGV[4])
+elseif taken == 1 then
+    redis.call("ZADD", prefix .. ":users", redis.call("INCR", prefix .. ":seq"), ARGV[4])
+end
+return taken
+"""
+
+
+class JudgeTaskScheduler:
+    """
+    等待判题服务器的任务队列。类别之间按优先级严格排序, 同一类别内按用户轮转,
+    避免一个用户的大量提交把其他人的提交堵在后面。
+
+    任务取出后并不会立即删除, 而是带着租约进入处理中状态, 判题完成后 ack。
+    worker 中途崩溃时租约会过期, 由 requeue_expired 放回队列。
+
+    需要先获取判题名额的调用方用 peek 查看排在前面的任务, 拿到名额后再用 take 逐个取出,
+    名额被其他进程抢走时任务留在原位, 不会因为放回队列而改变用户之间的轮转顺序。
+    """
+
+    def __init__(self, prefix, task_classes):
+        self.prefix = prefix
+        self.task_classes = task_classes
+        self._push_script = None
+        self._pop_script = None
+        self._peek_script = None
+        self._take_script = None
+
+    @staticmethod
+    def _task(task_id, task_class, user_id, data, attempts=0):
+        return {
+            "id": str(task_id),
+            "class": task_class,
+            "user_id": user_id,
+            "data": data,
+            "attempts": attempts,
+            # 用于统计排队时间
+            "enqueue_time": time.time(),
+        }
+
+    def _push(self, task, front=False):
+        if self._push_script is None:
+            self._push_script = cache.register_script(PUSH_SCRIPT)
+        return self._push_script(
+            args=[
+                self.prefix,
+                task["id"],
+                json.dumps(task),
+                task["class"],
+                task["user_id"],
+                int(front),
+            ]
+        )
+
+    def push(self, task_id, task_class, user_id, data, front=False):
+        """
+        放入队列, 如果该任务正在处理中则会结束其租约
+        :return: 任务已经在排队时返回 0
+        """
+        return self._push(self._task(task_id, task_class, user_id, data), front)
+
+    def pop(self, count=1, timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        """
+        :return: [{"id", "class", "user_id", "data", "attempts", "enqueue_time"}, ...]
+        """
+        if count <= 0:
+            return []
+        if self._pop_script is None:
+            self._pop_script = cache.register_script(POP_SCRIPT)
+        result = self._pop_script(
+            args=[self.prefix, count, time.time() + timeout, *self.task_classes]
+        )
+        return [json.loads(item.decode("utf-8")) for item in result]
+
+    def peek(self, count=1):
+        """
+        按 pop 的顺序查看排在最前面的任务, 不取出
+        :return: 同 pop
+        """
+        if count <= 0:
+            return []
+        if self._peek_script is None:
+            self._peek_script = cache.register_script(PEEK_SCRIPT)
+        result = self._peek_script(args=[self.prefix, count, *self.task_classes])
+        return [json.loads(item.decode("utf-8")) for item in result]
+
+    def take(self, task, timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        """
+        取出 peek 返回的任务, 进入处理中状态
+        :return: 任务已经被其他进程取出或者有同一用户的任务插到了前面时返回 False, 队列不变
+        """
+        if self._take_script is None:
+            self._take_script = cache.register_script(TAKE_SCRIPT)
+        return bool(
+            self._take_script(
+                args=[
+                    self.prefix,
+                    task["id"],
+                    task["class"],
+                    task["user_id"],
+                    time.time() + timeout,
+                ]
+            )
+        )
+
+    def lease(self, task_id, task_class, user_id, data, timeout):
+        """
+        登记或续期一个处理中的任务, 没有经过队列直接开始判题的任务也需要登记
+        """
+        task_id = str(task_id)
+        raw = cache.hget(f"{self.prefix}:tasks", task_id)
+        attempts = json.loads(raw.decode("utf-8"))["attempts"] if raw else 0
+        task = self._task(task_id, task_class, user_id, data, attempts)
+        pipe = cache.pipeline()
+        pipe.hset(f"{self.prefix}:tasks", task_id, json.dumps(task))
+        pipe.zadd(f"{self.prefix}:inflight", {task_id: time.time() + timeout})
+        pipe.execute()
+
+    def ack(self, task_id):
+        pipe = cache.pipeline()
+        pipe.hdel(f"{self.prefix}:tasks", str(task_id))
+        pipe.zrem(f"{self.prefix}:inflight", str(task_id))
+        pipe.execute()
+
+    def contains(self, task_id):
+        return bool(cache.hexists(f"{self.prefix}:tasks", str(task_id)))
+
+    def _retry(self, task, exclude=None):
+        task["attempts"] += 1
+        if exclude is not None:
+            task["data"]["exclude"] = task["data"].get("exclude", []) + [exclude]
+        if task["attempts"] >= MAX_ATTEMPTS:
+            self.ack(task["id"])
+            return False
+        self._push(task, front=True)
+        return True
+
+    def retry(self, task_id, exclude=None):
+        """
+        处理中的任务失败后放回队列最前面重试
+        :param exclude: 本次失败的 server_id, 重试时尽量避开
+        :return: 任务不存在或超过重试次数时返回 False, 并结束该任务
+        """
+        raw = cache.hget(f"{self.prefix}:tasks", str(task_id))
+        if not raw:
+            return False
+        return self._retry(json.loads(raw.decode("utf-8")), exclude)
+
+    def requeue_expired(self, limit=500):
+        """
+        把租约过期的任务放回队列最前面, 超过重试次数的任务直接结束
+        :return: 被放弃的任务列表
+        """
+        abandoned = []
+        task_ids = cache.zrangebyscore(
+            f"{self.prefix}:inflight", "-inf", time.time(), start=0, num=limit
+        )
+        for task_id in task_ids:
+            raw = cache.hget(f"{self.prefix}:tasks", task_id)
+            if not raw:
+                cache.zrem(f"{self.prefix}:inflight", task_id)
+                continue
+            task = json.loads(raw.decode("utf-8"))
+            if self._retry(task):
+                logger.warning(
+                    f"Lease of {self.prefix} task {task['id']} expired, requeue"
+                )
+            else:
+                abandoned.append(task)
+        return abandoned
+
+    def depth(self):
+        sizes = cache.mget(
+            [f"{self.prefix}:{task_class}:size" for task_class in self.task_classes]
+        )
+        return {
+            task_class: int(size or 0)
+            for task_class, size in zip(self.task_classes, sizes)
+        }
+
+
+# 判题和运行自定义输入各自使用独立的通道, 互不混入对方的任务
+judge_queue = JudgeTaskScheduler(
+    f"{CacheKey.judge_queue}:{JudgeLane.JUDGE}", JUDGE_TASK_CLASSES
+)
+compile_run_queue = JudgeTaskScheduler(
+    f"{CacheKey.judge_queue}:{JudgeLane.COMPILE_RUN}", [JudgeTaskClass.COMPILE_RUN]
+)
+
+
+def queue_depth():
+    return {
+        JudgeLane.JUDGE: judge_queue.depth(),
+        JudgeLane.COMPILE_RUN: compile_run_queue.depth(),
+    }
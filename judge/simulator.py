@@ -0,0 +1,351 @@
+"""
+离散事件模拟判题集群, 用于比较 judge.policies 中不同的服务器选择策略, 或者回放历史提交估计需要的服务器数,
+不依赖 redis 和数据库。
+
+每台服务器有 cpu_core 个并行的判题进程, 超出的请求在服务器内部排队;
+分配器一侧和线上一样按并发上限发放名额, 没有名额时任务在全局队列中等待,
+全局队列和 judge.scheduler 一样按类别的优先级出队, 同一类别内按用户轮转。
+并发上限和线上一样根据请求耗时、超时时间、心跳上报的 cpu 占用和结果中是否有超时的测试点调整,
+失败的任务和 JudgeTaskScheduler.retry 一样放回队列最前面, 尽量换一台服务器重试。
+"""
+import heapq
+import random
+from collections import OrderedDict, deque
+
+from judge.client import judge_timeout
+from judge.policies import ServerState, adjust_limit, initial_limit
+from judge.scheduler import JUDGE_TASK_CLASSES, MAX_ATTEMPTS, JudgeTaskClass
+
+# 模拟心跳上报 cpu 占用的间隔（秒）
+HEARTBEAT_INTERVAL = 1
+# 请求失败时 judge server 返回所需的时间（秒）
+ERROR_COST = 0.05
+# 测试用例不在页缓存中、spj 需要重新编译时额外的判题时间（秒）
+COLD_START_COST = 0.5
+
+
+class SimulatedServer:
+    def __init__(self, id, cpu_core, speed=1.0, error_rate=0.0, cache_size=10):
+        """
+        :param speed: 相对速度, 判题耗时为 work / speed
+        :param error_rate: 请求失败的概率
+        :param cache_size: 能同时保持在缓存中的题目数
+        """
+        self.id = id
+        self.cpu_core = cpu_core
+        self.speed = speed
+        self.error_rate = error_rate
+        self.limit = initial_limit(cpu_core)
+        self.latency = 0
+        self.cpu_usage = 0
+        # 已经发放的名额数
+        self.used = 0
+        # 正在运行的判题进程数和服务器内部的等待队列
+        self.running = 0
+        self.backlog = deque()
+        self.cache_size = cache_size
+        self.warm = OrderedDict()
+
+    def warm_up(self, key):
+        """
+        :return: 该题目的数据是否已经在缓存中
+        """
+        if key is None:
+            return True
+        if key in self.warm:
+            self.warm.move_to_end(key)
+            return True
+        self.warm[key] = True
+        if len(self.warm) > self.cache_size:
+            self.warm.popitem(last=False)
+        return False
+
+    def state(self):
+        return ServerState(
+            self.id,
+            max(int(self.limit), 1),
+            self.used,
+            self.cpu_core,
+            cpu_usage=self.cpu_usage,
+            latency=self.latency,
+        )
+
+
+class SimulatedJob:
+    def __init__(self, arrival, work, key, timeout=None, time_limit_exceeded=False):
+        """
+        :param work: 在速度为 1 的服务器上的判题耗时（秒）
+        :param timeout: 判题请求的超时时间（秒）, 见 judge.client.judge_timeout
+        :param time_limit_exceeded: 结果中是否有超时的测试点
+        """
+        self.arrival = arrival
+        self.work = work
+        self.key = key
+        self.timeout = timeout
+        self.time_limit_exceeded = time_limit_exceeded
+        # 已经失败的次数和失败过的服务器
+        self.attempts = 0
+        self.exclude = []
+
+
+class SimulatedQueue:
+    """
+    和 judge.scheduler.JudgeTaskScheduler 相同的出队顺序: 类别之间按优先级, 类别内按用户轮转
+    """
+
+    def __init__(self, task_classes=JUDGE_TASK_CLASSES):
+        # {类别: {user_id: deque}}, dict 保持插入顺序, 即轮转顺序
+        self.classes = {task_class: {} for task_class in task_classes}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, item, task_class=JudgeTaskClass.PRACTICE, user_id=None, front=False):
+        """
+        :param front: 插到该用户的最前面, 不在队列中的用户排到轮转的最前面
+        """
+        users = self.classes[task_class]
+        if front:
+            if user_id not in users:
+                self.classes[task_class] = users = {user_id: deque(), **users}
+            users[user_id].appendleft(item)
+        else:
+            users.setdefault(user_id, deque()).append(item)
+        self.size += 1
+
+    def peek(self):
+        for users in self.classes.values():
+            if users:
+                return users[next(iter(users))][0]
+        return None
+
+    def pop(self):
+        for users in self.classes.values():
+            if not users:
+                continue
+            user_id = next(iter(users))
+            tasks = users.pop(user_id)
+            item = tasks.popleft()
+            # 还有任务的用户排到最后
+            if tasks:
+                users[user_id] = tasks
+            self.size -= 1
+            return item
+        return None
+
+
+def estimate_work(info, exec_time=0, compile_cost=0.5, default_work=1.0):
+    """
+    估计一个历史提交在速度为 1 的服务器上的判题耗时（秒）
+    :param info: Submission.info, 按测试点的 real_time 之和加上编译时间
+    :param exec_time: Submission.exec_time（毫秒）, 没有 info 时使用
+    :param default_work: 两者都没有（如编译错误、系统错误）时的耗时, 编译错误只计编译时间
+    """
+    cases = (info or {}).get("data") or []
+    if cases:
+        real_time = sum(
+            case.get("real_time") or case.get("cpu_time") or 0 for case in cases
+        )
+        return compile_cost + real_time / 1000
+    if exec_time:
+        return compile_cost + exec_time / 1000
+    return default_work
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class Simulation:
+    def __init__(self, servers, policy, adaptive=True, seed=0):
+        """
+        :param policy: judge.policies.SelectionPolicy
+        :param adaptive: False 时并发上限固定为 cpu_core * 2
+        """
+        self.servers = servers
+        self.policy = policy
+        self.adaptive = adaptive
+        self.random = random.Random(seed)
+        self.now = 0
+        self.events = []
+        self.sequence = 0
+        self.queue = SimulatedQueue()
+        self.latencies = []
+        # 在全局队列中等待的时间
+        self.waits = []
+        # 重试次数和超过重试次数被放弃的任务数
+        self.retries = 0
+        self.errors = 0
+        self.cold_starts = 0
+        self.max_queue_length = 0
+
+    def schedule(self, at, callback, *args):
+        self.sequence += 1
+        heapq.heappush(self.events, (at, self.sequence, callback, args))
+
+    def choose(self, key, exclude=None):
+        candidates = [
+            server.state()
+            for server in self.servers
+            if server.used < max(int(server.limit), 1)
+        ]
+        # 和 JudgeSlotAllocator.acquire 一样, 没有其他服务器时仍然选择失败过的
+        if exclude:
+            candidates = [
+                state for state in candidates if state.id not in exclude
+            ] or candidates
+        if not candidates:
+            return None
+        return self.servers_by_id[self.policy.order(candidates, key=key)[0].id]
+
+    def dispatch(self):
+        while self.queue:
+            job, _, _ = self.queue.peek()
+            server = self.choose(job.key, job.exclude)
+            if not server:
+                break
+            job, task_class, user_id = self.queue.pop()
+            if not job.attempts:
+                self.waits.append(self.now - job.arrival)
+            server.used += 1
+            work = job.work
+            if not server.warm_up(job.key):
+                self.cold_starts += 1
+                work += COLD_START_COST
+            self.start(server, (job, task_class, user_id), self.now, work)
+
+    def start(self, server, item, sent, work):
+        if self.random.random() < server.error_rate:
+            self.schedule(self.now + ERROR_COST, self.finish, server, item, sent, False)
+        elif server.running < server.cpu_core:
+            server.running += 1
+            self.schedule(
+                self.now + work / server.speed, self.complete, server, item, sent
+            )
+        else:
+            server.backlog.append((item, sent, work))
+
+    def complete(self, server, item, sent):
+        server.running -= 1
+        if server.backlog:
+            next_item, next_sent, work = server.backlog.popleft()
+            server.running += 1
+            self.schedule(
+                self.now + work / server.speed,
+                self.complete,
+                server,
+                next_item,
+                next_sent,
+            )
+        self.finish(server, item, sent, True)
+
+    def finish(self, server, item, sent, ok):
+        job, task_class, user_id = item
+        server.used -= 1
+        cost = self.now - sent
+        # 超过超时时间的请求在线上会被中断, 按失败处理
+        if job.timeout and cost > job.timeout:
+            ok = False
+        limit, server.latency = adjust_limit(
+            server.limit,
+            server.latency,
+            cost,
+            ok,
+            server.cpu_core,
+            timeout=job.timeout,
+            cpu_usage=server.cpu_usage,
+            time_limit_exceeded=ok and job.time_limit_exceeded,
+        )
+        if self.adaptive:
+            server.limit = limit
+        if ok:
+            self.latencies.append(self.now - job.arrival)
+        else:
+            job.attempts += 1
+            job.exclude.append(server.id)
+            if job.attempts >= MAX_ATTEMPTS:
+                self.errors += 1
+            else:
+                self.retries += 1
+                self.queue.push(item, task_class, user_id, front=True)
+        self.dispatch()
+
+    def arrive(self, job, task_class=JudgeTaskClass.PRACTICE, user_id=None):
+        self.queue.push((job, task_class, user_id), task_class, user_id)
+        self.max_queue_length = max(self.max_queue_length, len(self.queue))
+        self.dispatch()
+
+    def heartbeat(self):
+        for server in self.servers:
+            server.cpu_usage = min(server.running / server.cpu_core, 1) * 100
+        self.schedule(self.now + HEARTBEAT_INTERVAL, self.heartbeat)
+
+    def run(self, arrival_rate, duration, mean_work=1.0, problems=0, time_limit=None):
+        """
+        :param arrival_rate: 每秒提交数, 按泊松过程到达
+        :param duration: 模拟的提交时长（秒）, 之后不再有新提交, 等待全部完成
+        :param mean_work: 单个提交在速度为 1 的服务器上的平均判题时间（秒）, 服从指数分布
+        :param problems: 题目数, 提交按 zipf 分布落在各题上; 0 表示不模拟题目缓存
+        :param time_limit: 题目时限（秒）, 判题时间超过时限的提交结果为超时, 运行时间最多为时限的 3 倍。
+            默认为 mean_work 的 3 倍
+        """
+        time_limit = time_limit or mean_work * 3
+        timeout = judge_timeout(time_limit * 1000)
+        self.servers_by_id = {server.id: server for server in self.servers}
+        weights = [1 / (i + 1) for i in range(problems)]
+        at = 0
+        while True:
+            at += self.random.expovariate(arrival_rate)
+            if at > duration:
+                break
+            key = None
+            if problems:
+                key = str(self.random.choices(range(problems), weights)[0])
+            work = self.random.expovariate(1 / mean_work)
+            job = SimulatedJob(
+                at, min(work, time_limit * 3), key, timeout, work > time_limit
+            )
+            self.schedule(at, self.arrive, job)
+        return self.simulate()
+
+    def replay(self, jobs):
+        """
+        回放历史提交
+        :param jobs: [(到达时间（秒）, 判题耗时, 题目的 key, 类别, user_id, 超时时间, 结果中是否有超时的测试点), ...],
+            最后两项可以省略
+        """
+        self.servers_by_id = {server.id: server for server in self.servers}
+        for at, work, key, task_class, user_id, *extra in jobs:
+            job = SimulatedJob(at, work, key, *extra)
+            self.schedule(at, self.arrive, job, task_class, user_id)
+        return self.simulate()
+
+    def simulate(self):
+        self.schedule(0, self.heartbeat)
+        while self.events:
+            at, _, callback, args = heapq.heappop(self.events)
+            # 只剩心跳事件时结束
+            if callback == self.heartbeat and len(self.events) == 0:
+                break
+            self.now = at
+            callback(*args)
+
+        return {
+            "completed": len(self.latencies),
+            "errors": self.errors,
+            "retries": self.retries,
+            "cold_starts": self.cold_starts,
+            "throughput": len(self.latencies) / self.now if self.now else 0,
+            "mean": sum(self.latencies) / len(self.latencies) if self.latencies else 0,
+            "p50": percentile(self.latencies, 50),
+            "p95": percentile(self.latencies, 95),
+            "p99": percentile(self.latencies, 99),
+            "wait_p50": percentile(self.waits, 50),
+            "wait_p95": percentile(self.waits, 95),
+            "wait_p99": percentile(self.waits, 99),
+            "max_queue_length": self.max_queue_length,
+        }
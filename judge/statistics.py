@@ -0,0 +1,453 @@
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Min
+
+from account.models import AdminType, User, UserProfile
+from contest.models import ACMContestRank, Contest, ContestRuleType, OIContestRank
+from problem.models import Problem, ProblemRuleType
+from submission.models import JudgeStatus, Submission
+from utils.cache import cache
+from utils.constants import CacheKey
+
+logger = logging.getLogger(__name__)
+
+# 每次从 redis 中取出的待重新计算的 用户-题目 / 比赛-用户 数
+FLUSH_BATCH_SIZE = 500
+
+# 写回数据库后扣除已经写回的增量, 扣到 0 的字段删除。写回期间新增的增量保留到下一次
+# KEYS[1]: 增量 hash  ARGV: field1, value1, field2, value2, ...
+SUBTRACT_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    if redis.call("HINCRBY", KEYS[1], ARGV[i], -tonumber(ARGV[i + 1])) == 0 then
+        redis.call("HDEL", KEYS[1], ARGV[i])
+    end
+end
+return 1
+"""
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class JudgeStatistics:
+    """
+    题目、用户和比赛排名统计信息的 write-behind 聚合。
+
+    判题结束时只在 redis 中记录增量: 题目的提交数、通过数和各结果的数量用 HINCRBY 累加,
+    用户的题目状态和比赛排名依赖提交顺序, 只记录需要重新计算的 用户-题目 和 比赛-用户,
+    由 flush_judge_statistics 定期批量写回数据库, 判题过程中不再锁 Problem 和 User 的行。
+
+    每个提交计入统计的结果保存在 Submission.statistic_result 中, 重新判题时先减去旧结果再加上新结果;
+    用户状态和排名按 statistic_result 从提交记录重新计算, 所以重复计算也不会出错。
+    """
+
+    problem_key = f"{CacheKey.judge_statistics}:problem"
+    user_key = f"{CacheKey.judge_statistics}:user"
+    user_problems_key = f"{CacheKey.judge_statistics}:user_problems"
+    contest_users_key = f"{CacheKey.judge_statistics}:contest_users"
+
+    def __init__(self):
+        self._subtract_script = None
+
+    @staticmethod
+    def _first_ac_key(contest_id):
+        return f"{CacheKey.judge_statistics}:first_ac:{contest_id}"
+
+    def collect(self, items):
+        """
+        计算提交应当计入统计的结果, 写到 submission.statistic_result 上, 需要和判题结果一起保存。
+        比赛开始前、结束后和比赛管理员的提交, 以及 SYSTEM_ERROR 不计入统计
+        :param items: [(submission, problem), ...], submission.result 为新的判题结果
+        :return: 保存后传给 record 的变化
+        """
+        contest_ids = {
+            submission.contest_id for submission, _ in items if submission.contest_id
+        }
+        contests = Contest.objects.in_bulk(contest_ids) if contest_ids else {}
+        super_admins = set()
+        if contest_ids:
+            super_admins = set(
+                User.objects.filter(
+                    id__in=[s.user_id for s, _ in items if s.contest_id],
+                    admin_type=AdminType.SUPER_ADMIN,
+                ).values_list("id", flat=True)
+            )
+
+        changes = []
+        for submission, problem in items:
+            counted = submission.result != JudgeStatus.SYSTEM_ERROR
+            contest = contests.get(submission.contest_id)
+            if contest and counted:
+                counted = (
+                    contest.start_time <= submission.create_time <= contest.end_time
+                    and submission.user_id != contest.created_by_id
+                    and submission.user_id not in super_admins
+                )
+            old = submission.statistic_result
+            new = submission.result if counted else None
+            submission.statistic_result = new
+            if old is not None or new is not None:
+                changes.append((submission, problem, old, new))
+        return changes
+
+    def record(self, changes):
+        """
+        在 redis 中记录统计信息的增量
+        :param changes: collect 的返回值, 对应的提交已经保存
+        """
+        if not changes:
+            return
+        pipe = cache.pipeline(transaction=False)
+        for submission, problem, old, new in changes:
+            deltas = defaultdict(int)
+            for result, sign in ((old, -1), (new, 1)):
+                if result is None:
+                    continue
+                deltas["submission_number"] += sign
+                deltas[str(result)] += sign
+                if result == JudgeStatus.ACCEPTED:
+                    deltas["accepted_number"] += sign
+            for field, value in deltas.items():
+                if value:
+                    pipe.hincrby(self.problem_key, f"{problem.id}:{field}", value)
+            if not submission.contest_id and deltas["submission_number"]:
+                pipe.hincrby(
+                    self.user_key, submission.user_id, deltas["submission_number"]
+                )
+            pipe.sadd(self.user_problems_key, f"{submission.user_id}:{problem.id}")
+            if submission.contest_id:
+                pipe.sadd(
+                    self.contest_users_key,
+                    f"{submission.contest_id}:{submission.user_id}",
+                )
+        try:
+            pipe.execute()
+        except Exception as e:
+            # 统计失败不能影响判题
+            logger.exception(e)
+
+    def _subtract(self, key, data):
+        if not data:
+            return
+        if self._subtract_script is None:
+            self._subtract_script = cache.register_script(SUBTRACT_SCRIPT)
+        args = []
+        for field, value in data.items():
+            args.extend([field, value])
+        self._subtract_script(keys=[key], args=args)
+
+    @staticmethod
+    def _load_deltas(key):
+        return {_decode(k): int(v) for k, v in cache.hgetall(key).items()}
+
+    @staticmethod
+    def _pop(key):
+        return [
+            tuple(int(i) for i in _decode(member).split(":"))
+            for member in cache.spop(key, FLUSH_BATCH_SIZE) or []
+        ]
+
+    def flush(self):
+        """
+        把 redis 中的统计信息写回数据库
+        :return: {"problems": 更新的题目数, "users": 重新计算的用户题目数, "ranks": 重新计算的比赛排名数}
+        """
+        result = {"problems": self.flush_problems(), "users": 0, "ranks": 0}
+        while True:
+            count = self.flush_users()
+            result["users"] += count
+            if count < FLUSH_BATCH_SIZE:
+                break
+        while True:
+            count = self.flush_ranks()
+            result["ranks"] += count
+            if count < FLUSH_BATCH_SIZE:
+                break
+        return result
+
+    def flush_problems(self):
+        data = self._load_deltas(self.problem_key)
+        if not data:
+            return 0
+        deltas = defaultdict(dict)
+        for field, value in data.items():
+            problem_id, name = field.split(":", 1)
+            deltas[int(problem_id)][name] = value
+
+        with transaction.atomic():
+            problems = list(
+                Problem.objects.select_for_update()
+                .filter(id__in=deltas.keys())
+                .order_by("id")
+                .only("id", "submission_number", "accepted_number", "statistic_info")
+            )
+            for problem in problems:
+                delta = dict(deltas[problem.id])
+                problem.submission_number += delta.pop("submission_number", 0)
+                problem.accepted_number += delta.pop("accepted_number", 0)
+                for result, value in delta.items():
+                    count = problem.statistic_info.get(result, 0) + value
+                    if count:
+                        problem.statistic_info[result] = count
+                    else:
+                        problem.statistic_info.pop(result, None)
+            Problem.objects.bulk_update(
+                problems, ["submission_number", "accepted_number", "statistic_info"]
+            )
+        # 已经删除的题目的增量也一并清除
+        self._subtract(self.problem_key, data)
+        return len(problems)
+
+    @staticmethod
+    def _problem_status(rows, keep_accepted=True):
+        """
+        :param rows: 按提交时间排序的 (statistic_result, score)
+        :param keep_accepted: 通过后不再被之后的提交覆盖
+        :return: 计入用户状态的 (result, score)
+        """
+        if keep_accepted:
+            for row in rows:
+                if row[0] == JudgeStatus.ACCEPTED:
+                    return row
+        return rows[-1]
+
+    def flush_users(self):
+        pairs = self._pop(self.user_problems_key)
+        deltas = self._load_deltas(self.user_key)
+        if not pairs and not deltas:
+            return 0
+        try:
+            self._update_profiles(pairs, deltas)
+        except Exception:
+            # 放回去等下次重新计算
+            if pairs:
+                cache.sadd(self.user_problems_key, *[f"{u}:{p}" for u, p in pairs])
+            raise
+        self._subtract(self.user_key, deltas)
+        return len(pairs)
+
+    def _update_profiles(self, pairs, deltas):
+        problem_ids = {problem_id for _, problem_id in pairs}
+        problems = {
+            item["id"]: item
+            for item in Problem.objects.filter(id__in=problem_ids).values(
+                "id", "_id", "rule_type", "contest_id", "contest__rule_type"
+            )
+        }
+        rows = defaultdict(list)
+        if pairs:
+            submissions = (
+                Submission.objects.filter(
+                    user_id__in={user_id for user_id, _ in pairs},
+                    problem_id__in=problem_ids,
+                    statistic_result__isnull=False,
+                )
+                .order_by("create_time")
+                .values_list("user_id", "problem_id", "statistic_result", "score")
+            )
+            for user_id, problem_id, result, score in submissions:
+                rows[(user_id, problem_id)].append((result, score))
+        user_pairs = defaultdict(list)
+        for user_id, problem_id in pairs:
+            if problem_id in problems:
+                user_pairs[user_id].append(problem_id)
+        user_ids = set(user_pairs) | {int(user_id) for user_id in deltas}
+
+        with transaction.atomic():
+            profiles = list(
+                UserProfile.objects.select_for_update()
+                .filter(user_id__in=user_ids)
+                .order_by("id")
+            )
+            for profile in profiles:
+                for problem_id in user_pairs.get(profile.user_id, []):
+                    problem = problems[problem_id]
+                    if problem["contest_id"]:
+                        rule_type = problem["contest__rule_type"]
+                        group = "contest_problems"
+                        keep_accepted = rule_type == ContestRuleType.ACM
+                    else:
+                        rule_type = problem["rule_type"]
+                        group = "problems"
+                        keep_accepted = True
+                    if rule_type == ProblemRuleType.ACM:
+                        status = profile.acm_problems_status
+                    else:
+                        status = profile.oi_problems_status
+                    status = status.setdefault(group, {})
+                    problem_rows = rows.get((profile.user_id, problem_id))
+                    if not problem_rows:
+                        status.pop(str(problem_id), None)
+                        continue
+                    result, score = self._problem_status(problem_rows, keep_accepted)
+                    status[str(problem_id)] = {"status": result, "_id": problem["_id"]}
+                    if rule_type != ProblemRuleType.ACM:
+                        status[str(problem_id)]["score"] = score
+
+                acm_problems = profile.acm_problems_status.get("problems", {})
+                oi_problems = profile.oi_problems_status.get("problems", {})
+                profile.accepted_number = sum(
+                    1
+                    for item in list(acm_problems.values()) + list(oi_problems.values())
+                    if item["status"] == JudgeStatus.ACCEPTED
+                )
+                profile.total_score = sum(
+                    item.get("score", 0) for item in oi_problems.values()
+                )
+                profile.submission_number += deltas.get(str(profile.user_id), 0)
+            UserProfile.objects.bulk_update(
+                profiles,
+                [
+                    "acm_problems_status",
+                    "oi_problems_status",
+                    "accepted_number",
+                    "total_score",
+                    "submission_number",
+                ],
+            )
+
+    def flush_ranks(self):
+        pairs = self._pop(self.contest_users_key)
+        if not pairs:
+            return 0
+        by_contest = defaultdict(set)
+        for contest_id, user_id in pairs:
+            by_contest[contest_id].add(user_id)
+        contests = Contest.objects.in_bulk(by_contest.keys())
+        failed = []
+        for contest_id, user_ids in by_contest.items():
+            contest = contests.get(contest_id)
+            if not contest:
+                continue
+            try:
+                with transaction.atomic():
+                    self._update_ranks(contest, user_ids)
+            except Exception as e:
+                logger.exception(e)
+                failed.extend(f"{contest_id}:{user_id}" for user_id in user_ids)
+                continue
+            if contest.rule_type == ContestRuleType.OI or contest.real_time_rank:
+                cache.delete(f"{CacheKey.contest_rank_cache}:{contest.id}")
+        if failed:
+            cache.sadd(self.contest_users_key, *failed)
+        return len(pairs)
+
+    def _first_ac(self, contest, user_ids):
+        """
+        查询每道题的一血时间, 一血易主时原来和现在的一血用户都加入 user_ids 重新计算
+        :return: {problem_id: 一血的提交时间}
+        """
+        first_times = dict(
+            Submission.objects.filter(
+                contest_id=contest.id, statistic_result=JudgeStatus.ACCEPTED
+            )
+            .order_by()
+            .values("problem_id")
+            .annotate(first=Min("create_time"))
+            .values_list("problem_id", "first")
+        )
+        first_users = {}
+        for problem_id, user_id, create_time in Submission.objects.filter(
+            contest_id=contest.id,
+            statistic_result=JudgeStatus.ACCEPTED,
+            create_time__in=first_times.values(),
+        ).values_list("problem_id", "user_id", "create_time"):
+            if first_times.get(problem_id) == create_time:
+                first_users[str(problem_id)] = str(user_id)
+
+        key = self._first_ac_key(contest.id)
+        old_users = {_decode(k): _decode(v) for k, v in cache.hgetall(key).items()}
+        if old_users != first_users:
+            for problem_id in set(old_users) | set(first_users):
+                for users in (old_users, first_users):
+                    if problem_id in users:
+                        user_ids.add(int(users[problem_id]))
+            pipe = cache.pipeline()
+            pipe.delete(key)
+            if first_users:
+                pipe.hset(key, mapping=first_users)
+            pipe.execute()
+        return first_times
+
+    def _update_ranks(self, contest, user_ids):
+        if contest.rule_type == ContestRuleType.ACM:
+            model = ACMContestRank
+            first_times = self._first_ac(contest, user_ids)
+        else:
+            model = OIContestRank
+        rows = defaultdict(list)
+        for user_id, problem_id, result, score, create_time in (
+            Submission.objects.filter(
+                contest_id=contest.id,
+                user_id__in=user_ids,
+                statistic_result__isnull=False,
+            )
+            .order_by("create_time")
+            .values_list(
+                "user_id", "problem_id", "statistic_result", "score", "create_time"
+            )
+        ):
+            rows[user_id].append((str(problem_id), result, score, create_time))
+
+        ranks = list(
+            model.objects.select_for_update().filter(
+                contest=contest, user_id__in=user_ids
+            )
+        )
+        # 第一次计入统计的用户创建排名, 提交都不再计入统计的用户排名清零
+        created = [
+            model(user_id=user_id, contest=contest)
+            for user_id in set(rows) - {rank.user_id for rank in ranks}
+        ]
+        for rank in ranks + created:
+            if model is ACMContestRank:
+                self._compute_acm_rank(rank, rows[rank.user_id], contest, first_times)
+            else:
+                self._compute_oi_rank(rank, rows[rank.user_id])
+        if model is ACMContestRank:
+            fields = ["submission_number", "accepted_number", "total_time"]
+        else:
+            fields = ["submission_number", "total_score"]
+        model.objects.bulk_update(ranks, fields + ["submission_info"])
+        model.objects.bulk_create(created)
+
+    @staticmethod
+    def _compute_acm_rank(rank, rows, contest, first_times):
+        # 通过之前的每次非编译错误的提交罚时 20 分钟, 通过之后的提交不再计入
+        info = {}
+        rank.submission_number = rank.accepted_number = 0
+        total_time = 0
+        for problem_id, result, _, create_time in rows:
+            item = info.setdefault(
+                problem_id,
+                {"is_ac": False, "ac_time": 0, "error_number": 0, "is_first_ac": False},
+            )
+            if item["is_ac"]:
+                continue
+            rank.submission_number += 1
+            if result == JudgeStatus.ACCEPTED:
+                rank.accepted_number += 1
+                item["is_ac"] = True
+                item["ac_time"] = (create_time - contest.start_time).total_seconds()
+                item["is_first_ac"] = first_times.get(int(problem_id)) == create_time
+                total_time += item["ac_time"] + item["error_number"] * 20 * 60
+            elif result != JudgeStatus.COMPILE_ERROR:
+                item["error_number"] += 1
+        rank.total_time = int(total_time)
+        rank.submission_info = info
+
+    @staticmethod
+    def _compute_oi_rank(rank, rows):
+        # 每道题以最后一次提交的得分为准
+        info = {}
+        for problem_id, _, score, _ in rows:
+            info[problem_id] = score
+        rank.submission_number = len(rows)
+        rank.total_score = sum(info.values())
+        rank.submission_info = info
+
+
+judge_statistics = JudgeStatistics()
@@ -1,14 +1,161 @@
+import logging
+import time
+from datetime import timedelta
+
 from celery import shared_task
+from django.utils import timezone
 
 from account.models import User
-from submission.models import Submission
-from judge.dispatcher import JudgeDispatcher
+from compilerun.dispatcher import (
+    process_pending_task as process_pending_compile_run_task,
+)
+from compilerun.models import CompileRun, CompileRunStatus
+from contest.models import Contest
+from problem.models import Problem
+from submission.models import JudgeStatus, Submission
+from judge.allocator import JudgeLane, JudgeSlot, slot_allocator
+from judge.dispatcher import (
+    JudgeDispatcher,
+    judge_task_class,
+    process_pending_task,
+)
+from judge.heartbeat import heartbeat_store
+from judge.metrics import JudgeStage, StageTimer
+from judge.notifier import ResultKind, result_notifier
+from judge.rejudge import rejudge_jobs
+from judge.scheduler import DEFAULT_VISIBILITY_TIMEOUT, compile_run_queue, judge_queue
+from judge.statistics import judge_statistics
 from utils.shortcuts import DRAMATIQ_WORKER_ARGS
 
+logger = logging.getLogger(__name__)
+
+# 创建超过这么久（秒）仍处于判题中, 且既不在队列中也没有租约的提交会被重新放回队列
+STUCK_SUBMISSION_TIMEOUT = 30 * 60
+
 
 @shared_task
-def judge_task(submission_id, problem_id):
-    uid = Submission.objects.get(id=submission_id).user_id
-    if User.objects.get(id=uid).is_disabled:
+def judge_task(submission_id, problem_id, exclude=None, enqueue_time=None, slot=None):
+    """
+    :param enqueue_time: 放入队列或调用 delay 的时间, 用于统计排队时间
+    :param slot: process_pending_task 已经获取的名额, JudgeSlot 的属性
+    """
+    timer = StageTimer(JudgeLane.JUDGE)
+    if enqueue_time:
+        timer.add(JudgeStage.QUEUE_WAIT, time.time() - enqueue_time)
+    with timer.measure(JudgeStage.FETCH):
+        submission = Submission.objects.get(id=submission_id)
+        dispatcher = None
+        if not User.objects.get(id=submission.user_id).is_disabled:
+            try:
+                dispatcher = JudgeDispatcher(
+                    submission_id, problem_id, submission=submission, timer=timer
+                )
+            except Problem.DoesNotExist:
+                # 题目已经被删除或者不属于提交所在的比赛
+                logger.warning(
+                    f"Problem {problem_id} of submission {submission_id} does not exist"
+                )
+    slot = JudgeSlot(**slot) if slot else None
+    if not dispatcher:
+        if slot:
+            slot_allocator.release(slot)
+        Submission.objects.filter(id=submission_id).update(is_judging=False)
+        judge_queue.ack(submission_id)
+        timer.flush()
         return
-    JudgeDispatcher(submission_id, problem_id).judge()
+    dispatcher.judge(exclude=exclude, slot=slot)
+    # 结果在回调或 async worker 中处理时, 先写入已经记录的阶段
+    timer.flush()
+
+
+def dispatch_judge_task(submission, contest=None, enqueue_time=None):
+    """
+    不经过队列直接发出 judge_task, 发出前在 judge_queue 中登记租约,
+    这样还在 broker 中等待的任务不会被 recover_judge_tasks 当作丢失的提交再放回队列
+    :param contest: 提交所在的比赛, 用于确定任务类别
+    """
+    if submission.contest_id and contest is None:
+        contest = Contest.objects.get(id=submission.contest_id)
+    data = {"submission_id": submission.id, "problem_id": submission.problem_id}
+    judge_queue.lease(
+        submission.id,
+        judge_task_class(contest, rejudge=bool(submission.info)),
+        submission.user_id,
+        data,
+        DEFAULT_VISIBILITY_TIMEOUT,
+    )
+    judge_task.delay(**data, enqueue_time=enqueue_time)
+
+
+@shared_task
+def recover_judge_tasks():
+    """
+    由 celery beat 定时执行:
+     - 租约过期的任务放回队列, 多次失败的直接标记为 SYSTEM_ERROR
+     - 找回 worker 崩溃后一直处于判题中的提交
+     - 按 redis 中的租约校正 judge_server 的 task_number
+    """
+    for task in judge_queue.requeue_expired():
+        logger.error(
+            f"Submission {task['id']} abandoned after {task['attempts']} attempts"
+        )
+        Submission.objects.filter(id=task["id"]).update(
+            result=JudgeStatus.SYSTEM_ERROR, is_judging=False
+        )
+        result_notifier.publish(
+            ResultKind.SUBMISSION, task["id"], JudgeStatus.SYSTEM_ERROR
+        )
+    for task in compile_run_queue.requeue_expired():
+        CompileRun.objects.filter(id=task["id"]).update(
+            result=CompileRunStatus.SYSTEM_ERROR
+        )
+        result_notifier.publish(
+            ResultKind.COMPILE_RUN, task["id"], CompileRunStatus.SYSTEM_ERROR
+        )
+
+    # 所有判题任务在排队, 等待 judge_task 执行和判题期间都在 judge_queue 中, 不在其中的才是丢失的
+    deadline = timezone.now() - timedelta(seconds=STUCK_SUBMISSION_TIMEOUT)
+    submissions = Submission.objects.filter(
+        is_judging=True, create_time__lt=deadline
+    ).only("id", "problem_id", "user_id", "contest_id", "info")[:500]
+    submissions = [s for s in submissions if not judge_queue.contains(s.id)]
+    contests = Contest.objects.in_bulk(
+        {s.contest_id for s in submissions if s.contest_id}
+    )
+    for submission in submissions:
+        logger.warning(f"Submission {submission.id} is stuck, requeue")
+        task_class = judge_task_class(
+            contests.get(submission.contest_id), rejudge=bool(submission.info)
+        )
+        data = {"submission_id": submission.id, "problem_id": submission.problem_id}
+        judge_queue.push(submission.id, task_class, submission.user_id, data)
+
+    slot_allocator.refresh(force=True)
+    process_pending_task()
+    process_pending_compile_run_task()
+
+
+@shared_task
+def flush_judge_heartbeats():
+    """
+    由 celery beat 定时执行, 把 redis 中的心跳数据写回 judge_server 表
+    """
+    heartbeat_store.flush()
+
+
+@shared_task
+def flush_judge_statistics():
+    """
+    由 celery beat 定时执行, 把 redis 中累计的题目、用户和比赛排名统计信息写回数据库
+    """
+    result = judge_statistics.flush()
+    if any(result.values()):
+        logger.info(f"Judge statistics flushed: {result}")
+
+
+@shared_task
+def advance_rejudge_jobs():
+    """
+    由 celery beat 定时执行, 推进进行中的批量重新判题任务
+    """
+    rejudge_jobs.advance_all()
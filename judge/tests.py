@@ -0,0 +1,1362 @@
+import asyncio
+import hashlib
+import threading
+import time
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+from urllib.parse import urljoin
+
+import aiohttp
+import requests
+from asgiref.sync import async_to_sync
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from account.models import User, UserProfile
+from contest.models import ACMContestRank, Contest, ContestRuleType
+from conf.models import JudgeServer
+from options.options import SysOptions
+from problem.models import Problem
+from submission.models import JudgeStatus, Submission
+from submission.tests import DEFAULT_PROBLEM_DATA
+from utils.api.tests import APITestCase
+from utils.cache import cache
+from utils.constants import CacheKey
+from . import admission, breaker
+from .admission import judge_admission
+from .allocator import JudgeLane, JudgeSlot, slot_allocator
+from .async_worker import AsyncJudgeWorker
+from .breaker import CircuitState, circuit_breaker
+from .client import (
+    JudgeServerClient,
+    get_client,
+    get_client_stats,
+    hedge_delay,
+    judge_timeout,
+)
+from .context import problem_context_cache
+from .dispatcher import (
+    ChooseJudgeServer,
+    JudgeDispatcher,
+    JudgeDispatchMode,
+    process_pending_task,
+)
+from .heartbeat import heartbeat_store
+from .metrics import JudgeStage, judge_metrics
+from .management.commands.judge_callback_proxy import make_server
+from .mock_server import LatencyDistribution, MockJudgeServer, start_mock_server
+from .notifier import ResultKind, result_notifier
+from .policies import POLICIES, ServerState, adjust_limit, initial_limit
+from .registry import judge_server_registry
+from .rejudge import RejudgeJobStatus, rejudge_jobs
+from .result_cache import result_cache
+from .scheduler import (
+    JudgeTaskClass,
+    JudgeTaskScheduler,
+    JUDGE_TASK_CLASSES,
+    MAX_ATTEMPTS,
+    judge_queue,
+)
+from .simulator import SimulatedQueue, Simulation, SimulatedServer, estimate_work
+from .statistics import judge_statistics
+from .tasks import dispatch_judge_task, judge_task, recover_judge_tasks
+
+
+class JudgeServerTestMixin:
+    def create_server(self, hostname, cpu_core=1, **kwargs):
+        data = {
+            "hostname": hostname,
+            "judger_version": "2.0.0",
+            "cpu_core": cpu_core,
+            "cpu_usage": 10,
+            "memory_usage": 10,
+            "last_heartbeat": timezone.now(),
+            "service_url": f"http://{hostname}:8080",
+        }
+        data.update(kwargs)
+        return JudgeServer.objects.create(**data)
+
+
+class JudgeSlotAllocatorTest(JudgeServerTestMixin, TestCase):
+    def setUp(self):
+        self.server = self.create_server("server1")
+        slot_allocator.reset()
+
+    def test_acquire_and_release(self):
+        # cpu_core=1 的服务器共 2 个名额, 判题通道最多占用 1 个
+        slot = slot_allocator.acquire()
+        self.assertEqual(slot.service_url, self.server.service_url)
+        self.assertIsNone(slot_allocator.acquire())
+        self.assertEqual(slot_allocator.available(JudgeLane.JUDGE), 0)
+        self.assertEqual(slot_allocator.available(JudgeLane.COMPILE_RUN), 1)
+
+        self.assertIsNotNone(slot_allocator.acquire(JudgeLane.COMPILE_RUN))
+        self.assertIsNone(slot_allocator.acquire(JudgeLane.COMPILE_RUN))
+
+        slot_allocator.release(slot)
+        self.assertIsNotNone(slot_allocator.acquire())
+
+    def test_choose_least_loaded_server(self):
+        server2 = self.create_server("server2", cpu_core=4)
+        slot_allocator.refresh(force=True)
+        hostnames = [slot_allocator.acquire().hostname for _ in range(4)]
+        self.assertEqual(hostnames.count(server2.hostname), 3)
+
+    def test_cached_snapshot(self):
+        self.create_server("server2", cpu_core=4)
+        slot_allocator.refresh(force=True)
+        with mock.patch.object(
+            slot_allocator, "snapshot", wraps=slot_allocator.snapshot
+        ) as mocked_snapshot:
+            slots = [slot_allocator.acquire() for _ in range(4)]
+            self.assertEqual(mocked_snapshot.call_count, 1)
+            # 本进程获取和释放的名额同步到缓存中
+            available = slot_allocator.available()
+            slot_allocator.release(slots[0])
+            self.assertEqual(slot_allocator.available(), available + 1)
+            self.assertEqual(mocked_snapshot.call_count, 1)
+        self.assertEqual(len({slot.lease_id for slot in slots}), 4)
+
+    def test_expired_lease_is_reclaimed(self):
+        slot_allocator.acquire(timeout=-1)
+        self.assertIsNotNone(slot_allocator.acquire())
+
+    def test_unavailable_server_is_skipped(self):
+        JudgeServer.objects.filter(id=self.server.id).update(is_disabled=True)
+        self.create_server(
+            "server2", last_heartbeat=timezone.now() - timedelta(seconds=60)
+        )
+        slot_allocator.refresh(force=True)
+        self.assertIsNone(slot_allocator.acquire())
+
+    def test_task_number_reconcile(self):
+        with ChooseJudgeServer() as server:
+            slot_allocator.reconcile()
+            self.assertEqual(JudgeServer.objects.get(id=server.id).task_number, 1)
+        slot_allocator.reconcile()
+        self.assertEqual(JudgeServer.objects.get(id=self.server.id).task_number, 0)
+
+    def test_adaptive_limit(self):
+        slot = slot_allocator.acquire()
+        slot_allocator.release(slot)
+        slot_allocator.report(slot, 1, ok=False)
+        # 上限降到 1 后判题通道仍保留 1 个名额
+        self.assertEqual(slot_allocator.snapshot()[0][0].capacity, 1)
+        for _ in range(3):
+            slot_allocator.report(slot, 1)
+        state = slot_allocator.snapshot()[0][0]
+        self.assertEqual(state.capacity, 2)
+        self.assertEqual(state.latency, 1)
+        # 对账时保留调整后的上限
+        slot_allocator.refresh(force=True)
+        self.assertEqual(slot_allocator.snapshot()[0][0].capacity, 2)
+        # 判题结果中有超时的测试点时不增大上限
+        resp = {"err": None, "data": [{"result": JudgeStatus.REAL_TIME_LIMIT_EXCEEDED}]}
+        for _ in range(3):
+            slot_allocator.report(slot, 1, resp=resp)
+        self.assertEqual(slot_allocator.snapshot()[0][0].capacity, 2)
+
+    def test_policy(self):
+        server2 = self.create_server("server2", cpu_core=4)
+        slot_allocator.refresh(force=True)
+        slot_allocator.report(JudgeSlot(self.server.id, "", "", ""), 1)
+        slot_allocator.report(JudgeSlot(server2.id, "", "", ""), 10)
+        self.assertEqual(slot_allocator.acquire(policy="ewma").id, self.server.id)
+        self.assertEqual(slot_allocator.acquire(policy="ewma").id, server2.id)
+        with self.assertRaises(ValueError):
+            slot_allocator.acquire(policy="unknown")
+
+
+class JudgeServerRegistryTest(JudgeServerTestMixin, TestCase):
+    def setUp(self):
+        self.server = self.create_server("server1")
+        judge_server_registry.invalidate()
+
+    def test_active(self):
+        self.create_server(
+            "server2", last_heartbeat=timezone.now() - timedelta(seconds=60)
+        )
+        self.create_server("server3", is_disabled=True)
+        self.assertEqual(judge_server_registry.active_ids(), {self.server.id})
+        # 缓存期内不再查询数据库
+        with self.assertNumQueries(0):
+            judge_server_registry.active()
+
+    def test_heartbeat_in_redis(self):
+        JudgeServer.objects.filter(id=self.server.id).update(
+            last_heartbeat=timezone.now() - timedelta(seconds=60)
+        )
+        heartbeat_store.beat(
+            "server1",
+            {
+                "judger_version": "2.0.0",
+                "cpu_core": 1,
+                "service_url": "http://server1:8080",
+                "cpu_usage": 10,
+                "memory_usage": 10,
+            },
+            "127.0.0.1",
+        )
+        judge_server_registry.invalidate()
+        self.assertEqual(judge_server_registry.active_ids(), {self.server.id})
+        heartbeat_store.remove("server1")
+
+
+class CircuitBreakerTest(JudgeServerTestMixin, TestCase):
+    def setUp(self):
+        self.server = self.create_server("server1")
+        slot_allocator.reset()
+        self.slot = JudgeSlot(self.server.id, "", "", "")
+
+    def test_open_and_recover(self):
+        for _ in range(breaker.MIN_REQUESTS):
+            slot_allocator.report(self.slot, 1, ok=False)
+        self.assertEqual(
+            circuit_breaker.status(self.server.id)["state"], CircuitState.OPEN
+        )
+        self.assertEqual(slot_allocator.available(), 0)
+        self.assertIsNone(slot_allocator.acquire())
+
+        with mock.patch("judge.breaker.OPEN_DURATION", 0):
+            # 到了试探时间后, 进程内缓存最多 SNAPSHOT_TTL 秒后才会更新
+            slot_allocator.invalidate()
+            self.assertEqual(slot_allocator.available(), 1)
+            slot = slot_allocator.acquire()
+            self.assertEqual(slot.id, self.server.id)
+            self.assertEqual(
+                circuit_breaker.status(self.server.id)["state"], CircuitState.HALF_OPEN
+            )
+            # 同一时间只允许一个试探请求
+            self.assertEqual(slot_allocator.available(), 0)
+            slot_allocator.release(slot)
+            slot_allocator.report(slot, 1, ok=True)
+        self.assertEqual(
+            circuit_breaker.status(self.server.id)["state"], CircuitState.CLOSED
+        )
+        self.assertIsNotNone(slot_allocator.acquire())
+
+    def test_slow_call(self):
+        # 提交的代码运行得慢, 不影响熔断器
+        for _ in range(breaker.MIN_REQUESTS):
+            circuit_breaker.record(
+                self.server.id, True, cost=9, timeout=10, finished=True
+            )
+        self.assertEqual(
+            circuit_breaker.status(self.server.id)["state"], CircuitState.CLOSED
+        )
+        for _ in range(breaker.MIN_REQUESTS):
+            circuit_breaker.record(self.server.id, True, cost=9, timeout=10)
+        self.assertEqual(
+            circuit_breaker.status(self.server.id)["state"], CircuitState.OPEN
+        )
+
+    def test_failure_rate(self):
+        for i in range(breaker.MIN_REQUESTS * 2):
+            circuit_breaker.record(self.server.id, i % 3 != 0)
+        status = circuit_breaker.status(self.server.id)
+        self.assertEqual(status["state"], CircuitState.CLOSED)
+        self.assertEqual(status["requests"], breaker.MIN_REQUESTS * 2)
+
+
+class SelectionPolicyTest(TestCase):
+    def test_least_loaded(self):
+        servers = [
+            ServerState(1, 2, 1, cpu_core=1),
+            ServerState(2, 8, 2, cpu_core=4),
+            ServerState(3, 8, 0, cpu_core=4, memory_usage=95),
+        ]
+        self.assertEqual(
+            [server.id for server in POLICIES["least_loaded"].order(servers)],
+            [2, 1, 3],
+        )
+
+    def test_p2c(self):
+        servers = [ServerState(i, 2, 0, cpu_core=1) for i in range(5)]
+        ordered = POLICIES["p2c"].order(servers)
+        self.assertEqual(sorted(server.id for server in ordered), list(range(5)))
+
+    def test_affinity(self):
+        policy = POLICIES["affinity"]
+        servers = [ServerState(i, 8, 0, cpu_core=4) for i in range(4)]
+        first = {policy.order(servers, key=str(i))[0].id for i in range(50)}
+        self.assertGreater(len(first), 1)
+        for i in range(10):
+            self.assertEqual(
+                policy.order(servers, key=str(i))[0].id,
+                policy.order(list(reversed(servers)), key=str(i))[0].id,
+            )
+
+        # 去掉一台服务器只影响原本分配给它的键
+        target = policy.order(servers, key="a")[0]
+        others = [server for server in servers if server is not target]
+        moved = [
+            key
+            for key in map(str, range(50))
+            if policy.order(servers, key=key)[0] is not target
+            and policy.order(others, key=key)[0]
+            is not policy.order(servers, key=key)[0]
+        ]
+        self.assertEqual(moved, [])
+
+        # 负载超过上限后溢出到其他服务器
+        target.used = 6
+        self.assertIsNot(policy.order(servers, key="a")[0], target)
+        self.assertEqual(len(policy.order(servers, key="a")), 4)
+
+    def test_adjust_limit(self):
+        limit, latency = adjust_limit(4, 0, 2, True, cpu_core=2)
+        self.assertEqual((limit, latency), (4.25, 2))
+        limit, latency = adjust_limit(limit, latency, 30, False, cpu_core=2)
+        self.assertLess(limit, 4)
+        self.assertEqual(latency, 2)
+        self.assertEqual(adjust_limit(8, 1, 1, True, cpu_core=2)[0], 8)
+
+    def test_adjust_limit_congestion(self):
+        # 结果中有超时的测试点、延迟不断升高时上限不会增大
+        limit, latency = 4, 1
+        for i in range(20):
+            limit, latency = adjust_limit(
+                limit, latency, 1 + i, True, cpu_core=2, time_limit_exceeded=True
+            )
+            self.assertLessEqual(limit, 4)
+        limit, latency = 4, 1
+        for i in range(20):
+            limit, latency = adjust_limit(
+                limit, latency, 2.5 ** (i + 1), True, cpu_core=2
+            )
+            self.assertLessEqual(limit, 4)
+        # cpu 占用饱和
+        self.assertEqual(adjust_limit(4, 1, 1, True, cpu_core=2, cpu_usage=95)[0], 4)
+        # 成功但耗时接近超时时间
+        self.assertLess(adjust_limit(4, 1, 8, True, cpu_core=2, timeout=10)[0], 4)
+        # 提交的代码超时, 耗时长不是服务器的问题
+        self.assertEqual(
+            adjust_limit(
+                4, 1, 8, True, cpu_core=2, timeout=10, time_limit_exceeded=True
+            )[0],
+            4,
+        )
+
+    def test_simulation(self):
+        for policy in POLICIES.values():
+            servers = [SimulatedServer(1, 2), SimulatedServer(2, 2, speed=0.5)]
+            result = Simulation(servers, policy).run(2, 60)
+            self.assertGreater(result["completed"], 0)
+            self.assertGreaterEqual(result["p99"], result["p50"])
+
+    def test_simulation_retry(self):
+        servers = [SimulatedServer(1, 2, error_rate=1), SimulatedServer(2, 2)]
+        result = Simulation(servers, POLICIES["least_loaded"]).run(1, 30)
+        # 失败的任务换一台服务器重试
+        self.assertEqual(result["errors"], 0)
+        self.assertGreater(result["retries"], 0)
+
+        result = Simulation(
+            [SimulatedServer(1, 2, error_rate=1)], POLICIES["least_loaded"]
+        ).run(1, 30)
+        self.assertEqual(result["completed"], 0)
+        self.assertEqual(result["retries"], result["errors"] * (MAX_ATTEMPTS - 1))
+
+    def test_simulation_limit(self):
+        # 全部超时的提交不能让并发上限增大
+        server = SimulatedServer(1, 2)
+        jobs = [(i, 0.5, None, JudgeTaskClass.PRACTICE, i, 10, True) for i in range(20)]
+        Simulation([server], POLICIES["least_loaded"]).replay(jobs)
+        self.assertEqual(server.limit, initial_limit(2))
+
+    def test_simulated_queue(self):
+        queue = SimulatedQueue()
+        for i in range(3):
+            queue.push(f"a{i}", JudgeTaskClass.PRACTICE, "a")
+        queue.push("b0", JudgeTaskClass.PRACTICE, "b")
+        queue.push("c0", JudgeTaskClass.CONTEST, "c")
+        self.assertEqual(queue.peek(), "c0")
+        self.assertEqual(
+            [queue.pop() for _ in range(5)], ["c0", "a0", "b0", "a1", "a2"]
+        )
+        self.assertEqual(len(queue), 0)
+
+    def test_replay(self):
+        info = {"data": [{"real_time": 300}, {"real_time": 200}]}
+        self.assertEqual(estimate_work(info, compile_cost=0.5), 1)
+        self.assertEqual(estimate_work({}, exec_time=1000, compile_cost=0), 1)
+        # 10 秒内每秒 4 个提交, 每个耗时 1 秒
+        jobs = [
+            (i / 4, 1, str(i % 3), JudgeTaskClass.PRACTICE, i % 5) for i in range(40)
+        ]
+        results = [
+            Simulation(
+                [SimulatedServer(i + 1, 2) for i in range(count)],
+                POLICIES["affinity"],
+            ).replay(jobs)
+            for count in (1, 4)
+        ]
+        self.assertEqual([result["completed"] for result in results], [40, 40])
+        # 一台服务器处理不过来, 队列越来越长
+        self.assertGreater(results[0]["wait_p95"], 5)
+        self.assertLess(results[1]["wait_p95"], results[0]["wait_p95"])
+        self.assertLess(results[1]["p95"], results[0]["p95"])
+
+
+class ProblemJudgeContextTest(TestCase):
+    def setUp(self):
+        user = User.objects.create(username="test")
+        problem_data = deepcopy(DEFAULT_PROBLEM_DATA)
+        problem_data.pop("tags")
+        problem_data["template"] = {
+            "C": "//PREPEND BEGIN\n#include <stdio.h>\n//PREPEND END\n"
+        }
+        self.problem = Problem.objects.create(created_by=user, **problem_data)
+        problem_context_cache.clear()
+
+    def test_context(self):
+        context = problem_context_cache.get(self.problem.id)
+        self.assertEqual(context.templates["C"]["prepend"], "#include <stdio.h>\n")
+        self.assertEqual(context.language_configs["C"]["name"], "C")
+        self.assertFalse(hasattr(context, "description"))
+        with self.assertNumQueries(0):
+            self.assertIs(problem_context_cache.get(self.problem.id), context)
+
+        Problem.objects.filter(id=self.problem.id).update(time_limit=2000)
+        problem_context_cache.invalidate(self.problem.id)
+        self.assertEqual(problem_context_cache.get(self.problem.id).time_limit, 2000)
+
+        with self.assertRaises(Problem.DoesNotExist):
+            problem_context_cache.get(self.problem.id + 1)
+
+
+class JudgeStatisticsTest(APITestCase):
+    def setUp(self):
+        admin = self.create_super_admin(login=False)
+        self.contest = Contest.objects.create(
+            title="test",
+            description="test",
+            real_time_rank=True,
+            rule_type=ContestRuleType.ACM,
+            start_time=timezone.now() - timedelta(hours=1),
+            end_time=timezone.now() + timedelta(hours=1),
+            created_by=admin,
+        )
+        problem_data = deepcopy(DEFAULT_PROBLEM_DATA)
+        problem_data.pop("tags")
+        self.problem = Problem.objects.create(
+            created_by=admin, contest=self.contest, **problem_data
+        )
+        self.admin = admin
+        self.user1 = self.create_user("user1", "user1", login=False)
+        self.user2 = self.create_user("user2", "user2", login=False)
+        cache.delete_pattern(f"{CacheKey.judge_statistics}:*")
+
+    def submit(self, user, minutes, result):
+        submission = Submission.objects.create(
+            problem=self.problem,
+            contest=self.contest,
+            user_id=user.id,
+            username=user.username,
+            code="",
+            language="C",
+        )
+        submission.create_time = self.contest.start_time + timedelta(minutes=minutes)
+        submission.save()
+        return self.judge(submission, result)
+
+    def judge(self, submission, result):
+        submission.result = result
+        changes = judge_statistics.collect([(submission, self.problem)])
+        submission.save()
+        judge_statistics.record(changes)
+        return submission
+
+    def rank(self, user):
+        return ACMContestRank.objects.get(contest=self.contest, user=user)
+
+    def test_acm_rank(self):
+        wrong = self.submit(self.user1, 10, JudgeStatus.WRONG_ANSWER)
+        self.submit(self.user1, 20, JudgeStatus.ACCEPTED)
+        self.submit(self.user2, 15, JudgeStatus.ACCEPTED)
+        # 比赛管理员的提交不计入统计
+        self.submit(self.admin, 1, JudgeStatus.ACCEPTED)
+        judge_statistics.flush()
+
+        problem_id = str(self.problem.id)
+        rank = self.rank(self.user1)
+        self.assertEqual((rank.submission_number, rank.accepted_number), (2, 1))
+        self.assertEqual(rank.total_time, 40 * 60)
+        self.assertFalse(rank.submission_info[problem_id]["is_first_ac"])
+        self.assertTrue(
+            self.rank(self.user2).submission_info[problem_id]["is_first_ac"]
+        )
+        self.assertFalse(
+            ACMContestRank.objects.filter(
+                contest=self.contest, user=self.admin
+            ).exists()
+        )
+        problem = Problem.objects.get(id=self.problem.id)
+        self.assertEqual((problem.submission_number, problem.accepted_number), (3, 2))
+        profile = UserProfile.objects.get(user=self.user1)
+        self.assertEqual(
+            profile.acm_problems_status["contest_problems"][problem_id]["status"],
+            JudgeStatus.ACCEPTED,
+        )
+        # 比赛中的提交不计入用户的提交数
+        self.assertEqual(profile.submission_number, 0)
+
+        # 重新判题后一血易主
+        self.judge(wrong, JudgeStatus.ACCEPTED)
+        judge_statistics.flush()
+        rank = self.rank(self.user1)
+        self.assertEqual((rank.submission_number, rank.accepted_number), (1, 1))
+        self.assertEqual(rank.total_time, 10 * 60)
+        self.assertTrue(rank.submission_info[problem_id]["is_first_ac"])
+        self.assertFalse(
+            self.rank(self.user2).submission_info[problem_id]["is_first_ac"]
+        )
+        problem = Problem.objects.get(id=self.problem.id)
+        self.assertEqual((problem.submission_number, problem.accepted_number), (3, 3))
+        self.assertEqual(problem.statistic_info, {str(JudgeStatus.ACCEPTED): 3})
+
+        # 重新判题失败时撤销原来的结果
+        self.judge(wrong, JudgeStatus.SYSTEM_ERROR)
+        judge_statistics.flush()
+        judge_statistics.flush()
+        problem = Problem.objects.get(id=self.problem.id)
+        self.assertEqual((problem.submission_number, problem.accepted_number), (2, 2))
+        self.assertEqual(self.rank(self.user1).total_time, 20 * 60)
+        self.assertEqual(cache.hgetall(judge_statistics.problem_key), {})
+
+
+@mock.patch("judge.dispatcher.process_pending_task")
+@mock.patch("judge.rejudge.process_pending_task")
+@override_settings(JUDGE_REJUDGE_RATE=1000)
+class RejudgeJobTest(APITestCase):
+    def setUp(self):
+        self.admin = self.create_super_admin()
+        problem_data = deepcopy(DEFAULT_PROBLEM_DATA)
+        problem_data.pop("tags")
+        self.problem = Problem.objects.create(
+            created_by=self.admin,
+            submission_number=3,
+            statistic_info={str(JudgeStatus.WRONG_ANSWER): 3},
+            **problem_data,
+        )
+        self.submissions = [
+            Submission.objects.create(
+                problem=self.problem,
+                user_id=self.admin.id,
+                username=self.admin.username,
+                code=code,
+                language="C",
+                result=JudgeStatus.WRONG_ANSWER,
+                statistic_result=JudgeStatus.WRONG_ANSWER,
+            )
+            for code in ("a", "b", "a")
+        ]
+        self.url = self.reverse("submission_rejudge_job_api")
+        cache.delete_pattern(f"{CacheKey.judge_queue}:*")
+        cache.delete_pattern(f"{CacheKey.judge_statistics}:*")
+        problem_context_cache.clear()
+
+    def tearDown(self):
+        cache.delete_pattern(f"{CacheKey.judge_queue}:*")
+
+    def test_rejudge_job(self, *mocks):
+        self.assertFailed(self.client.post(self.url, data={}))
+        resp = self.client.post(self.url, data={"problem_id": self.problem.id})
+        self.assertSuccess(resp)
+        job = resp.data["data"]
+        self.assertEqual((job["total"], job["enqueued"], job["duplicated"]), (3, 2, 1))
+        leaders = [
+            submission
+            for submission in self.submissions
+            if judge_queue.contains(submission.id)
+        ]
+        self.assertEqual(len(leaders), 2)
+        self.assertTrue(
+            all(Submission.objects.get(id=s.id).is_judging for s in leaders)
+        )
+
+        resp = {
+            "err": None,
+            "data": [{"test_case": "1", "result": 0, "cpu_time": 10, "memory": 1}],
+        }
+        for submission in leaders:
+            JudgeDispatcher(submission.id, self.problem.id).process_result(
+                deepcopy(resp)
+            )
+        job = rejudge_jobs.advance(job["id"])
+        self.assertEqual(job["status"], RejudgeJobStatus.FINISHED)
+        self.assertEqual((job["judged"], job["copied"], job["progress"]), (2, 1, 1))
+        for submission in Submission.objects.filter(problem=self.problem):
+            self.assertEqual(submission.result, JudgeStatus.ACCEPTED)
+        problem = Problem.objects.get(id=self.problem.id)
+        self.assertEqual((problem.submission_number, problem.accepted_number), (3, 3))
+        self.assertEqual(problem.statistic_info, {str(JudgeStatus.ACCEPTED): 3})
+
+        resp = self.client.get(self.url, data={"id": job["id"]})
+        self.assertEqual(resp.data["data"]["status"], RejudgeJobStatus.FINISHED)
+        resp = self.client.get(self.url)
+        self.assertIn(job["id"], [item["id"] for item in resp.data["data"]])
+
+    @override_settings(JUDGE_REJUDGE_RATE=1)
+    def test_rate_and_cancel(self, *mocks):
+        job = rejudge_jobs.create({"problem_id": self.problem.id}, self.admin.id)
+        # 第一次推进只有一秒的额度
+        self.assertEqual(job["scanned"], 1)
+        job = rejudge_jobs.advance(job["id"])
+        self.assertEqual(job["scanned"], 1)
+        resp = self.client.delete(f"{self.url}?id={job['id']}")
+        self.assertEqual(resp.data["data"]["status"], RejudgeJobStatus.CANCELLED)
+        self.assertNotIn(job["id"].encode(), cache.smembers(rejudge_jobs.running_key))
+
+
+class JudgeAdmissionTest(JudgeServerTestMixin, TestCase):
+    def setUp(self):
+        self.create_server("server1", cpu_core=2)
+        slot_allocator.reset()
+        cache.delete_pattern(f"{CacheKey.judge_queue}:*")
+        judge_admission.invalidate()
+        for i in range(4):
+            judge_queue.push(f"s{i}", JudgeTaskClass.PRACTICE, i, {})
+        # rejudge 排在最后, 不影响新提交
+        judge_queue.push("r", JudgeTaskClass.REJUDGE, 1, {})
+
+    def tearDown(self):
+        cache.delete_pattern(f"{CacheKey.judge_queue}:*")
+
+    def test_status(self):
+        status = judge_admission.status()
+        self.assertEqual((status["depth"], status["capacity"]), (4, 4))
+        self.assertEqual(status["estimated_wait"], 4 * admission.DEFAULT_LATENCY / 4)
+        self.assertIsNone(status["retry_after"])
+        self.assertIsNone(judge_admission.check())
+
+    @override_settings(JUDGE_ADMISSION_MAX_DEPTH=3)
+    def test_max_depth(self):
+        self.assertEqual(judge_admission.check(), 1)
+        # 比赛中的提交不受限制
+        self.assertIsNone(judge_admission.check(contest_id=1))
+
+    @override_settings(JUDGE_ADMISSION_MAX_WAIT=1)
+    def test_max_wait(self):
+        slot_allocator.report(JudgeSlot(JudgeServer.objects.get().id, "", "", ""), 5)
+        judge_admission.invalidate()
+        # 4 个提交在并发上限为 4 的服务器上, 每个 5 秒
+        self.assertEqual(judge_admission.status()["estimated_wait"], 5)
+        self.assertEqual(judge_admission.check(), 4)
+
+
+class JudgeMetricsTest(TestCase):
+    def setUp(self):
+        judge_metrics.clear()
+
+    def test_quantile(self):
+        timings = [("judge", 0.01 * i) for i in range(1, 101)]
+        judge_metrics.observe_many("judge", "server1", timings)
+        item = judge_metrics.summary()[0]
+        self.assertEqual(item["count"], 100)
+        self.assertAlmostEqual(item["sum"], 50.5)
+        # 桶的宽度为 25%
+        for q, expected in ((0.5, 0.5), (0.95, 0.95), (0.99, 0.99)):
+            self.assertLess(abs(item["quantiles"][q] - expected) / expected, 0.25)
+
+    def test_window(self):
+        now = time.time()
+        judge_metrics.observe_many("judge", None, [("save", 10)], now=now - 600)
+        judge_metrics.observe_many("judge", None, [("save", 0.1)], now=now)
+        counts = judge_metrics.histograms(window=60, now=now)[("judge", "save", "-")]
+        self.assertEqual(sum(counts), 1)
+        self.assertEqual(judge_metrics.totals()[("judge", "save", "-")]["count"], 2)
+
+    def test_exposition(self):
+        judge_metrics.observe_many("compile_run", "server1", [("judge", 0.2)])
+        text = judge_metrics.exposition()
+        self.assertIn("# TYPE oj_judge_stage_seconds summary", text)
+        self.assertIn(
+            'oj_judge_stage_seconds_count{lane="compile_run",stage="judge",server="server1"} 1',
+            text,
+        )
+        self.assertIn('quantile="0.99"', text)
+
+
+class ResultNotifierTest(TestCase):
+    def wait(self, check_result, timeout, publish_after=None):
+        async def check():
+            return check_result
+
+        async def run():
+            if publish_after is not None:
+                loop = asyncio.get_running_loop()
+                loop.call_later(
+                    publish_after,
+                    result_notifier.publish,
+                    ResultKind.SUBMISSION,
+                    "a",
+                    JudgeStatus.ACCEPTED,
+                )
+            return await result_notifier.wait(
+                ResultKind.SUBMISSION, "a", check, timeout
+            )
+
+        return asyncio.run(run())
+
+    def test_wait(self):
+        start = time.time()
+        self.assertEqual(self.wait(None, 5, publish_after=0.1), JudgeStatus.ACCEPTED)
+        self.assertLess(time.time() - start, 3)
+        self.assertEqual(result_notifier.waiting(), 0)
+
+    def test_finished(self):
+        self.assertEqual(
+            self.wait(JudgeStatus.WRONG_ANSWER, 5), JudgeStatus.WRONG_ANSWER
+        )
+
+    def test_timeout(self):
+        self.assertIsNone(self.wait(None, 0.1))
+        self.assertEqual(result_notifier.waiting(), 0)
+
+
+class JudgeCallbackProxyTest(TransactionTestCase):
+    # 代理在另一个线程中读取 SysOptions, 需要提交到数据库
+    def test_token(self):
+        SysOptions.judge_server_token = "test"
+        token = hashlib.sha256(
+            SysOptions.judge_server_token.encode("utf-8")
+        ).hexdigest()
+        mock_server = start_mock_server(work=0)
+        self.addCleanup(mock_server.shutdown)
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        proxy = make_server("127.0.0.1", 0, executor)
+        threading.Thread(target=proxy.serve_forever, daemon=True).start()
+        self.addCleanup(proxy.shutdown)
+
+        url = f"http://127.0.0.1:{proxy.server_address[1]}/judge_batch"
+        job = {"service_url": mock_server.url, "timeout": 5, "tasks": [{}]}
+        for headers in ({}, {"X-Judge-Server-Token": "wrong"}):
+            resp = requests.post(url, json=job, headers=headers, timeout=5)
+            self.assertEqual(resp.status_code, 403)
+        self.assertEqual(mock_server.requests, 0)
+        resp = requests.post(
+            url, json=job, headers={"X-Judge-Server-Token": token}, timeout=5
+        )
+        self.assertIsNone(resp.json()["err"])
+        self.assertEqual(len(resp.json()["data"]), 1)
+
+
+class MockJudgeServerTest(TestCase):
+    def post(self, server, path, data):
+        return requests.post(urljoin(server.url, path), json=data, timeout=5)
+
+    def test_compile_run(self):
+        server = start_mock_server(work=0, distribution=LatencyDistribution.LOGNORMAL)
+        try:
+            resp = self.post(server, "/compile_run", {"input_data": "1 2"})
+            self.assertEqual(resp.json()["data"][0]["output"], "1 2")
+            resp = self.post(server, "/compile_run", {"inputs": ["1", "2"]})
+            self.assertEqual(
+                [item["output"] for item in resp.json()["data"]], ["1", "2"]
+            )
+            self.assertEqual(
+                self.post(server, "/compile_spj", {}).json()["data"], "success"
+            )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_failure_rate(self):
+        server = start_mock_server(work=0, failure_rate=1)
+        try:
+            self.assertEqual(self.post(server, "/judge", {}).status_code, 500)
+            resp = self.post(server, "/judge_batch", {"tasks": [{}, {}]})
+            self.assertEqual(resp.json()["data"], [None, None])
+            self.assertEqual(server.failures, 3)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_latency_distribution(self):
+        server = MockJudgeServer(
+            ("127.0.0.1", 0),
+            work=0.1,
+            distribution=LatencyDistribution.EXPONENTIAL,
+            seed=0,
+        )
+        samples = [server.sample_work() for _ in range(2000)]
+        server.server_close()
+        self.assertAlmostEqual(sum(samples) / len(samples), 0.1, delta=0.01)
+        self.assertGreater(max(samples), 0.3)
+
+
+class JudgeServerClientTest(TestCase):
+    def setUp(self):
+        self.service_url = "http://judge-client-test:8080"
+        cache.delete(f"{CacheKey.judge_client_stats}:{self.service_url}")
+
+    def test_judge_timeout(self):
+        self.assertGreater(judge_timeout(1000, 10), judge_timeout(1000, 1))
+        self.assertLessEqual(judge_timeout(10000, 1000), 500)
+
+    def test_hedge_delay(self):
+        self.assertIsNone(hedge_delay(1000, 10))
+        self.assertEqual(hedge_delay(1000, 10, percentile=50), 6)
+        self.assertLessEqual(
+            hedge_delay(1000, 10, percentile=1000), judge_timeout(1000, 10)
+        )
+
+    def test_client_is_reused(self):
+        self.assertIs(get_client(self.service_url), get_client(self.service_url))
+
+    @mock.patch("judge.client.requests.Session.post")
+    def test_stats(self, mocked_post):
+        client = JudgeServerClient(self.service_url)
+        mocked_post.return_value.json.return_value = {"err": None, "data": []}
+        client.post("/judge", data={}, timeout=5)
+        self.assertEqual(mocked_post.call_args[1]["timeout"], (3, 5))
+
+        mocked_post.side_effect = requests.Timeout()
+        with self.assertRaises(requests.Timeout):
+            client.post("/judge", data={})
+        stats = get_client_stats(self.service_url)
+        self.assertEqual(stats["requests"], 2)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["errors"], 0)
+
+
+class JudgeTaskSchedulerTest(TestCase):
+    def setUp(self):
+        cache.delete_pattern("test_judge_queue:*")
+        self.queue = JudgeTaskScheduler("test_judge_queue", JUDGE_TASK_CLASSES)
+
+    def pop_ids(self, count):
+        return [task["id"] for task in self.queue.pop(count)]
+
+    def test_round_robin_between_users(self):
+        for i in range(3):
+            self.queue.push(f"a{i}", JudgeTaskClass.PRACTICE, 1, {})
+        self.queue.push("b0", JudgeTaskClass.PRACTICE, 2, {})
+        self.assertEqual(self.pop_ids(4), ["a0", "b0", "a1", "a2"])
+        self.assertEqual(self.queue.pop(1), [])
+
+    def test_priority(self):
+        self.queue.push("rejudge", JudgeTaskClass.REJUDGE, 1, {})
+        self.queue.push("practice", JudgeTaskClass.PRACTICE, 1, {})
+        self.queue.push("contest", JudgeTaskClass.CONTEST, 2, {})
+        self.assertEqual(self.queue.depth()[JudgeTaskClass.PRACTICE], 1)
+        self.assertEqual(self.pop_ids(2), ["contest", "practice"])
+        self.assertEqual(sum(self.queue.depth().values()), 1)
+
+    def test_push_front(self):
+        self.queue.push("a", JudgeTaskClass.PRACTICE, 1, {})
+        self.queue.push("b", JudgeTaskClass.PRACTICE, 2, {}, front=True)
+        self.assertEqual(self.pop_ids(1), ["b"])
+
+    def test_duplicate_push(self):
+        self.assertEqual(self.queue.push("a", JudgeTaskClass.PRACTICE, 1, {}), 1)
+        self.assertEqual(self.queue.push("a", JudgeTaskClass.PRACTICE, 1, {}), 0)
+        self.assertEqual(self.pop_ids(2), ["a"])
+
+    def test_ack(self):
+        self.queue.push("a", JudgeTaskClass.PRACTICE, 1, {"submission_id": "a"})
+        task = self.queue.pop(1)[0]
+        self.assertEqual(task["data"], {"submission_id": "a"})
+        self.assertTrue(self.queue.contains("a"))
+        self.queue.ack("a")
+        self.assertFalse(self.queue.contains("a"))
+        self.assertEqual(self.queue.requeue_expired(), [])
+
+    def test_requeue_expired(self):
+        self.queue.push("a", JudgeTaskClass.PRACTICE, 1, {})
+        self.queue.pop(1, timeout=-1)
+        self.queue.requeue_expired()
+        task = self.queue.pop(1, timeout=-1)[0]
+        self.assertEqual(task["attempts"], 1)
+
+        self.queue.requeue_expired()
+        self.queue.pop(1, timeout=-1)
+        abandoned = self.queue.requeue_expired()
+        self.assertEqual([task["id"] for task in abandoned], ["a"])
+        self.assertFalse(self.queue.contains("a"))
+
+    def test_acked_task_is_skipped(self):
+        self.queue.lease("a", JudgeTaskClass.PRACTICE, 1, {}, timeout=-1)
+        self.queue.requeue_expired()
+        self.queue.ack("a")
+        self.assertEqual(self.queue.pop(1), [])
+
+    def test_peek_and_take(self):
+        for i in range(3):
+            self.queue.push(f"a{i}", JudgeTaskClass.PRACTICE, 1, {})
+        self.queue.push("b0", JudgeTaskClass.PRACTICE, 2, {})
+        self.queue.push("c0", JudgeTaskClass.CONTEST, 3, {})
+        tasks = self.queue.peek(5)
+        self.assertEqual([task["id"] for task in tasks], ["c0", "a0", "b0", "a1", "a2"])
+        # 只取出了一部分, 剩下的顺序与直接 pop 一致
+        for task in tasks[:2]:
+            self.assertTrue(self.queue.take(task))
+        self.assertFalse(self.queue.take(tasks[0]))
+        self.assertTrue(self.queue.contains("a0"))
+        self.assertEqual(self.pop_ids(3), ["b0", "a1", "a2"])
+
+    def test_take_after_queue_changed(self):
+        self.queue.push("a0", JudgeTaskClass.PRACTICE, 1, {})
+        self.queue.push("b0", JudgeTaskClass.PRACTICE, 2, {})
+        task = self.queue.peek(1)[0]
+        # peek 之后同一用户有任务插到了前面, 取出失败且不改变顺序
+        self.queue.push("a1", JudgeTaskClass.PRACTICE, 1, {}, front=True)
+        self.assertFalse(self.queue.take(task))
+        self.assertEqual(self.pop_ids(3), ["a1", "b0", "a0"])
+
+    def test_take_skips_acked_task(self):
+        self.queue.push("a0", JudgeTaskClass.PRACTICE, 1, {})
+        self.queue.push("a1", JudgeTaskClass.PRACTICE, 1, {})
+        self.queue.ack("a0")
+        task = self.queue.peek(1)[0]
+        self.assertEqual(task["id"], "a1")
+        self.assertTrue(self.queue.take(task))
+        self.assertEqual(sum(self.queue.depth().values()), 0)
+
+
+@mock.patch("judge.dispatcher.process_pending_task")
+@mock.patch("judge.dispatcher.DispatcherBase._request")
+class JudgeDispatcherTest(JudgeServerTestMixin, APITestCase):
+    def setUp(self):
+        user = self.create_user("test", "test123", login=False)
+        problem_data = deepcopy(DEFAULT_PROBLEM_DATA)
+        problem_data.pop("tags")
+        self.problem = Problem.objects.create(created_by=user, **problem_data)
+        self.submission = Submission.objects.create(
+            problem=self.problem,
+            user_id=user.id,
+            username=user.username,
+            code="int main() { return 0; }",
+            language="C",
+            is_judging=True,
+        )
+        cache.delete_pattern(f"{CacheKey.judge_queue}:*")
+        slot_allocator.reset()
+        problem_context_cache.clear()
+
+    def tearDown(self):
+        cache.delete_pattern(f"{CacheKey.judge_queue}:*")
+
+    def judge(self):
+        JudgeDispatcher(self.submission.id, self.problem.id).judge()
+        return Submission.objects.get(id=self.submission.id)
+
+    def test_judge(self, mocked_request, mocked_process_pending_task):
+        self.create_server("server1")
+        slot_allocator.refresh(force=True)
+        mocked_request.return_value = {
+            "err": None,
+            "data": [{"test_case": "1", "result": 0, "cpu_time": 10, "memory": 1024}],
+        }
+        submission = self.judge()
+        self.assertEqual(submission.result, JudgeStatus.ACCEPTED)
+        self.assertFalse(submission.is_judging)
+        self.assertFalse(judge_queue.contains(submission.id))
+        self.assertEqual(slot_allocator.available(), 1)
+        mocked_process_pending_task.assert_called_once()
+
+    def test_metrics(self, mocked_request, mocked_process_pending_task):
+        self.create_server("server1")
+        slot_allocator.refresh(force=True)
+        judge_metrics.clear()
+        mocked_request.return_value = {
+            "err": None,
+            "data": [{"test_case": "1", "result": 0, "cpu_time": 10, "memory": 1024}],
+        }
+        judge_task(self.submission.id, self.problem.id, enqueue_time=time.time() - 1)
+        summary = {item["stage"]: item for item in judge_metrics.summary()}
+        self.assertEqual(
+            set(summary),
+            {
+                JudgeStage.QUEUE_WAIT,
+                JudgeStage.FETCH,
+                JudgeStage.ACQUIRE,
+                JudgeStage.JUDGE,
+                JudgeStage.SAVE,
+                JudgeStage.PENDING,
+            },
+        )
+        for item in summary.values():
+            self.assertEqual((item["lane"], item["server"]), ("judge", "server1"))
+            self.assertEqual(item["count"], 1)
+        self.assertGreater(summary[JudgeStage.QUEUE_WAIT]["quantiles"][0.5], 0.75)
+
+    def test_no_available_server(self, mocked_request, mocked_process_pending_task):
+        self.judge()
+        mocked_request.assert_not_called()
+        task = judge_queue.pop(1)[0]
+        self.assertEqual(task["id"], self.submission.id)
+        self.assertEqual(task["class"], JudgeTaskClass.PRACTICE)
+
+    @mock.patch("judge.tasks.judge_task.delay")
+    def test_process_pending_task(
+        self, mocked_delay, mocked_request, mocked_process_pending_task
+    ):
+        self.judge()
+        # 没有名额时任务留在队列中
+        process_pending_task()
+        mocked_delay.assert_not_called()
+        self.assertTrue(judge_queue.peek(1))
+
+        self.create_server("server1")
+        slot_allocator.refresh(force=True)
+        available = slot_allocator.available()
+        process_pending_task()
+        mocked_delay.assert_called_once()
+        self.assertEqual(sum(judge_queue.depth().values()), 0)
+        # 名额在取出任务之前获取, 交给 judge_task 使用
+        self.assertEqual(slot_allocator.available(), available - 1)
+        slot = JudgeSlot(**mocked_delay.call_args[1]["slot"])
+        self.assertEqual(slot.hostname, "server1")
+        slot_allocator.release(slot)
+
+    def test_problem_mismatch(self, mocked_request, mocked_process_pending_task):
+        self.create_server("server1")
+        slot_allocator.refresh(force=True)
+        available = slot_allocator.available()
+        data = {"submission_id": self.submission.id, "problem_id": self.problem.id}
+        judge_queue.lease(
+            self.submission.id, JudgeTaskClass.PRACTICE, 1, data, timeout=60
+        )
+        slot = slot_allocator.acquire()
+        # 题目已经不属于提交所在的比赛
+        contest = Contest.objects.create(
+            title="test",
+            description="test",
+            real_time_rank=True,
+            rule_type=ContestRuleType.ACM,
+            start_time=timezone.now(),
+            end_time=timezone.now() + timedelta(hours=1),
+            created_by=self.problem.created_by,
+        )
+        Problem.objects.filter(id=self.problem.id).update(contest=contest)
+        problem_context_cache.clear()
+
+        judge_task(**data, slot=vars(slot))
+        mocked_request.assert_not_called()
+        self.assertFalse(Submission.objects.get(id=self.submission.id).is_judging)
+        self.assertFalse(judge_queue.contains(self.submission.id))
+        self.assertEqual(slot_allocator.available(), available)
+
+    def test_judge_server_error(self, mocked_request, mocked_process_pending_task):
+        self.create_server("server1")
+        slot_allocator.refresh(force=True)
+        self.create_server("server2")
+        slot_allocator.refresh(force=True)
+        mocked_request.return_value = None
+        submission = self.judge()
+        # 放回队列, 重试时避开失败的服务器
+        self.assertEqual(submission.result, JudgeStatus.PENDING)
+        self.assertTrue(submission.is_judging)
+        mocked_process_pending_task.assert_called_once()
+        task = judge_queue.pop(1)[0]
+        self.assertEqual(len(task["data"]["exclude"]), 1)
+        with ChooseJudgeServer(exclude=task["data"]["exclude"]) as server:
+            self.assertNotEqual(server.id, task["data"]["exclude"][0])
+        with ChooseJudgeServer(
+            exclude=[s.id for s in JudgeServer.objects.all()]
+        ) as server:
+            self.assertIsNotNone(server)
+
+        # 超过重试次数后结束
+        for _ in range(2):
+            submission = self.judge()
+        self.assertEqual(submission.result, JudgeStatus.SYSTEM_ERROR)
+        self.assertFalse(submission.is_judging)
+        self.assertFalse(judge_queue.contains(submission.id))
+
+    @mock.patch.object(JudgeDispatcher, "hedge_delay", new_callable=mock.PropertyMock)
+    def test_judge_hedged(
+        self, mocked_hedge_delay, mocked_request, mocked_process_pending_task
+    ):
+        self.create_server("server1")
+        self.create_server("server2")
+        slot_allocator.refresh(force=True)
+        mocked_hedge_delay.return_value = 0.05
+        for hostname in ("server1", "server2"):
+            cache.delete(f"{CacheKey.judge_client_stats}:http://{hostname}:8080")
+        stalled = threading.Event()
+        servers = []
+
+        def request(server, path, data=None, timeout=None):
+            servers.append(server)
+            if len(servers) == 1:
+                stalled.wait(5)
+                return None
+            return {
+                "err": None,
+                "data": [
+                    {"test_case": "1", "result": 0, "cpu_time": 10, "memory": 1024}
+                ],
+            }
+
+        mocked_request.side_effect = request
+        submission = self.judge()
+        stalled.set()
+        self.assertEqual(submission.result, JudgeStatus.ACCEPTED)
+        self.assertEqual(len(servers), 2)
+        self.assertNotEqual(servers[0].id, servers[1].id)
+        # 两个名额都已释放
+        self.assertEqual(slot_allocator.available(), 2)
+        self.assertEqual(get_client_stats(servers[0].service_url)["stragglers"], 1)
+
+    @override_settings(JUDGE_RESULT_CACHE_TIMEOUT=60)
+    def test_result_cache(self, mocked_request, mocked_process_pending_task):
+        self.create_server("server1")
+        slot_allocator.refresh(force=True)
+        result_cache.reset()
+        mocked_request.return_value = {
+            "err": None,
+            "data": [{"test_case": "1", "result": -1, "cpu_time": 10, "memory": 1024}],
+        }
+        self.judge()
+        # 另一个人提交了相同的代码
+        self.submission.id = "duplicate"
+        self.submission.save(force_insert=True)
+        submission = self.judge()
+        self.assertEqual(submission.result, JudgeStatus.WRONG_ANSWER)
+        self.assertEqual(submission.info["data"][0]["cpu_time"], 10)
+        mocked_request.assert_called_once()
+        self.assertEqual(result_cache.stats()["hits"], 1)
+        self.assertEqual(result_cache.stats()["hit_rate"], 0.5)
+
+        # 题目时限修改后不再命中
+        Problem.objects.filter(id=self.problem.id).update(time_limit=2000)
+        problem_context_cache.invalidate(self.problem.id)
+        self.judge()
+        self.assertEqual(mocked_request.call_count, 2)
+
+        # 超时的结果不缓存
+        mocked_request.return_value = {
+            "err": None,
+            "data": [{"test_case": "1", "result": 1, "cpu_time": 2000, "memory": 1}],
+        }
+        Problem.objects.filter(id=self.problem.id).update(time_limit=3000)
+        problem_context_cache.invalidate(self.problem.id)
+        self.judge()
+        self.judge()
+        self.assertEqual(mocked_request.call_count, 4)
+
+        # judge server 自身的错误不缓存, 编译错误缓存
+        key = result_cache.key(
+            JudgeDispatcher(self.submission.id, self.problem.id).build_payload()
+        )
+        result_cache.set(key, {"err": "JudgeClientError", "data": "failed"})
+        self.assertIsNone(result_cache.get(key))
+        result_cache.set(key, {"err": "CompileError", "data": "error"})
+        self.assertEqual(result_cache.get(key)["err"], "CompileError")
+
+    def test_statistics(self, mocked_request, mocked_process_pending_task):
+        self.create_server("server1")
+        slot_allocator.refresh(force=True)
+        cache.delete_pattern(f"{CacheKey.judge_statistics}:*")
+        mocked_request.return_value = {
+            "err": None,
+            "data": [{"test_case": "1", "result": -1, "cpu_time": 10, "memory": 1}],
+        }
+        self.judge()
+        # 判题时只记录增量
+        self.assertEqual(Problem.objects.get(id=self.problem.id).submission_number, 0)
+        judge_statistics.flush()
+        problem = Problem.objects.get(id=self.problem.id)
+        self.assertEqual((problem.submission_number, problem.accepted_number), (1, 0))
+        self.assertEqual(problem.statistic_info, {str(JudgeStatus.WRONG_ANSWER): 1})
+        profile = UserProfile.objects.get(user_id=self.submission.user_id)
+        self.assertEqual(profile.submission_number, 1)
+        self.assertEqual(
+            profile.acm_problems_status["problems"][str(self.problem.id)]["status"],
+            JudgeStatus.WRONG_ANSWER,
+        )
+
+        # 重新判题为通过, 提交数不变
+        mocked_request.return_value["data"][0]["result"] = 0
+        self.judge()
+        judge_statistics.flush()
+        problem = Problem.objects.get(id=self.problem.id)
+        self.assertEqual((problem.submission_number, problem.accepted_number), (1, 1))
+        self.assertEqual(problem.statistic_info, {str(JudgeStatus.ACCEPTED): 1})
+        profile = UserProfile.objects.get(user_id=self.submission.user_id)
+        self.assertEqual((profile.submission_number, profile.accepted_number), (1, 1))
+
+    @override_settings(JUDGE_DISPATCH_MODE=JudgeDispatchMode.CALLBACK)
+    @mock.patch("judge.dispatcher.DispatcherBase._post")
+    def test_judge_callback(
+        self, mocked_post, mocked_request, mocked_process_pending_task
+    ):
+        self.create_server("server1")
+        slot_allocator.refresh(force=True)
+        mocked_post.return_value = {"err": None, "data": "accepted"}
+        submission = self.judge()
+        self.assertEqual(submission.result, JudgeStatus.JUDGING)
+        self.assertEqual(mocked_post.call_args[0][1], "/judge_async")
+        self.assertEqual(slot_allocator.available(), 0)
+
+        SysOptions.judge_server_token = "test"
+        url = self.reverse("judge_server_callback_api")
+        data = {
+            "submission_id": submission.id,
+            "result": {
+                "err": None,
+                "data": [
+                    {"test_case": "1", "result": 0, "cpu_time": 10, "memory": 1024}
+                ],
+            },
+        }
+        headers = {"HTTP_X_JUDGE_SERVER_TOKEN": hashlib.sha256(b"test").hexdigest()}
+        self.assertFailed(self.client.post(url, data=data))
+        self.assertSuccess(self.client.post(url, data=data, **headers))
+        submission = Submission.objects.get(id=submission.id)
+        self.assertEqual(submission.result, JudgeStatus.ACCEPTED)
+        self.assertFalse(submission.is_judging)
+        self.assertEqual(slot_allocator.available(), 1)
+        # 重复的回调被忽略
+        self.assertFailed(self.client.post(url, data=data, **headers))
+
+    @override_settings(JUDGE_DISPATCH_MODE=JudgeDispatchMode.ASYNC)
+    def test_async_worker(self, mocked_request, mocked_process_pending_task):
+        self.create_server("server1")
+        slot_allocator.refresh(force=True)
+        self.judge()
+        mocked_request.assert_not_called()
+
+        worker = AsyncJudgeWorker()
+        jobs = worker.fetch()
+        self.assertEqual(len(jobs), 1)
+        dispatcher, slot, data = jobs[0]
+        self.assertEqual(data["src"], self.submission.code)
+        self.assertEqual(
+            Submission.objects.get(id=self.submission.id).result, JudgeStatus.JUDGING
+        )
+        self.assertEqual(worker.fetch(), [])
+
+        slot_allocator.release(slot)
+        resp = {
+            "err": None,
+            "data": [{"test_case": "1", "result": -1, "cpu_time": 10, "memory": 1}],
+        }
+        worker.flush([(dispatcher, resp, slot.id)])
+        submission = Submission.objects.get(id=self.submission.id)
+        self.assertEqual(submission.result, JudgeStatus.WRONG_ANSWER)
+        self.assertFalse(submission.is_judging)
+        self.assertFalse(judge_queue.contains(submission.id))
+
+    @override_settings(JUDGE_DISPATCH_MODE=JudgeDispatchMode.ASYNC)
+    def test_async_worker_keeps_order(
+        self, mocked_request, mocked_process_pending_task
+    ):
+        self.create_server("server1")
+        slot_allocator.refresh(force=True)
+        self.judge()
+        judge_queue.push("other", JudgeTaskClass.PRACTICE, 0, {})
+        order = [task["id"] for task in judge_queue.peek(2)]
+
+        # 名额在 available 之后被其他进程抢走, 任务留在原位
+        with mock.patch.object(slot_allocator, "acquire", return_value=None):
+            self.assertEqual(AsyncJudgeWorker().fetch(), [])
+        self.assertEqual([task["id"] for task in judge_queue.peek(2)], order)
+        self.assertEqual(sum(judge_queue.depth().values()), 2)
+
+    @override_settings(
+        JUDGE_DISPATCH_MODE=JudgeDispatchMode.BATCH, JUDGE_CALLBACK_PROXY_URL=""
+    )
+    def test_batch_worker(self, mocked_request, mocked_process_pending_task):
+        mock_server = start_mock_server(work=0)
+        self.addCleanup(mock_server.shutdown)
+        self.create_server("server1", cpu_core=2, service_url=mock_server.url)
+        slot_allocator.refresh(force=True)
+        other = Submission.objects.get(id=self.submission.id)
+        other.id = "other"
+        other.save(force_insert=True)
+        self.judge()
+        JudgeDispatcher(other.id, self.problem.id).judge()
+
+        available = slot_allocator.available()
+        worker = AsyncJudgeWorker(batch_size=5)
+        jobs = worker.fetch()
+        self.assertEqual(len(jobs), 2)
+        groups = worker.group(jobs)
+        self.assertEqual([len(group) for group in groups], [2])
+
+        async def run():
+            async with aiohttp.ClientSession() as session:
+                await worker.judge_batch(session, groups[0])
+
+        asyncio.run(run())
+        self.assertEqual(mock_server.requests, 1)
+        self.assertEqual(slot_allocator.available(), available)
+        worker.flush(worker.results)
+        for submission in Submission.objects.filter(
+            id__in=[self.submission.id, other.id]
+        ):
+            self.assertEqual(submission.result, JudgeStatus.ACCEPTED)
+            self.assertFalse(submission.is_judging)
+
+    @override_settings(JUDGE_DISPATCH_MODE=JudgeDispatchMode.ASYNC)
+    @mock.patch.object(JudgeDispatcher, "hedge_delay", new_callable=mock.PropertyMock)
+    def test_async_worker_hedged(
+        self, mocked_hedge_delay, mocked_request, mocked_process_pending_task
+    ):
+        servers = {}
+        for hostname in ("server1", "server2"):
+            mock_server = start_mock_server(work=0)
+            self.addCleanup(mock_server.shutdown)
+            server = self.create_server(hostname, service_url=mock_server.url)
+            servers[server.id] = mock_server
+        slot_allocator.refresh(force=True)
+        mocked_hedge_delay.return_value = 0.05
+        self.judge()
+
+        worker = AsyncJudgeWorker()
+        dispatcher, slot, data = worker.fetch()[0]
+        servers[slot.id].work = 5
+        # 发出 hedged 请求时服务器列表的进程内缓存已经过期, 需要读取数据库
+        judge_server_registry.invalidate()
+
+        async def run():
+            async with aiohttp.ClientSession() as session:
+                await worker.judge(session, dispatcher, slot, data)
+
+        # sync_to_async 中的数据库操作回到当前线程执行, 使用测试的事务
+        async_to_sync(run)()
+        self.assertEqual(len(worker.results), 1)
+        _, resp, server_id = worker.results[0]
+        self.assertEqual(resp["data"][0]["result"], JudgeStatus.ACCEPTED)
+        self.assertNotEqual(server_id, slot.id)
+        self.assertEqual(slot_allocator.available(), 2)
+
+    @mock.patch("judge.tasks.process_pending_compile_run_task")
+    @mock.patch("judge.tasks.process_pending_task")
+    def test_recover_stuck_submission(self, *mocks):
+        Submission.objects.filter(id=self.submission.id).update(
+            create_time=timezone.now() - timedelta(days=1)
+        )
+        recover_judge_tasks()
+        self.assertTrue(judge_queue.contains(self.submission.id))
+        self.assertEqual(judge_queue.peek(1)[0]["class"], JudgeTaskClass.PRACTICE)
+
+    @mock.patch("judge.tasks.process_pending_compile_run_task")
+    @mock.patch("judge.tasks.process_pending_task")
+    @mock.patch("judge.tasks.judge_task.delay")
+    def test_recover_skips_dispatched_submission(self, mocked_delay, *mocks):
+        Submission.objects.filter(id=self.submission.id).update(
+            create_time=timezone.now() - timedelta(days=1),
+            info={"err": None, "data": []},
+        )
+        submission = Submission.objects.get(id=self.submission.id)
+        # 重判的提交直接发给 celery, 还在 broker 中等待时不能再放回队列
+        dispatch_judge_task(submission)
+        mocked_delay.assert_called_once()
+        recover_judge_tasks()
+        self.assertEqual(judge_queue.peek(1), [])
+        self.assertEqual(sum(judge_queue.depth().values()), 0)
+
+        # 租约过期后作为重判任务放回队列
+        judge_queue.lease(
+            submission.id, JudgeTaskClass.REJUDGE, submission.user_id, {}, timeout=-1
+        )
+        recover_judge_tasks()
+        self.assertEqual(judge_queue.peek(1)[0]["class"], JudgeTaskClass.REJUDGE)
@@ -0,0 +1,14 @@
+"""
+ASGI config for qduoj project.
+
+Serves the async long-polling views (submission_wait, compile_run_wait) without
+tying up a thread per waiting request, see deploy/supervisord.conf.
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "oj.settings")
+
+application = get_asgi_application()
@@ -214,6 +214,47 @@ CELERY_RESULT_BACKEND = f"{REDIS_URL}/2"
 CELERY_BROKER_URL = f"{REDIS_URL}/3"
 CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
+CELERY_BEAT_SCHEDULE = {
+    "recover-judge-tasks": {
+        "task": "judge.tasks.recover_judge_tasks",
+        "schedule": 30,
+    },
+    "flush-judge-heartbeats": {
+        "task": "judge.tasks.flush_judge_heartbeats",
+        "schedule": 30,
+    },
+    "flush-judge-statistics": {
+        "task": "judge.tasks.flush_judge_statistics",
+        "schedule": 10,
+    },
+    "advance-rejudge-jobs": {
+        "task": "judge.tasks.advance_rejudge_jobs",
+        "schedule": 5,
+    },
+}
 IP_HEADER = "HTTP_X_REAL_IP"
 
+# 判题分发方式, 见 judge.dispatcher.JudgeDispatchMode, async 和 batch 模式需要另外运行 manage.py judge_async_worker
+JUDGE_DISPATCH_MODE = get_env("JUDGE_DISPATCH_MODE", "sync")
+# batch 模式下每个判题请求最多包含的提交数
+JUDGE_BATCH_SIZE = int(get_env("JUDGE_BATCH_SIZE", "20"))
+# callback 模式下 judge server 回传结果的地址
+JUDGE_CALLBACK_URL = get_env("JUDGE_CALLBACK_URL", "http://127.0.0.1:8080/api/judge_server_callback")
+# judge server 不支持回调或 /judge_batch 时, 由 judge_callback_proxy 代为调用 /judge, 为空表示直接发给 judge server
+JUDGE_CALLBACK_PROXY_URL = get_env("JUDGE_CALLBACK_PROXY_URL", "http://127.0.0.1:8090")
+# 选择判题服务器的策略, 见 judge.policies.POLICIES
+JUDGE_SELECTION_POLICY = get_env("JUDGE_SELECTION_POLICY", "affinity")
+# 判题请求超过预计时间的这个百分比还没有返回时, 在另一台服务器上再发一份, 取先返回的结果; 0 表示不开启, 不支持 callback 模式
+JUDGE_HEDGE_PERCENTILE = int(get_env("JUDGE_HEDGE_PERCENTILE", "0"))
+# 相同代码和判题参数的提交复用判题结果的缓存时间（秒）, 0 表示不开启
+JUDGE_RESULT_CACHE_TIMEOUT = int(get_env("JUDGE_RESULT_CACHE_TIMEOUT", "0"))
+# 相同代码和输入的自定义输入运行结果缓存的时间（秒）, 0 表示不缓存; 最多缓存的条数
+COMPILE_RUN_CACHE_TIMEOUT = int(get_env("COMPILE_RUN_CACHE_TIMEOUT", "600"))
+COMPILE_RUN_CACHE_SIZE = int(get_env("COMPILE_RUN_CACHE_SIZE", "10000"))
+# 批量重新判题时每秒最多放入队列的提交数
+JUDGE_REJUDGE_RATE = int(get_env("JUDGE_REJUDGE_RATE", "20"))
+# 排队的提交数或预计等待时间（秒）达到这个值时, 不再接受比赛以外的新提交; 0 表示不限制
+JUDGE_ADMISSION_MAX_DEPTH = int(get_env("JUDGE_ADMISSION_MAX_DEPTH", "0"))
+JUDGE_ADMISSION_MAX_WAIT = int(get_env("JUDGE_ADMISSION_MAX_WAIT", "0"))
+
 DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
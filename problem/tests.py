@@ -13,6 +13,7 @@ from .models import ProblemTag, ProblemIOMode
 from .models import Problem, ProblemRuleType
 from contest.models import Contest
 from contest.tests import DEFAULT_CONTEST_DATA
+from judge.context import problem_context_cache
 
 from .views.admin import TestCaseAPI
 from .utils import parse_problem_template
@@ -171,10 +172,13 @@ class ProblemAdminAPITest(APITestCase):
 
     def test_edit_problem(self):
         problem_id = self.test_create_problem().data["data"]["id"]
+        time_limit = problem_context_cache.get(problem_id).time_limit
         data = copy.deepcopy(self.data)
         data["id"] = problem_id
+        data["time_limit"] = time_limit + 1000
         resp = self.client.put(self.url, data=data)
         self.assertSuccess(resp)
+        self.assertEqual(problem_context_cache.get(problem_id).time_limit, time_limit + 1000)
 
 
 class ProblemAPITest(ProblemCreateTestBase):
@@ -15,6 +15,7 @@ from django.http import StreamingHttpResponse, FileResponse
 from account.decorators import problem_permission_required, ensure_created_by
 from contest.models import Contest, ContestStatus
 from fps.parser import FPSHelper, FPSParser
+from judge.context import problem_context_cache
 from judge.dispatcher import SPJCompiler
 from options.options import SysOptions
 from submission.models import Submission, JudgeStatus
@@ -311,6 +312,7 @@ class ProblemAPI(ProblemBase):
         for k, v in data.items():
             setattr(problem, k, v)
         problem.save()
+        problem_context_cache.invalidate(problem.id)
 
         problem.tags.remove(*problem.tags.all())
         for tag in tags:
@@ -447,6 +449,7 @@ class ContestProblemAPI(ProblemBase):
         for k, v in data.items():
             setattr(problem, k, v)
         problem.save()
+        problem_context_cache.invalidate(problem.id)
 
         problem.tags.remove(*problem.tags.all())
         for tag in tags:
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.9 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('submission', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='statistic_result',
+            field=models.IntegerField(null=True),
+        ),
+    ]
@@ -44,6 +44,9 @@ class Submission(models.Model):
     details = models.TextField(default="")
     ip = models.TextField(null=True)
     is_judging = models.BooleanField(default=False)
+    # 计入题目、用户和比赛排名统计信息的结果, 为空表示没有计入。
+    # 重新判题时 result 会暂时变为 JUDGING, 统计信息以这个字段为准
+    statistic_result = models.IntegerField(null=True)
 
     def check_user_permission(self, user, check_share=True):
         if (
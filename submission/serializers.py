@@ -11,6 +11,19 @@ class CreateSubmissionSerializer(serializers.Serializer):
     captcha = serializers.CharField(required=False)
 
 
+class CreateRejudgeJobSerializer(serializers.Serializer):
+    problem_id = serializers.IntegerField(required=False)
+    contest_id = serializers.IntegerField(required=False)
+    submission_ids = serializers.ListField(child=serializers.CharField(), required=False, allow_empty=False)
+    # 只重新判题这些结果的提交
+    result = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False)
+
+    def validate(self, data):
+        if not any(data.get(field) for field in ("problem_id", "contest_id", "submission_ids")):
+            raise serializers.ValidationError("problem_id, contest_id or submission_ids is required")
+        return data
+
+
 class ShareSubmissionSerializer(serializers.Serializer):
     id = serializers.CharField()
     shared = serializers.BooleanField()
@@ -1,7 +1,8 @@
 from django.conf.urls import url
 
-from ..views.admin import SubmissionRejudgeAPI
+from ..views.admin import SubmissionRejudgeAPI, SubmissionRejudgeJobAPI
 
 urlpatterns = [
     url(r"^submission/rejudge?$", SubmissionRejudgeAPI.as_view(), name="submission_rejudge_api"),
+    url(r"^submission/rejudge_job/?$", SubmissionRejudgeJobAPI.as_view(), name="submission_rejudge_job_api"),
 ]
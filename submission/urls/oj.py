@@ -1,10 +1,11 @@
 from django.conf.urls import url
 
-from ..views.oj import SubmissionAPI, SubmissionListAPI, ContestSubmissionListAPI, SubmissionExistsAPI
+from ..views.oj import SubmissionAPI, SubmissionListAPI, ContestSubmissionListAPI, SubmissionExistsAPI, SubmissionWaitAPI
 
 urlpatterns = [
     url(r"^submission/?$", SubmissionAPI.as_view(), name="submission_api"),
     url(r"^submissions/?$", SubmissionListAPI.as_view(), name="submission_list_api"),
+    url(r"^submission_wait/?$", SubmissionWaitAPI, name="submission_wait_api"),
     url(r"^submission_exists/?$", SubmissionExistsAPI.as_view(), name="submission_exists"),
     url(r"^contest_submissions/?$", ContestSubmissionListAPI.as_view(), name="contest_submission_list_api"),
 ]
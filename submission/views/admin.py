@@ -1,9 +1,11 @@
 from account.decorators import super_admin_required
-from judge.tasks import judge_task
+from judge.rejudge import rejudge_jobs
+from judge.tasks import dispatch_judge_task
 
 # from judge.dispatcher import JudgeDispatcher
-from utils.api import APIView
+from utils.api import APIView, validate_serializer
 from ..models import Submission
+from ..serializers import CreateRejudgeJobSerializer
 
 
 class SubmissionRejudgeAPI(APIView):
@@ -21,5 +23,29 @@ class SubmissionRejudgeAPI(APIView):
         submission.statistic_info = {}
         submission.save()
 
-        judge_task.delay(submission.id, submission.problem.id)
+        dispatch_judge_task(submission)
         return self.success()
+
+
+class SubmissionRejudgeJobAPI(APIView):
+    @super_admin_required
+    def get(self, request):
+        job_id = request.GET.get("id")
+        if not job_id:
+            return self.success(rejudge_jobs.list())
+        job = rejudge_jobs.get(job_id)
+        if not job:
+            return self.error("Rejudge job does not exist")
+        return self.success(job)
+
+    @super_admin_required
+    @validate_serializer(CreateRejudgeJobSerializer)
+    def post(self, request):
+        return self.success(rejudge_jobs.create(request.data, request.user.id))
+
+    @super_admin_required
+    def delete(self, request):
+        job = rejudge_jobs.cancel(request.GET.get("id"))
+        if not job:
+            return self.error("Rejudge job does not exist")
+        return self.success(job)
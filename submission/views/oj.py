@@ -1,17 +1,20 @@
 import ipaddress
+import time
 
 from account.decorators import login_required, check_contest_permission
 from contest.models import ContestStatus, ContestRuleType
-from judge.tasks import judge_task
+from judge.admission import judge_admission
+from judge.notifier import ResultKind, wait_result_view
+from judge.tasks import dispatch_judge_task
 from options.options import SysOptions
 
 # from judge.dispatcher import JudgeDispatcher
 from problem.models import Problem, ProblemRuleType
-from utils.api import APIView, validate_serializer
+from utils.api import APIError, APIView, validate_serializer
 from utils.cache import cache
 from utils.captcha import Captcha
 from utils.throttling import TokenBucket
-from ..models import Submission
+from ..models import JudgeStatus, Submission
 from ..serializers import (
     CreateSubmissionSerializer,
     SubmissionModelSerializer,
@@ -72,6 +75,17 @@ class SubmissionAPI(APIView):
         error = self.throttling(request)
         if error:
             return self.error(error)
+        retry_after = judge_admission.check(data.get("contest_id"))
+        if retry_after:
+            resp = self.response(
+                {
+                    "error": "judge-busy",
+                    "data": f"Too many submissions are waiting, please retry after {retry_after} seconds",
+                    "retry_after": retry_after,
+                }
+            )
+            resp["Retry-After"] = str(retry_after)
+            return resp
 
         try:
             problem = Problem.objects.get(
@@ -93,7 +107,11 @@ class SubmissionAPI(APIView):
         )
         # use this for debug
         # JudgeDispatcher(submission.id, problem.id).judge()
-        judge_task.delay(submission.id, problem.id)
+        dispatch_judge_task(
+            submission,
+            contest=self.contest if data.get("contest_id") else None,
+            enqueue_time=time.time(),
+        )
 
         # return => submission info
         if hide_id:
@@ -245,3 +263,24 @@ class SubmissionExistsAPI(APIView):
                 problem_id=request.GET["problem_id"], user_id=request.user.id
             ).exists()
         )
+
+
+def load_submission_result(request, submission_id):
+    """
+    SubmissionWaitAPI 使用, 判题没有结束时返回 None
+    """
+    if not request.user.is_authenticated:
+        raise APIError("Please login first", err="permission-denied")
+    try:
+        submission = Submission.objects.select_related("problem").get(id=submission_id)
+    except Submission.DoesNotExist:
+        raise APIError("Submission doesn't exist")
+    if not submission.check_user_permission(request.user):
+        raise APIError("No permission for this submission")
+    if submission.result in (JudgeStatus.PENDING, JudgeStatus.JUDGING):
+        return None
+    return submission.result
+
+
+# 长轮询等待判题结束, 结束后再调用 SubmissionAPI.get 获取详情
+SubmissionWaitAPI = wait_result_view(ResultKind.SUBMISSION, load_submission_result)
@@ -22,9 +22,28 @@ class ContestRuleType(Choices):
 
 
 class CacheKey:
-    waiting_queue = "waiting_queue"
+    judge_queue = "judge_queue"
     contest_rank_cache = "contest_rank_cache"
     website_config = "website_config"
+    judge_slot_capacity = "judge_slot:capacity"
+    judge_slot_servers = "judge_slot:servers"
+    judge_slot_leases = "judge_slot:leases"
+    judge_slot_latency = "judge_slot:latency"
+    judge_slot_reconcile_lock = "judge_slot:reconcile_lock"
+    judge_client_stats = "judge_client_stats"
+    judge_callback = "judge_callback"
+    judge_breaker = "judge_breaker"
+    judge_heartbeat = "judge_heartbeat"
+    judge_heartbeat_active = "judge_heartbeat_active"
+    judge_result_cache = "judge_result_cache"
+    judge_result_cache_stats = "judge_result_cache_stats"
+    compile_run_cache = "compile_run_cache"
+    compile_run_cache_stats = "compile_run_cache_stats"
+    problem_judge_version = "problem_judge_version"
+    judge_statistics = "judge_statistics"
+    rejudge_job = "rejudge_job"
+    judge_metrics = "judge_metrics"
+    result_notify = "result_notify"
 
 
 class Difficulty(Choices):